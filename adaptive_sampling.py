@@ -0,0 +1,95 @@
+import numpy as np
+
+
+class adaptive_sampler:
+
+    def __init__(self,nH_list,d_list,target_median=None,target_peak=None,min_count=50,max_count=300,round_size=50):
+        '''
+        Plans the rounds of an adaptive run: every (nH, d) cell gets realizations until the confidence intervals of
+        its median distance and distance peak (see cell_stats.cell_table.intervals) are narrower than the targets,
+        so the simulation budget goes to the noisy cells instead of 300 realizations everywhere.
+
+        A cell is done when it has at least min_count realizations and both half widths, relative to the true
+        distance d, are within target_median and target_peak (a target of None is not checked), or when it reaches
+        max_count. An unfinished cell gets as many realizations as the 1/sqrt(n) shrinking of its widest interval
+        projects to reach the target, at least round_size and at most as many as it already has (so a noisy early
+        estimate cannot spend its whole budget at once).
+
+        Task ids are cell index * max_count + realization, the ids of build_tasks with n_iterations=max_count, so a
+        result store of a fixed run of max_count iterations (or of an interrupted adaptive run) can be resumed.
+
+        Arguments:
+        nH_list, d_list: grid of the run
+        target_median: target half width of the interval of the median d_fit, as a fraction of d
+        target_peak: target half width of the bootstrap interval of d_fit_peak, as a fraction of d
+        min_count, max_count: realizations per cell before convergence is checked and at most
+        round_size: smallest number of realizations given to an unfinished cell in a round
+        '''
+        if target_median is None and target_peak is None:
+            raise ValueError('Give target_median and/or target_peak.')
+        if not 0 < min_count <= max_count:
+            raise ValueError('min_count must be between 1 and max_count.')
+        self.target_median = target_median
+        self.target_peak = target_peak
+        self.min_count = min_count
+        self.max_count = max_count
+        self.round_size = round_size
+        self.keys = [(nH_value, d) for nH_value in nH_list for d in d_list]
+        # Next unused task id of every cell
+        self.next_id = {key: i * max_count for i, key in enumerate(self.keys)}
+
+    def resume(self,task_rows):
+        '''
+        Continues after the task ids already used (dictionary {task id: number of rows}, see
+        result_store.task_rows).
+        '''
+        for task_id, n_rows in task_rows.items():
+            key = self.keys[int(task_id) // self.max_count]
+            self.next_id[key] = max(self.next_id[key], int(task_id) + max(int(n_rows), 1))
+
+    def status(self,cells):
+        '''
+        Convergence of every cell of a cell_stats.cell_table.
+
+        Output:
+        dictionary of arrays in grid order: 'count', 'median_width' and 'peak_width' (relative half widths, inf
+        where undefined), 'converged' (targets met) and 'done' (converged or out of realizations)
+        '''
+        intervals = cells.intervals(self.keys)
+        d = np.array([key[1] for key in self.keys], dtype=float)
+        count = np.array([cells.cells[key].count for key in self.keys])
+        with np.errstate(invalid='ignore'):
+            median_width = np.nan_to_num((intervals['median_up'] - intervals['median_low']) / (2 * d), nan=np.inf)
+            peak_width = np.nan_to_num((intervals['peak_up'] - intervals['peak_low']) / (2 * d), nan=np.inf)
+        converged = count >= self.min_count
+        if self.target_median is not None:
+            converged &= median_width <= self.target_median
+        if self.target_peak is not None:
+            converged &= peak_width <= self.target_peak
+        exhausted = np.array([self.next_id[key] >= (i + 1) * self.max_count for i, key in enumerate(self.keys)])
+        return {'count': count, 'median_width': median_width, 'peak_width': peak_width, 'converged': converged, 'done': converged | exhausted}
+
+    def next_round(self,cells,batched=False):
+        '''
+        Tasks of the next round for the unfinished cells of a cell_stats.cell_table (empty when all are done): (nH,
+        d, iteration) per realization, or (nH, d, n_iterations, first_id) per cell when batched.
+        '''
+        status = self.status(cells)
+        tasks = []
+        for i, key in enumerate(self.keys):
+            if status['done'][i]:
+                continue
+            count = status['count'][i]
+            if count < self.min_count:
+                n = self.min_count - count
+            else:
+                ratios = [width / target for width, target in ((status['median_width'][i], self.target_median), (status['peak_width'][i], self.target_peak)) if target is not None]
+                projected = count * max(ratios) ** 2 if np.isfinite(max(ratios)) else np.inf
+                n = int(np.clip(np.ceil(projected - count), self.round_size, max(count, self.round_size)))
+            n = min(n, (i + 1) * self.max_count - self.next_id[key])
+            if batched:
+                tasks.append(key + (n, self.next_id[key]))
+            else:
+                tasks.extend(key + (task_id,) for task_id in range(self.next_id[key], self.next_id[key] + n))
+            self.next_id[key] += n
+        return tasks
@@ -0,0 +1,353 @@
+import argparse
+import json
+import os
+import pickle
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from bias_emulator import bias_emulator, LOG_VARIABLES
+from cell_stats import find_peak
+from gr_correction import correction_table, write_npy_cache
+from profiling import latency_summary, run_profile
+from result_store import RESULT_COLUMNS
+from scheduler import task_scheduler
+import observational_effects as oe
+
+# Grid of observational_effects.py __main__
+D_LIST = [1,2,3,4,5,6,8,12,18,26]
+NH_LIST = [0.1,0.5,5,10]
+
+# Relative change of throughput or p50 latency reported as a regression by --compare
+TOLERANCE = 0.2
+
+
+def synthetic_correction_table(n_a=1000,n_i=86):
+    """
+    Correction table with the grid sizes of gGR_gNT_J1655.h5 and smooth, plausible values (Rin/Rg at the ISCO),
+    used when the real file is not there so the benchmarks run offline.
+    """
+    a_grid = np.linspace(-0.998, 0.998, n_a)
+    z1 = 1 + (1 - a_grid**2)**(1/3) * ((1 + a_grid)**(1/3) + (1 - a_grid)**(1/3))
+    z2 = np.sqrt(3 * a_grid**2 + z1**2)
+    r_grid = 3 + z2 - np.sign(a_grid) * np.sqrt((3 - z1) * (3 + z1 + 2 * z2))
+    i_grid = np.linspace(0.0, 85.0, n_i)
+    gGR_grid = 1 + 0.3 * np.outer(1 / r_grid, 1 - np.cos(np.radians(i_grid)))
+    gNT_grid = 0.5 + 0.1 * a_grid
+    return correction_table({'a_grid': a_grid, 'r_grid': r_grid, 'i_grid': i_grid, 'gGR_grid': gGR_grid, 'gNT_grid': gNT_grid}, verbose=False)
+
+
+def load_correction_table():
+    if os.path.isfile('gGR_gNT_J1655.h5'):
+        return oe.correction_file()
+    return synthetic_correction_table()
+
+
+def config(**kwargs):
+    """
+    Configuration (the argparse.Namespace of observational_effects.py) of the fake-backend runs.
+    """
+    values = {'gamma': 2.0, 'temp': 1.0, 'a': 0.5, 'mass': 8.0, 'inc': 60.0, 'ratio_disk_to_tot': 0.8, 'exposure': 1000.0,
+              'instrument': 'maxi', 'backend': 'fake', 'batched': False, 'fake_settings': {}}
+    values.update(kwargs)
+    return argparse.Namespace(**values)
+
+
+def time_calls(function,inputs):
+    """
+    Calls function once per input and returns the seconds each call took.
+    """
+    seconds = np.empty(len(inputs))
+    for k, value in enumerate(inputs):
+        start = time.perf_counter()
+        function(value)
+        seconds[k] = time.perf_counter() - start
+    return seconds
+
+
+def call_report(seconds,payload):
+    """
+    Throughput, latency percentiles and pickled bytes of one call (payload: the arguments of a call).
+    """
+    latency = latency_summary(seconds)
+    del latency['histogram']
+    return {'calls': len(seconds), 'seconds': float(np.sum(seconds)), 'throughput': len(seconds) / float(np.sum(seconds)),
+            'latency': latency, 'pickled_bytes': len(pickle.dumps(payload))}
+
+
+def bench_scheduler(n_tasks=2000,processes=2,latency=0.002,latency_sigma=0.5,hang_rate=0.001,error_rate=0.005,task_timeout=1.0,max_retries=2,seed=0,start_method='forkserver'):
+    """
+    main() with the scheduler of make_scheduler over n_tasks fake realizations: dispatch, the timeout loop,
+    retries, run_simulation (to_norm, powerlaw scaling and to_d) and result collection. Latency is the round trip
+    from dispatch to receipt per completed task; 'overhead' is the part not spent inside the task. 'worker_start'
+    and 'worker_restart' are the mean seconds from process start to ready of the first workers and of the workers
+    that replaced a timed out one.
+    """
+    args = config(fake_settings={'latency': latency, 'latency_sigma': latency_sigma, 'hang_rate': hang_rate, 'error_rate': error_rate})
+    tasks = oe.build_tasks(NH_LIST, D_LIST, n_iterations=n_tasks // (len(NH_LIST) * len(D_LIST)) + 1)[:n_tasks]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_dir = os.path.join(tmp_dir, 'correction_npy')
+        write_npy_cache(load_correction_table(), cache_dir)
+        scheduler = task_scheduler(oe.run_simulation,processes,task_timeout=task_timeout,max_retries=max_retries,
+                                   initializer=oe.init_worker,initargs=(cache_dir, args, tmp_dir),max_consecutive_timeouts=10,seed=seed,
+                                   start_method=start_method,preload=oe.preload_modules('fake'))
+        profile = run_profile()
+        start = time.perf_counter()
+        results, timed_out, errored = oe.main(tasks,scheduler=scheduler,profile=profile)
+        elapsed = time.perf_counter() - start
+    rows = profile.tasks()
+    latency = latency_summary(rows['wall'] + rows['ipc'])
+    overhead = latency_summary(rows['ipc'])
+    del latency['histogram'], overhead['histogram']
+    summary = profile.summary()
+    starts = profile.worker_starts()
+    return {'calls': len(tasks), 'completed': len(rows), 'timed_out': len(timed_out), 'errored': len(errored), 'processes': processes,
+            'retries': sum(cell['retries'] for cell in profile.cells.values()),
+            'seconds': elapsed, 'throughput': len(rows) / elapsed, 'throughput_per_core': summary['tasks_per_second_per_core'],
+            'worker_utilisation': summary['worker_utilisation'], 'latency': latency, 'overhead': overhead,
+            'worker_start': starts.loc[~starts['restart'].astype(bool), 'startup'].mean(), 'worker_restart': starts.loc[starts['restart'].astype(bool), 'startup'].mean(),
+            'pickled_bytes': float(np.mean([len(pickle.dumps(task)) for task in tasks])),
+            'result_pickled_bytes': float(np.mean([len(pickle.dumps(result)) for result in results[:100]]))}
+
+
+def bench_build_tasks(repeat=20,n_iterations=300):
+    """
+    Task construction of observational_effects.py for the full nH x d grid.
+    """
+    seconds = time_calls(lambda _: oe.build_tasks(NH_LIST, D_LIST, n_iterations=n_iterations), range(repeat))
+    tasks = oe.build_tasks(NH_LIST, D_LIST, n_iterations=n_iterations)
+    report = call_report(seconds, tasks[0])
+    report['tasks_per_call'] = len(tasks)
+    return report
+
+
+def bench_gr_correction(n_calls=3000,n_pairs=1000,seed=0):
+    """
+    get_total_correction_GR_and_Rin_Rg_ratio for scalar (inc, a); every pair is queried three times, so the
+    percentiles cover both the grid search and the memoized lookups.
+    """
+    table = load_correction_table()
+    rng = np.random.default_rng(seed)
+    pairs = np.column_stack((rng.uniform(5, 85, n_pairs), rng.uniform(-0.99, 0.99, n_pairs)))
+    inputs = [tuple(pairs[k % n_pairs]) for k in range(n_calls)]
+    seconds = time_calls(lambda pair: oe.get_total_correction_GR_and_Rin_Rg_ratio(table, pair[0], pair[1], verbose=False), inputs)
+    return call_report(seconds, inputs[0])
+
+
+def bench_to_norm_to_d(n_calls=5000,seed=0):
+    """
+    to_norm followed by to_d for one realization, as run_simulation calls them.
+    """
+    table = load_correction_table()
+    rng = np.random.default_rng(seed)
+    distances = rng.choice(D_LIST, n_calls).astype(float)
+    seconds = time_calls(lambda d: oe.to_d(table, oe.to_norm(table, d, 8.0, 0.5, 60.0), 8.0, 0.5, 60.0), distances)
+    return call_report(seconds, (distances[0], 8.0, 0.5, 60.0))
+
+
+def bench_find_peak(n_calls=500,n_realizations=300,seed=0):
+    """
+    find_peak (histogram mode with Stone's bin rule) on one cell of realizations.
+    """
+    rng = np.random.default_rng(seed)
+    samples = [rng.lognormal(np.log(8.0), 0.2, n_realizations) for _ in range(n_calls)]
+    seconds = time_calls(find_peak, samples)
+    return call_report(seconds, samples[0])
+
+
+def synthetic_full_table(n_realizations=300,seed=0):
+    """
+    Full table (RESULT_COLUMNS) of a fake run over the __main__ grid, with a few failed fits.
+    """
+    rng = np.random.default_rng(seed)
+    nH, d = np.meshgrid(NH_LIST, D_LIST, indexing='ij')
+    nH = np.repeat(nH.ravel(), n_realizations)
+    d = np.repeat(d.ravel(), n_realizations).astype(float)
+    df = pd.DataFrame({column: rng.lognormal(0, 0.1, len(d)) for column in RESULT_COLUMNS})
+    df['nH'], df['d'] = nH, d
+    df['d_fit'] = d * rng.lognormal(0, 0.1, len(d))
+    df['error_d_low'], df['error_d_up'] = 0.9 * df['d_fit'], 1.1 * df['d_fit']
+    df.loc[rng.random(len(d)) < 0.01, ['d_fit', 'error_d_low', 'error_d_up', 'frac_uncert']] = np.nan
+    return df
+
+
+def bench_reduce_results(repeat=5,n_realizations=300,n_boot=200):
+    """
+    reduce_results (the table_red reduction: medians, distance peak and its bootstrap interval per cell).
+    """
+    df_full = synthetic_full_table(n_realizations)
+    seconds = time_calls(lambda _: oe.reduce_results(df_full, NH_LIST, D_LIST, n_boot=n_boot), range(repeat))
+    report = call_report(seconds, df_full)
+    report['rows_per_call'] = len(df_full)
+    return report
+
+
+def emulator_queries(emulator,n,seed=0):
+    """
+    Queries of every variable of a bias_emulator, uniform (log-uniform for LOG_VARIABLES) over the range of its
+    tables and a little beyond, so some are extrapolated.
+    """
+    rng = np.random.default_rng(seed)
+    queries = {}
+    for name, axis in emulator.axes.items():
+        if name in LOG_VARIABLES:
+            queries[name] = np.exp(rng.uniform(np.log(axis[0]) - 0.2, np.log(axis[-1]) + 0.2, n))
+        else:
+            queries[name] = rng.uniform(axis[0] - 0.1, axis[-1] + 0.1, n)
+    return queries
+
+
+def bench_bias_emulator(repeat=5,n_queries=1000000,seed=0):
+    """
+    bias_emulator.predict on n_queries points of all variables (effects_data_maxi tables), after one small call
+    that builds the per-cell contractions.
+    """
+    emulator = bias_emulator('effects_data_maxi')
+    queries = emulator_queries(emulator, n_queries, seed)
+    emulator.predict(**{name: value[:10] for name, value in queries.items()})
+    seconds = time_calls(lambda _: emulator.predict(**queries), range(repeat))
+    report = call_report(seconds, {name: value[:1] for name, value in queries.items()})
+    report['queries_per_second'] = n_queries / float(np.median(seconds))
+    return report
+
+
+BENCHMARKS = {
+    'build_tasks': bench_build_tasks,
+    'gr_correction': bench_gr_correction,
+    'to_norm_to_d': bench_to_norm_to_d,
+    'find_peak': bench_find_peak,
+    'reduce_results': bench_reduce_results,
+    'bias_emulator': bench_bias_emulator,
+    'scheduler': bench_scheduler,
+}
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size (MB) of this process and of its largest finished child (the scheduler workers).
+    """
+    scale = 1 / 1024 if sys.platform != 'darwin' else 1 / 1024**2
+    return {'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale}
+
+
+def run_benchmark(name,options):
+    """
+    Runs one benchmark in a fresh interpreter, so that its peak RSS is its own, and returns its report.
+    """
+    with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as fh:
+        output = fh.name
+    try:
+        command = [sys.executable, os.path.abspath(__file__), '--run-one', name, '--output', output, '--options', json.dumps(options)]
+        process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if process.returncode != 0:
+            raise RuntimeError('Benchmark %s failed:\n%s' % (name, process.stderr[-2000:]))
+        with open(output) as fh:
+            return json.load(fh)
+    finally:
+        os.remove(output)
+
+
+def environment():
+    return {'date': datetime.now().isoformat(timespec='seconds'), 'host': platform.node(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'pandas': pd.__version__, 'cpus': os.cpu_count()}
+
+
+def compare(results,baseline,tolerance=TOLERANCE):
+    """
+    Relative change of throughput and p50/p99 latency against a saved baseline.
+
+    Returns:
+        DataFrame with one row per benchmark in both, and the names of the benchmarks whose throughput dropped
+        or p50 latency rose by more than tolerance.
+    """
+    rows, regressions = [], []
+    for name, report in results.items():
+        if name not in baseline:
+            continue
+        reference = baseline[name]
+        row = {'benchmark': name,
+               'throughput': report['throughput'] / reference['throughput'] - 1,
+               'p50': report['latency']['p50'] / reference['latency']['p50'] - 1,
+               'p99': report['latency']['p99'] / reference['latency']['p99'] - 1,
+               'peak_rss': report['peak_rss_mb']['self'] / reference['peak_rss_mb']['self'] - 1}
+        rows.append(row)
+        if row['throughput'] < -tolerance or row['p50'] > tolerance:
+            regressions.append(name)
+    return pd.DataFrame(rows), regressions
+
+
+def print_report(results):
+    for name, report in results.items():
+        latency = report['latency']
+        print(f"{name:>15}: {report['throughput']:10.1f} calls/s  p50 {latency['p50']*1e3:9.3f} ms  p90 {latency['p90']*1e3:9.3f} ms  "
+              f"p99 {latency['p99']*1e3:9.3f} ms  peak RSS {report['peak_rss_mb']['self']:6.0f} MB  {report['pickled_bytes']:8.0f} pickled bytes")
+    if 'scheduler' in results:
+        report = results['scheduler']
+        print(f"{'':>15}  scheduler: {report['completed']}/{report['calls']} completed, {report['timed_out']} timed out, {report['errored']} errored, {report['retries']} retries, "
+              f"{report['throughput_per_core']:.1f} tasks/s per core, utilisation {100*report['worker_utilisation']:.0f}%, "
+              f"overhead p50 {report['overhead']['p50']*1e3:.3f} ms, worker peak RSS {report['peak_rss_mb']['children']:.0f} MB, "
+              f"worker start {report['worker_start']*1e3:.0f} ms, restart {report['worker_restart']*1e3:.0f} ms")
+    if 'bias_emulator' in results:
+        print(f"{'':>15}  bias_emulator: {results['bias_emulator']['queries_per_second']:.3g} queries/s")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the scheduler and post-processing hot paths, with a fake spectral backend (fake_backend.py) instead of XSPEC')
+    parser.add_argument('benchmarks', nargs='*', help='benchmarks to run (default: all of %s)' % ', '.join(BENCHMARKS))
+    parser.add_argument('--processes', type=int, default=2, help='scheduler workers')
+    parser.add_argument('--n-tasks', type=int, default=2000, help='fake realizations run by the scheduler benchmark')
+    parser.add_argument('--latency', type=float, default=0.002, help='median seconds per fake realization')
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help='log-normal scatter of the fake latency')
+    parser.add_argument('--hang-rate', type=float, default=0.001, help='fraction of fake realizations that hang until the task timeout')
+    parser.add_argument('--error-rate', type=float, default=0.005, help='fraction of fake realizations that raise')
+    parser.add_argument('--task-timeout', type=float, default=1.0, help='task timeout of the scheduler benchmark (s)')
+    parser.add_argument('--start-method', type=str, choices=['forkserver','fork','spawn'], default='forkserver', help='how the scheduler benchmark starts its workers')
+    parser.add_argument('--save-baseline', type=str, default=None, help='write the results to this JSON file')
+    parser.add_argument('--compare', type=str, default=None, help='compare with a baseline JSON file; exits with 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='relative change reported as a regression')
+    parser.add_argument('--run-one', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--output', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--options', type=str, default='{}', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        report = BENCHMARKS[args.run_one](**json.loads(args.options))
+        report['peak_rss_mb'] = peak_rss_mb()
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, default=float)
+        sys.exit(0)
+
+    names = args.benchmarks if args.benchmarks else list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error('unknown benchmarks: %s' % ', '.join(unknown))
+    scheduler_options = {'n_tasks': args.n_tasks, 'processes': args.processes, 'latency': args.latency, 'latency_sigma': args.latency_sigma,
+                         'hang_rate': args.hang_rate, 'error_rate': args.error_rate, 'task_timeout': args.task_timeout,
+                         'start_method': args.start_method}
+
+    results = {}
+    for name in names:
+        results[name] = run_benchmark(name, scheduler_options if name == 'scheduler' else {})
+    print_report(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as fh:
+            json.dump({'environment': environment(), 'options': scheduler_options, 'results': results}, fh, indent=1, default=float)
+        print(f"Baseline written to {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)
+        changes, regressions = compare(results, baseline['results'], tolerance=args.tolerance)
+        print(f"Relative change against {args.compare} ({baseline['environment']['date']}, {baseline['environment']['host']}):")
+        print(changes.to_string(index=False, float_format=lambda x: f"{x:+.1%}"))
+        if regressions:
+            print("Regressions: " + ", ".join(regressions))
+            sys.exit(1)
@@ -0,0 +1,438 @@
+import glob
+import os
+import re
+import numpy as np
+import pandas as pd
+from interpolation import axis_brackets, axis_weights, curvature_bound
+
+# Variables of the bias model (factor names of Interaction_analysis.Rmd) and the names used elsewhere in the repo
+VARIABLES = ('nH', 'g', 'T', 'a', 'm', 'i', 'r', 'e', 'd')
+ALIASES = {'gamma': 'g', 'temp': 'T', 'mass': 'm', 'inc': 'i', 'ratio_disk_to_tot': 'r', 'exposure': 'e'}
+
+# Variables spanning decades, interpolated in log space
+LOG_VARIABLES = ('nH', 'e', 'd')
+
+# Reduced result tables of the XSPEC backend; tables of other backends end in _<backend> (see
+# observational_effects.table_name) and are not used
+TABLE_PATTERN = re.compile(r'table_g(?P<g>[^_]+)_T(?P<T>[^_]+)_a(?P<a>[^_]+)_m(?P<m>[^_]+)_i(?P<i>[^_]+)_r(?P<r>[^_]+)_e(?P<e>[^_]+)\.csv$')
+
+
+def canonical_queries(queries):
+    """
+    Query dictionary with the names of VARIABLES (aliases such as gamma or temp are renamed) and float arrays
+    broadcast to a common shape.
+    """
+    renamed = {ALIASES.get(name, name): value for name, value in queries.items()}
+    unknown = set(renamed) - set(VARIABLES)
+    if unknown:
+        raise ValueError('Unknown variables: %s' % ', '.join(sorted(unknown)))
+    arrays = np.broadcast_arrays(*[np.asarray(value, dtype=float) for value in renamed.values()])
+    return dict(zip(renamed, arrays))
+
+
+# Interpolation weights at which the per-cell contractions of the effect tables are evaluated, and the inverse of
+# their Vandermonde matrix (the contractions are polynomials of degree 2 in each weight)
+NODES = np.array([0.0, 0.5, 1.0])
+NODES_INVERSE = np.linalg.inv(np.vander(NODES, 3, increasing=True))
+
+
+def cell_polynomial(coefficients,cell,w_i,w_j):
+    """
+    Horner evaluation of polynomials in two weights, with coefficients (powers of w_i, powers of w_j, cells), at the
+    cell of every query.
+    """
+    total = 0.0
+    for row in coefficients[::-1]:
+        value = 0.0
+        for c in row[::-1]:
+            value = value * w_j + np.take(c, cell)
+        total = total * w_i + value
+    return total
+
+
+class effect_table:
+
+    def __init__(self,filename):
+        '''
+        One pairwise effect table written by Interaction_analysis.Rmd (allEffects of the lm on log_frac_uncert):
+        two factor columns, then fit, se, lower and upper.
+        '''
+        df = pd.read_csv(filename)
+        self.filename = filename
+        self.variables = (df.columns[0], df.columns[1])
+        self.axes = [np.sort(df[name].astype(float).unique()) for name in self.variables]
+        shape = (len(self.axes[0]), len(self.axes[1]))
+        self.fit = np.full(shape, np.nan)
+        self.se = np.full(shape, np.nan)
+        rows = np.searchsorted(self.axes[0], df[self.variables[0]].astype(float))
+        cols = np.searchsorted(self.axes[1], df[self.variables[1]].astype(float))
+        self.fit[rows, cols] = df['fit']
+        self.se[rows, cols] = df['se']
+        if np.isnan(self.fit).any():
+            raise ValueError('%s does not cover the full %s x %s grid.' % (filename, *self.variables))
+
+
+def level_weights(tables,iterations=100,tol=1e-12):
+    """
+    Level proportions p of every variable at which the effect tables were computed. effects() averages the factors
+    that are not shown in a table with the proportions of their levels in the fitted data (unequal, because of the
+    |frac_uncert| <= 1 cut), and the model is linear in each factor's indicator vector, so consistent proportions make
+    p_i^T E_ij p_j the same constant c for every table and E_ij p_j the same main effect of i for every table with
+    i. Those conditions are solved by least squares (Levenberg-Marquardt, softmax parametrization).
+
+    Output:
+    dictionary {variable: proportions}, the constant c and the rms of the remaining inconsistency
+    """
+    names = sorted({name for table in tables for name in table.variables}, key=VARIABLES.index)
+    sizes = {name: len(next(table.axes[table.variables.index(name)] for table in tables if name in table.variables)) for name in names}
+    offsets = np.cumsum([0] + [sizes[name] - 1 for name in names])
+
+    def unpack(theta):
+        p = {}
+        for name, start in zip(names, offsets):
+            e = np.exp(np.concatenate([[0.0], theta[start:start + sizes[name] - 1]]))
+            p[name] = e / e.sum()
+        return p, theta[-1]
+
+    def residuals(theta):
+        p, c = unpack(theta)
+        main = {name: [] for name in names}
+        r = []
+        for table in tables:
+            i, j = table.variables
+            r.append([p[i] @ table.fit @ p[j] - c])
+            main[i].append(table.fit @ p[j])
+            main[j].append(table.fit.T @ p[i])
+        for effects in main.values():
+            r.extend(effect - np.mean(effects, axis=0) for effect in effects)
+        return np.concatenate(r)
+
+    theta = np.zeros(offsets[-1] + 1)
+    theta[-1] = np.mean([table.fit.mean() for table in tables])
+    r = residuals(theta)
+    damping = 1e-3
+    for _ in range(iterations):
+        jacobian = np.stack([(residuals(theta + 1e-7 * e) - r) / 1e-7 for e in np.eye(len(theta))], axis=1)
+        JTJ, JTr = jacobian.T @ jacobian, jacobian.T @ r
+        step = np.linalg.solve(JTJ + damping * np.diag(np.diag(JTJ) + 1e-12), -JTr)
+        r_new = residuals(theta + step)
+        if r_new @ r_new < r @ r:
+            theta, damping = theta + step, damping / 10
+            converged = r @ r - r_new @ r_new < tol * max(r @ r, 1e-30)
+            r = r_new
+            if converged:
+                break
+        else:
+            damping *= 10
+    p, c = unpack(theta)
+    return p, c, np.sqrt(np.mean(r ** 2))
+
+
+class bias_emulator:
+
+    def __init__(self,effects_dir,results_pattern=None,instrument=None):
+        '''
+        Surrogate of log(|d - d_fit| / d) (the response of Interaction_analysis.Rmd) for any combination of nH, g, T,
+        a, m, i, r, e and d.
+
+        The pairwise effect tables are slices of one model with two-way interactions, each with the other variables
+        averaged at the level proportions of the data (see level_weights). With u_i the interpolation weights of a
+        query on the levels of i and u_c = u_i - p_i, the model is recovered exactly from the tables as
+
+            c + sum_i u_c^T E_ij p_j (main effects) + sum_ij u_c^T E_ij v_c (interactions)
+
+        (main effects averaged over the tables with i), so a table contributes sum(G * fit) with fixed weights G.
+        Tables are interpolated bilinearly (log axes for nH, e and d). The standard error follows from the tabulated
+        se (treating the cells as independent; their covariance is not saved). A variable left out of a query is
+        averaged at its data proportions, so leaving out all but two variables returns their table; variables
+        without a table (m and d when the lm dropped them) do not change the prediction.
+
+        Reduced result tables (table_*.csv, see load_results) can be added: where a query lies inside a fully
+        simulated hypercube of their grid, the multilinear interpolation of the simulated median bias is used
+        instead.
+
+        Arguments:
+        effects_dir: directory with effect_<x>_<y>.csv tables (effects_data_maxi or effects_data_xrt)
+        results_pattern: optional glob of reduced result tables, e.g. 'results/maxi_results/table_*.csv'
+        instrument: passed to load_results (default: from the directory names)
+        '''
+        self.tables = [effect_table(f) for f in sorted(glob.glob(os.path.join(effects_dir, 'effect_*.csv')))]
+        if not self.tables:
+            raise ValueError('No effect_*.csv tables in %s' % effects_dir)
+        self.variables = sorted({name for table in self.tables for name in table.variables}, key=VARIABLES.index)
+        # Number of tables each variable's main effect is averaged over
+        self.n_tables = {name: sum(name in table.variables for table in self.tables) for name in self.variables}
+        self.proportions, self.constant, self.inconsistency = level_weights(self.tables)
+        self.axes = {name: next(table.axes[table.variables.index(name)] for table in self.tables if name in table.variables) for name in self.variables}
+        # Per-cell contractions of each table, by table and queried variables (see _table_contractions)
+        self.contractions = {}
+        self.results = None
+        if results_pattern is not None:
+            self.results = results_surrogate(load_results(results_pattern, instrument=instrument))
+
+    def _table_weights(self,table,u,v):
+        '''
+        Weights G (n, n_i, n_j) such that the contribution of this table to the prediction is sum(G * fit), for the
+        interpolation weights u (n, n_i) and v (n, n_j) on the levels of its two variables (their proportions for a
+        variable that is not queried), and the contribution as a function of the level of each variable (n, levels;
+        the other one at its query value).
+        '''
+        name_i, name_j = table.variables
+        p_i, p_j = self.proportions[name_i], self.proportions[name_j]
+        u_c, v_c = u - p_i, v - p_j
+        G = (u_c[:, :, None] * v_c[:, None, :]
+             + u_c[:, :, None] * p_j[None, None, :] / self.n_tables[name_i]
+             + p_i[None, :, None] * v_c[:, None, :] / self.n_tables[name_j]
+             + p_i[:, None] * p_j[None, :] / len(self.tables))
+        profile_i = v_c @ table.fit.T + table.fit @ p_j / self.n_tables[name_i]
+        profile_j = u_c @ table.fit + p_i @ table.fit / self.n_tables[name_j]
+        return G, profile_i, profile_j
+
+    def _table_contractions(self,table,queried):
+        '''
+        Contractions of a table for queries of the variables in queried, per cell of its grid, so that a prediction
+        only gathers the coefficients of the cell of each query: G is bilinear in the interpolation weights w_i and
+        w_j of a query in its cell, so sum(G * fit) is bilinear and sum(G^2 * se^2) of degree 2 in each, and the
+        profiles are linear in the weight of the other variable. They are evaluated with the dense weights G at the
+        NODES of every cell and converted to polynomial coefficients, once per table and set of queried variables,
+        so a prediction takes O(n) time and memory per table instead of O(n n_i n_j).
+
+        Returns:
+            tuple: coefficients of the mean and of the variance in powers of w_i and w_j (see cell_polynomial; cells
+            numbered cell_i * cells_j + cell_j), and of profile_i and profile_j (2, levels, cells) in powers of w_j
+            and w_i respectively. A variable that is not queried or has one level has one cell and degree 0.
+        '''
+        key = (table.variables, queried)
+        if key not in self.contractions:
+            nodes, degrees = [], []
+            for axis, name in zip(table.axes, table.variables):
+                degrees.append(int(name in queried and len(axis) > 1))
+                if name not in queried:
+                    nodes.append(np.tile(self.proportions[name], (1, len(NODES), 1)))
+                elif len(axis) == 1:
+                    nodes.append(np.ones((1, len(NODES), 1)))
+                else:
+                    cells = np.arange(len(axis) - 1)
+                    weights = np.zeros((len(cells), len(NODES), len(axis)))
+                    weights[cells, :, cells] = 1 - NODES
+                    weights[cells, :, cells + 1] = NODES
+                    nodes.append(weights)
+            (c_i, w_i, n_i), (c_j, w_j, n_j) = nodes[0].shape, nodes[1].shape
+            u = np.repeat(nodes[0].reshape(-1, n_i), c_j * w_j, axis=0)
+            v = np.tile(nodes[1].reshape(-1, n_j), (c_i * w_i, 1))
+            G, profile_i, profile_j = self._table_weights(table, u, v)
+            values = np.stack([np.einsum('nij,ij->n', G, table.fit), np.einsum('nij,ij->n', G ** 2, table.se ** 2)], axis=-1)
+            values = values.reshape(c_i, w_i, c_j, w_j, 2)
+            coefficients = np.einsum('pa,iajbk,qb->kpqij', NODES_INVERSE, values, NODES_INVERSE).reshape(2, 3, 3, -1)
+            d_i, d_j = degrees
+            mean = np.ascontiguousarray(coefficients[0, :d_i + 1, :d_j + 1])
+            var = np.ascontiguousarray(coefficients[1, :2 * d_i + 1, :2 * d_j + 1])
+            # Profiles at the first and last node of each cell of the other variable
+            profile_i = profile_i.reshape(c_i, w_i, c_j, w_j, n_i)[0, 0][:, [0, -1]].transpose(1, 2, 0)
+            profile_j = profile_j.reshape(c_i, w_i, c_j, w_j, n_j)[:, [0, -1], 0, 0].transpose(1, 2, 0)
+            profile_i[1] -= profile_i[0]
+            profile_j[1] -= profile_j[0]
+            self.contractions[key] = mean, var, np.ascontiguousarray(profile_i), np.ascontiguousarray(profile_j)
+        return self.contractions[key]
+
+    def _table_terms(self,table,brackets,n):
+        '''
+        Contribution of this table to the prediction (sum(G * fit), see _table_weights) and to its variance
+        (sum(G^2 * se^2)), and the contribution as a function of the level of each queried variable of the table
+        (levels, n; the others at their query values), from the brackets (axis_brackets k and w) of the queried
+        variables.
+        '''
+        name_i, name_j = table.variables
+        (k_i, w_i), (k_j, w_j) = (brackets.get(name, (np.zeros(n, dtype=int), np.zeros(n))) for name in table.variables)
+        mean, var, profile_i, profile_j = self._table_contractions(table, tuple(name for name in table.variables if name in brackets))
+        cell = k_i * profile_i.shape[-1] + k_j
+        profiles = {}
+        if name_i in brackets:
+            profiles[name_i] = np.take(profile_i[0], k_j, axis=1) + w_j * np.take(profile_i[1], k_j, axis=1)
+        if name_j in brackets:
+            profiles[name_j] = np.take(profile_j[0], k_i, axis=1) + w_i * np.take(profile_j[1], k_i, axis=1)
+        return cell_polynomial(mean, cell, w_i, w_j), cell_polynomial(var, cell, w_i, w_j), profiles
+
+    def predict(self,chunk_size=50000,**queries):
+        '''
+        Vectorized prediction for arrays of query values (keyword per variable; gamma, temp, mass, inc,
+        ratio_disk_to_tot and exposure are accepted as aliases; arrays broadcast against each other).
+
+        Returns:
+            dict of arrays: 'log_frac_uncert', 'se' (from the table se), 'interp_error' (estimated interpolation
+            error), 'sigma' (both combined), 'frac_uncert' with its 1 sigma range 'frac_uncert_low'/'frac_uncert_up',
+            'extrapolated' (some value outside the tables, clamped to their range) and 'source' (0: effect tables,
+            1: simulated results).
+        '''
+        queries = canonical_queries(queries)
+        shape = next(iter(queries.values())).shape if queries else ()
+        flat = {name: value.ravel() for name, value in queries.items()}
+        n = int(np.prod(shape))
+        mean, var, interp, extrapolated = np.zeros(n), np.zeros(n), np.zeros(n), np.zeros(n, dtype=bool)
+
+        for start in range(0, n, chunk_size):
+            chunk = {name: value[start:start + chunk_size] for name, value in flat.items()}
+            m = min(chunk_size, n - start)
+            sl = slice(start, start + m)
+            profiles, brackets = {}, {}
+            for name, value in chunk.items():
+                if name in self.axes:
+                    k, w, outside = axis_brackets(self.axes[name], value, log=name in LOG_VARIABLES)
+                    brackets[name] = k, w
+                    extrapolated[sl] |= outside
+            for table in self.tables:
+                table_mean, table_var, table_profiles = self._table_terms(table, brackets, m)
+                mean[sl] += table_mean
+                var[sl] += table_var
+                for name, profile in table_profiles.items():
+                    profiles[name] = profiles.get(name, 0) + profile
+            # Interpolation error along each queried variable, from the curvature of the prediction over its levels
+            # (zero on grid points); the errors of different variables are added in quadrature
+            interp_sq = np.zeros(m)
+            for name, profile in profiles.items():
+                axis = self.axes[name]
+                if len(axis) > 1:
+                    k, w = brackets[name]
+                    bound = curvature_bound(profile, axis, log=name in LOG_VARIABLES)
+                    interp_sq += (w * (1 - w) * bound[k, np.arange(m)]) ** 2
+            interp[sl] = np.sqrt(interp_sq)
+
+        source = np.zeros(n, dtype=int)
+        if self.results is not None:
+            simulated, simulated_error = self.results.predict(flat)
+            use = np.isfinite(simulated)
+            mean[use], var[use], interp[use], source[use] = simulated[use], 0.0, simulated_error[use], 1
+            extrapolated[use] = False
+
+        se = np.sqrt(var)
+        sigma = np.sqrt(var + interp ** 2)
+        out = {'log_frac_uncert': mean, 'se': se, 'interp_error': interp, 'sigma': sigma, 'frac_uncert': np.exp(mean),
+               'frac_uncert_low': np.exp(mean - sigma), 'frac_uncert_up': np.exp(mean + sigma), 'extrapolated': extrapolated, 'source': source}
+        return {key: value.reshape(shape) for key, value in out.items()}
+
+    def suggest(self,n=10,candidates=None,n_candidates=100000,min_separation=0.1,seed=0,**fixed):
+        '''
+        Active learning helper: the n points where the emulator is most uncertain (largest sigma), to be simulated
+        next (e.g. as a sweep.py grid).
+
+        Arguments:
+        n: number of points
+        candidates: optional dictionary of arrays of candidate points; by default n_candidates points are drawn
+                    uniformly (log-uniformly for nH, e, d) within the range of the tables
+        min_separation: points closer than this to an already chosen one (in units of each variable's range) are
+                        skipped, so the suggestions do not pile up in one spot
+        fixed: variables held at one value (e.g. m=8)
+
+        Output:
+        DataFrame of the suggested points with their prediction and sigma, most uncertain first
+        '''
+        rng = np.random.default_rng(seed)
+        if candidates is None:
+            candidates = {}
+            for name in self.variables:
+                axis = self.axes[name]
+                if name in LOG_VARIABLES:
+                    candidates[name] = np.exp(rng.uniform(np.log(axis[0]), np.log(axis[-1]), n_candidates))
+                else:
+                    candidates[name] = rng.uniform(axis[0], axis[-1], n_candidates)
+        candidates = canonical_queries(dict(candidates, **fixed))
+        prediction = self.predict(**candidates)
+
+        names = [name for name in candidates if np.ptp(candidates[name]) > 0]
+        scaled = np.stack([(np.log(candidates[name]) if name in LOG_VARIABLES else candidates[name]).ravel() for name in names], axis=1) if names else np.zeros((prediction['sigma'].size, 0))
+        if names:
+            scaled = (scaled - scaled.min(axis=0)) / np.ptp(scaled, axis=0)
+        chosen = []
+        for index in np.argsort(-prediction['sigma'].ravel(), kind='stable'):
+            if len(chosen) == n:
+                break
+            if all(np.max(np.abs(scaled[index] - scaled[other])) >= min_separation for other in chosen):
+                chosen.append(index)
+        table = pd.DataFrame({name: candidates[name].ravel()[chosen] for name in candidates})
+        for key in ('log_frac_uncert', 'sigma', 'se', 'interp_error'):
+            table[key] = prediction[key].ravel()[chosen]
+        return table
+
+
+def load_results(pattern,instrument=None):
+    """
+    Reads reduced result tables (table_g.._T.._a.._m.._i.._r.._e...csv, not the _full/_partial ones) into one
+    DataFrame with the configuration parsed from the file names (columns named as in VARIABLES) and the instrument
+    from the results/<instrument>_results directory. instrument keeps only that instrument's tables.
+    """
+    frames = []
+    for filename in sorted(glob.glob(pattern)):
+        match = TABLE_PATTERN.search(os.path.basename(filename))
+        if match is None:
+            continue
+        df = pd.read_csv(filename)
+        for name, value in match.groupdict().items():
+            df[name] = float(value)
+        folder = os.path.basename(os.path.dirname(os.path.abspath(filename)))
+        df['instrument'] = folder[:-len('_results')] if folder.endswith('_results') else None
+        frames.append(df)
+    if not frames:
+        raise ValueError('No reduced result tables match %s' % pattern)
+    df = pd.concat(frames, ignore_index=True)
+    if instrument is not None:
+        df = df[df['instrument'] == instrument]
+    return df
+
+
+class results_surrogate:
+
+    def __init__(self,df,column='frac_uncert'):
+        '''
+        Multilinear interpolation of log(|column|) (default: the fractional bias of the median fitted distance) over
+        the grid of simulated configurations. Variables with a single simulated value are dropped; grid nodes that
+        were not simulated are NaN, so queries in hypercubes with a missing corner return NaN.
+        '''
+        with np.errstate(divide='ignore'):
+            response = np.log(np.abs(df[column].astype(float).to_numpy()))
+        self.axes = {name: np.sort(df[name].astype(float).unique()) for name in VARIABLES if df[name].nunique() > 1}
+        self.fixed = {name: float(df[name].iloc[0]) for name in VARIABLES if df[name].nunique() == 1}
+        self.names = list(self.axes)
+        shape = tuple(len(self.axes[name]) for name in self.names)
+        self.values = np.full(shape, np.nan)
+        index = tuple(np.searchsorted(self.axes[name], df[name].astype(float)) for name in self.names)
+        self.values[index] = np.where(np.isfinite(response), response, np.nan)
+        self.bounds = [np.moveaxis(curvature_bound(np.moveaxis(self.values, k, 0), self.axes[name], name in LOG_VARIABLES), 0, k) for k, name in enumerate(self.names)]
+
+    def predict(self,queries):
+        '''
+        Interpolated log bias and interpolation error for flat query arrays (NaN where a query misses a variable of
+        the grid, is outside it, or falls in a hypercube that was not fully simulated).
+        '''
+        n = len(next(iter(queries.values())))
+        if any(name not in queries for name in self.names):
+            return np.full(n, np.nan), np.full(n, np.nan)
+        lower, weight, inside = [], [], np.ones(n, dtype=bool)
+        for name in self.names:
+            _, ww, outside, k = axis_weights(self.axes[name], queries[name], log=name in LOG_VARIABLES)
+            x = np.log(queries[name]) if name in LOG_VARIABLES else queries[name]
+            grid = np.log(self.axes[name]) if name in LOG_VARIABLES else self.axes[name]
+            lower.append(k)
+            weight.append(np.clip((x - grid[k]) / (grid[k + 1] - grid[k]), 0, 1))
+            inside &= ~outside
+        # Queries for a variable that was simulated at one value only must match it
+        for name, value in self.fixed.items():
+            if name in queries:
+                inside &= np.isclose(queries[name], value)
+
+        def corner_weight(bits, skip=None):
+            return np.prod([np.ones(n)] + [wk if b else 1 - wk for j, (wk, b) in enumerate(zip(weight, bits)) if j != skip], axis=0)
+
+        mean, error = np.zeros(n), np.zeros(n)
+        for corner in range(2 ** len(self.names)):
+            bits = [(corner >> k) & 1 for k in range(len(self.names))]
+            index = tuple(k + b for k, b in zip(lower, bits))
+            w = corner_weight(bits)
+            mean += np.where(w > 0, w * self.values[index], 0.0)
+            mean[(w > 0) & np.isnan(self.values[index])] = np.nan
+            # Interpolation error along each axis, from the interval bounds at the corners of the other axes
+            for k in range(len(self.names)):
+                if bits[k] == 0:
+                    w_other = corner_weight(bits, skip=k)
+                    error += np.where(w_other > 0, w_other * np.nan_to_num(self.bounds[k][index]), 0.0) * weight[k] * (1 - weight[k])
+        mean[~inside] = np.nan
+        return mean, error
@@ -0,0 +1,204 @@
+from statistics import NormalDist
+import numpy as np
+from mode_estimation import histogram_mode, estimate_modes
+
+# Result columns kept per realization for the reduced table (medians and peaks)
+TRACKED_COLUMNS = ("red_chi_squared", "gamma", "power_norm_fit", "temp", "disk_norm_fit", "d_fit", "frac_uncert", "total_flux")
+
+
+def find_peak(array):
+    """
+    Centre of the most populated bin of a histogram with Stone's bin rule (None for an empty array). See
+    mode_estimation.histogram_mode for many cells at once and bootstrap intervals.
+    """
+    if len(array) != 0:
+        peak = histogram_mode(np.asarray(array, dtype=float))['mode'][0]
+    else:
+        peak = None
+    return peak
+
+
+class cell_accumulator:
+
+    def __init__(self,nH,d,capacity=100000,seed=0):
+        '''
+        Online summary of the realizations of one (nH, d) cell. The tracked columns of each result are kept in one
+        preallocated float array (NaN for a failed fit), so medians and the histogram peak of the reduced table are
+        exact. Once more than capacity results have arrived, the array becomes a uniform reservoir sample of all of
+        them (Algorithm R), which bounds the memory of very long runs at the cost of approximate medians and peaks.
+
+        Arguments:
+        nH, d: the cell
+        capacity: maximum number of realizations kept
+        seed: seed of the reservoir sampling
+        '''
+        self.nH = nH
+        self.d = d
+        self.capacity = capacity
+        self.count = 0
+        self.power_norm_fake = None
+        self.disk_norm_fake = None
+        self._values = np.empty((min(capacity, 512), len(TRACKED_COLUMNS)))
+        self._rng = np.random.default_rng(seed)
+
+    def update(self,result):
+        '''
+        Adds one result dictionary (as returned by run_simulation).
+        '''
+        if self.count == 0:
+            self.power_norm_fake = result.get("power_norm_fake")
+            self.disk_norm_fake = result.get("disk_norm_fake")
+        row = [np.nan if result.get(column) is None else result[column] for column in TRACKED_COLUMNS]
+        if self.count < self.capacity:
+            if self.count == len(self._values):
+                self._values = np.resize(self._values, (min(2 * len(self._values), self.capacity), len(TRACKED_COLUMNS)))
+            self._values[self.count] = row
+        else:
+            slot = self._rng.integers(self.count + 1)
+            if slot < self.capacity:
+                self._values[slot] = row
+        self.count += 1
+
+    def values(self,column):
+        '''
+        Kept values of a column, failed fits (NaN) removed.
+        '''
+        values = self._values[:min(self.count, self.capacity), TRACKED_COLUMNS.index(column)]
+        return values[~np.isnan(values)]
+
+    def median(self,column):
+        values = self.values(column)
+        return np.median(values) if len(values) else np.nan
+
+    def median_interval(self,column,ci=0.68):
+        '''
+        Distribution-free confidence interval of the median of a column: the order statistics n/2 -+ z sqrt(n)/2
+        (normal approximation of the binomial count below the median). (nan, nan) with fewer than two values.
+        '''
+        values = np.sort(self.values(column))
+        n = len(values)
+        if n < 2:
+            return np.nan, np.nan
+        half = NormalDist().inv_cdf((1 + ci) / 2) * np.sqrt(n) / 2
+        return values[max(int(np.floor(n / 2 - half)), 0)], values[min(int(np.ceil(n / 2 + half)), n - 1)]
+
+    def row(self,peak=None,peak_flux=None,peak_ci=(None, None),median_ci=(None, None)):
+        '''
+        The row of this cell in the reduced table (same keys and values as observational_effects.py always wrote,
+        followed by the bootstrap interval of the distance peak, the number of realizations and the interval of
+        the median distance). cell_table passes the peaks it computed for all cells at once; otherwise they are
+        computed here without an interval.
+        '''
+        nH_value, d = self.nH, self.d
+        d_fit = self.median("d_fit")
+        if peak is None and peak_flux is None:
+            peak, peak_flux = find_peak(self.values("d_fit")), find_peak(self.values("total_flux"))
+        peak_low, peak_up = peak_ci
+        median_low, median_up = median_ci
+        disk_norm_fake = self.disk_norm_fake if self.count else None
+        return {
+            "nH": nH_value,
+            "red_chi_squared": self.median("red_chi_squared"),
+            "gamma": self.median("gamma"),
+            "power_norm_fake": self.power_norm_fake if self.count else None,
+            "power_norm_fit": self.median("power_norm_fit"),
+            "temp": self.median("temp"),
+            "disk_norm_fake": disk_norm_fake,
+            "disk_norm_fit": self.median("disk_norm_fit"),
+            "error_disk_norm": (self.median("disk_norm_fit") - disk_norm_fake) if self.count else None,
+            "d": d,
+            "d_fit": d_fit,
+            "error_d": (d_fit - d) if self.count else None,
+            "frac_uncert": ((d_fit - d) / d) if self.count else None,
+            "d_fit_peak": peak,
+            "error_d_peak": (peak-d) if peak else None,
+            "frac_uncert_peak": ((peak-d) / d) if peak else None,
+            "med_frac_uncert": self.median("frac_uncert"),
+            "total_flux": self.median("total_flux"),
+            "peak_flux": peak_flux,
+            "d_fit_peak_low": peak_low,
+            "d_fit_peak_up": peak_up,
+            "frac_uncert_peak_low": ((peak_low-d) / d) if peak_low is not None else None,
+            "frac_uncert_peak_up": ((peak_up-d) / d) if peak_up is not None else None,
+            "n_realizations": self.count,
+            "d_fit_low": median_low,
+            "d_fit_up": median_up,
+            "d_fit_ci_width": (median_up - median_low) if median_low is not None else None,
+            "d_fit_peak_ci_width": (peak_up - peak_low) if peak_low is not None else None
+        }
+
+
+class cell_table:
+
+    def __init__(self,nH_list,d_list,capacity=100000,peak_method='histogram',n_boot=200,ci=0.68,seed=0):
+        '''
+        One cell_accumulator per (nH, d) of the grid. Results are added as they arrive (update) or from a full
+        table (update_frame), and the reduced table can be taken at any time (table), e.g. as a live partial table
+        while the run is going.
+
+        Arguments:
+        peak_method: 'histogram' (Stone's rule, the published d_fit_peak) or 'kde' (see mode_estimation)
+        n_boot, ci, seed: bootstrap replicates, confidence level and seed of the interval on d_fit_peak
+                          (n_boot=0 leaves the interval columns empty)
+        '''
+        self.peak_method = peak_method
+        self.n_boot = n_boot
+        self.ci = ci
+        self.seed = seed
+        self.nH_list = list(nH_list)
+        self.d_list = list(d_list)
+        self.cells = {(nH_value, d): cell_accumulator(nH_value, d, capacity=capacity, seed=i)
+                      for i, (nH_value, d) in enumerate((nH_value, d) for nH_value in self.nH_list for d in self.d_list)}
+
+    def update(self,result):
+        '''
+        Adds a result dictionary or a list of them (a batched cell). Results of cells outside the grid are ignored.
+        '''
+        for res in (result if isinstance(result, list) else [result]):
+            cell = self.cells.get((res["nH"], res["d"]))
+            if cell is not None:
+                cell.update(res)
+
+    def update_frame(self,df):
+        '''
+        Adds every row of a full results table (e.g. result_store.to_dataframe()).
+        '''
+        for res in df.to_dict('records'):
+            self.update({key: (None if isinstance(value, float) and np.isnan(value) else value) for key, value in res.items()})
+
+    def count(self):
+        return sum(cell.count for cell in self.cells.values())
+
+    def intervals(self,keys=None):
+        '''
+        Distance peaks with their bootstrap intervals and the intervals of the median distance for the cells keys
+        (default: all, in grid order), estimated together.
+
+        Output:
+        dictionary of arrays 'peak', 'peak_low', 'peak_up', 'median_low', 'median_up' (NaN where undefined)
+        '''
+        cells = [self.cells[key] for key in (keys if keys is not None else self.keys())]
+        d_fit = estimate_modes([cell.values("d_fit") for cell in cells], method=self.peak_method, n_boot=self.n_boot, ci=self.ci, seed=self.seed)
+        median = np.array([cell.median_interval("d_fit", self.ci) for cell in cells]).reshape(-1, 2)
+        return {'peak': d_fit['mode'], 'peak_low': d_fit['low'], 'peak_up': d_fit['up'], 'median_low': median[:, 0], 'median_up': median[:, 1]}
+
+    def keys(self):
+        return [(nH_value, d) for nH_value in self.nH_list for d in self.d_list]
+
+    def table(self):
+        '''
+        The reduced table, one row per (nH, d) in grid order. The peaks of all cells (and the bootstrap interval of
+        the distance peak) are estimated together.
+        '''
+        cells = [self.cells[key] for key in self.keys()]
+        d_fit = self.intervals()
+        flux = estimate_modes([cell.values("total_flux") for cell in cells], method=self.peak_method)
+
+        def value(x):
+            return None if np.isnan(x) else x
+
+        import pandas as pd
+
+        return pd.DataFrame([cell.row(peak=value(d_fit['peak'][i]), peak_flux=value(flux['mode'][i]), peak_ci=(value(d_fit['peak_low'][i]), value(d_fit['peak_up'][i])),
+                                      median_ci=(value(d_fit['median_low'][i]), value(d_fit['median_up'][i])))
+                             for i, cell in enumerate(cells)])
@@ -1,6 +1,12 @@
 import os
 import sys
-import glob
+import json
+
+# Catalogs are kept in memory unless a catalog file is given, or named by the environment variable CATALOG_VARIABLE
+# (see products_catalog); CATALOG_FILE is the name for one kept in the root of the catalogued tree
+CATALOG_FILE = '.products_catalog.json'
+CATALOG_VARIABLE = 'PRODUCTS_CATALOG'
+CATALOG_VERSION = 1
 
 
 def readDatesFile(fileName):
@@ -8,44 +14,247 @@ def readDatesFile(fileName):
         dates = date_f.read().splitlines()
     return dates
 
-def findProductsFolders(instrument,dates):
+def productsFolderNames(instrument,dates):
+    '''
+    Names of the soft state and transition products folders (products_<date> or products_<start>_to_<end>) for the
+    dates of a dates file; the transition folder is None when the file has no transition dates.
+    '''
+    def name(start,end=None):
+        return 'products_'+start if end is None or end == start else 'products_'+start+'_to_'+end
     if instrument == 'maxi':
         if len(dates) == 4:
-            if dates[0] != dates[1]:
-                softProductsFolder = glob.glob('products_'+dates[0]+'_to_'+dates[1])[0]
-            else:
-                softProductsFolder = glob.glob('products_'+dates[0])[0]
-            if dates[2] != dates[3]:
-                transProductsFolder = glob.glob('products_'+dates[2]+'_to_'+dates[3])[0]
-            else:
-                transProductsFolder = glob.glob('products_'+dates[2])[0]
-        else:
-            if dates[0] != dates[1]:
-                softProductsFolder = glob.glob('products_'+dates[0]+'_to_'+dates[1])[0]
-            else:
-                softProductsFolder = glob.glob('products_'+dates[0])[0]
-            transProductsFolder = None
+            return name(dates[0],dates[1]), name(dates[2],dates[3])
+        return name(dates[0],dates[1]), None
     elif instrument == 'xrt' or instrument == 'rxte_pca':
         if len(dates) == 2:
-            softProductsFolder = glob.glob('products_'+dates[0])[0]
-            transProductsFolder = glob.glob('products_'+dates[1])[0]
+            return name(dates[0]), name(dates[1])
         elif len(dates) == 1:
-            softProductsFolder = glob.glob('products_'+dates[0])[0]
-            transProductsFolder = None
-    else:
-        raise ValueError('Cannot find products folder!')
+            return name(dates[0]), None
+    raise ValueError('Cannot find products folder!')
 
-    return (softProductsFolder,transProductsFolder)
+def productsDateRange(folderName):
+    '''
+    (start, end) dates of a products folder name; end equals start for a single-date folder.
+    '''
+    dates = folderName[len('products_'):].split('_to_')
+    return dates[0], dates[-1]
 
-def findSavedModel():
-    rootDir = os.getcwd()
-    for dirName, subdirList, fileList in os.walk(rootDir):
-        for fname in fileList:
-            if 'PLonlyFlux' in fname and '.xcm' in fname and '2023' not in fname and 'fake' in fname:
-                return fname
-    return None
 
+class products_catalog:
+
+    def __init__(self,root='.',path=None):
+        '''
+        Catalog of the products_* folders and saved .xcm models under root (e.g. an archive with one directory per
+        source and instrument). Every directory is listed once and kept with its mtime; refresh() only lists
+        directories again whose mtime changed (a file or folder was added, removed or renamed in them), so keeping
+        the catalog up to date costs one stat per directory instead of a full walk. Products folders are looked up
+        by (instrument, dates) with set lookups.
+
+        The catalog is saved to a JSON file and read back by later processes only when a catalog file is given
+        (path or $PRODUCTS_CATALOG, e.g. root/.products_catalog.json), and then brought up to date with the whole
+        tree when it is opened. Otherwise it is kept in memory, nothing is written, and directories are only listed
+        when a lookup needs them.
+
+        Arguments:
+        root: top of the catalogued tree
+        path: catalog file (default: $PRODUCTS_CATALOG if set, else none)
+        '''
+        self.root = os.path.abspath(root)
+        path = path if path else os.environ.get(CATALOG_VARIABLE)
+        self.path = os.path.abspath(path) if path else None
+        self.dirs = {}
+        if self.path is not None and os.path.isfile(self.path):
+            try:
+                with open(self.path) as fh:
+                    stored = json.load(fh)
+                if stored.get('version') == CATALOG_VERSION and stored.get('root') == self.root:
+                    self.dirs = stored['dirs']
+            except (OSError, ValueError):
+                pass
+        self._index()
+        if self.path is not None:
+            self.refresh()
+
+    def _index(self):
+        self.products = {directory: set(entry['products']) for directory, entry in self.dirs.items()}
+
+    def refresh(self,directory=None,recursive=True):
+        '''
+        Brings the catalog up to date with directory (relative to the current working directory; default: root) and,
+        if recursive, its subdirectories, and saves it if anything changed.
+
+        Output:
+        number of directories that were listed again
+        '''
+        top = '.' if directory is None else self._relative(directory)
+        inside = lambda name: top == '.' or name == top or name.startswith(top + os.sep)
+        dirs = {name: entry for name, entry in self.dirs.items() if not (inside(name) if recursive else name == top)}
+        listed = 0
+        changed = False
+        own = self._relative(os.path.dirname(self.path)) if self.path is not None else None
+        stack = [top]
+        while stack:
+            directory = stack.pop()
+            full = os.path.join(self.root, directory)
+            try:
+                mtime = os.stat(full).st_mtime_ns
+            except OSError:
+                continue
+            entry = self.dirs.get(directory)
+            if entry is None or entry['mtime'] != mtime:
+                listed += 1
+                entry = {'mtime': mtime, 'subdirs': [], 'products': [], 'models': []}
+                try:
+                    with os.scandir(full) as it:
+                        for item in it:
+                            try:
+                                if item.is_dir():
+                                    if item.name.startswith('products_'):
+                                        entry['products'].append(item.name)
+                                    if not item.is_symlink():
+                                        entry['subdirs'].append(item.name)
+                                elif '.xcm' in item.name:
+                                    entry['models'].append(item.name)
+                            except OSError:
+                                continue
+                except OSError:
+                    continue
+                for key in ('subdirs', 'products', 'models'):
+                    entry[key].sort()
+                # Saving the catalog changes the mtime of its own directory (see save), which alone needs no new save
+                old = self.dirs.get(directory)
+                changed = changed or directory != own or old is None or any(old[key] != entry[key] for key in ('subdirs', 'products', 'models'))
+            dirs[directory] = entry
+            if recursive:
+                stack.extend(os.path.normpath(os.path.join(directory, sub)) for sub in entry['subdirs'])
+        changed = changed or set(dirs) != set(self.dirs)
+        self.dirs = dirs
+        if changed:
+            self._index()
+            self.save()
+        return listed
+
+    def save(self):
+        '''
+        Writes the catalog to a temporary file and renames it to the catalog file with os.replace, so a process killed
+        while saving (or another one reading) sees either the previous catalog or the new one. Does nothing for a
+        catalog kept in memory.
+        '''
+        if self.path is None:
+            return
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp, 'w') as fh:
+            json.dump({'version': CATALOG_VERSION, 'root': self.root, 'dirs': self.dirs}, fh)
+        os.replace(tmp, self.path)
+        # The rename changes the mtime of the directory of the catalog file. The new mtime is only known after the
+        # file is written, so the next process lists that directory once more and, finding nothing new, does not save.
+        directory = self._relative(os.path.dirname(self.path))
+        if directory in self.dirs:
+            self.dirs[directory]['mtime'] = os.stat(os.path.dirname(self.path)).st_mtime_ns
+
+    def _relative(self,directory):
+        return os.path.normpath(os.path.relpath(os.path.abspath(directory), self.root))
 
+    def missing(self,instrument,dates,directory='.'):
+        '''
+        Names of the products folders of a dates file that are not in the catalog for directory, or that are in it
+        but no longer exist (removed since the last refresh).
+        '''
+        relative = self._relative(directory)
+        products = self.products.get(relative, ())
+        return [name for name in productsFolderNames(instrument,dates) if name is not None and
+                (name not in products or not os.path.isdir(os.path.join(self.root, relative, name)))]
 
+    def find(self,instrument,dates,directory='.',refresh=True):
+        '''
+        Products folders of a dates file (see findProductsFolders) in directory (relative to the current working
+        directory). With refresh, the catalog is refreshed once if a folder is not in it or no longer exists.
 
+        Output:
+        (soft state folder, transition folder or None), as paths relative to the current working directory
+        '''
+        names = productsFolderNames(instrument,dates)
+        missing = self.missing(instrument,dates,directory)
+        if missing and refresh:
+            self.refresh(directory, recursive=False)
+            missing = self.missing(instrument,dates,directory)
+        if missing:
+            raise IndexError('No %s in %s' % (', '.join(missing), directory))
+        return tuple(None if name is None else (name if directory == '.' else os.path.join(directory, name)) for name in names)
 
+    def date_ranges(self,directory='.'):
+        '''
+        (start, end, folder name) of every products folder in directory, sorted by start date.
+        '''
+        return sorted(productsDateRange(name) + (name,) for name in self.products.get(self._relative(directory), ()))
+
+    def models(self,directory='.'):
+        '''
+        Paths (relative to directory) of the .xcm files in directory and its subdirectories, sorted.
+        '''
+        relative = self._relative(directory)
+        prefix = '' if relative == '.' else relative + os.sep
+        paths = []
+        for name, entry in self.dirs.items():
+            if relative == '.' or name == relative or name.startswith(prefix):
+                sub = os.path.relpath(name, relative)
+                paths.extend(fname if sub == '.' else os.path.join(sub, fname) for fname in entry['models'])
+        return sorted(paths)
+
+
+# Catalogs of the trees looked up in this process, by root and catalog file
+_catalogs = {}
+
+def getCatalog(root='.',path=None):
+    '''
+    Catalog of root shared by the lookups of this process, kept in memory unless path or $PRODUCTS_CATALOG names a
+    catalog file (see products_catalog).
+    '''
+    key = (os.path.abspath(root), path if path else os.environ.get(CATALOG_VARIABLE))
+    if key not in _catalogs:
+        _catalogs[key] = products_catalog(root, path)
+    return _catalogs[key]
+
+def findProductsFolders(instrument,dates):
+    '''
+    Products folders of a dates file in the current working directory (see products_catalog.find). The catalog is
+    kept in memory and only lists the current working directory; set $PRODUCTS_CATALOG to a file to keep a
+    catalog of the whole tree between processes.
+    '''
+    return getCatalog('.').find(instrument,dates)
+
+def resolveDatesFiles(instrument,dateFiles,root='.'):
+    '''
+    Bulk version of readDatesFile + findProductsFolders: resolves the products folders of many dates files, each
+    looked up in the directory of its dates file, listing each directory with missing folders once at most.
+
+    Output:
+    dictionary {dates file: (soft state folder, transition folder or None)}; None for a dates file whose folders
+    are missing
+    '''
+    catalog = getCatalog(root)
+    requests = [(fileName, readDatesFile(fileName), os.path.dirname(fileName) or '.') for fileName in dateFiles]
+    for directory in dict.fromkeys(directory for _, dates, directory in requests if catalog.missing(instrument,dates,directory)):
+        catalog.refresh(directory, recursive=False)
+    resolved = {}
+    for fileName, dates, directory in requests:
+        try:
+            resolved[fileName] = catalog.find(instrument,dates,directory,refresh=False)
+        except IndexError:
+            resolved[fileName] = None
+    return resolved
+
+def findSavedModel():
+    '''
+    Name of a saved fake PLonlyFlux .xcm model (not from 2023) under the current working directory, or None. The
+    first match in path order is returned.
+    '''
+    catalog = getCatalog('.')
+    for attempt in range(2):
+        for path in catalog.models():
+            fname = os.path.basename(path)
+            if 'PLonlyFlux' in fname and '.xcm' in fname and '2023' not in fname and 'fake' in fname and os.path.isfile(path):
+                return fname
+        if attempt == 0:
+            catalog.refresh()
+    return None
@@ -0,0 +1,74 @@
+import time
+import numpy as np
+from profiling import stage_timer
+
+
+class fake_simulation:
+
+    def __init__(self,model_def,instrument,simulation_params_dic,fit_params_dic,latency=0.0,latency_sigma=0.0,hang_rate=0.0,error_rate=0.0,hang_seconds=3600.0):
+        '''
+        Stand-in for xspec_simulations.simulation that needs neither HEASoft nor the response files: run() waits
+        for a configurable time and returns fit results scattered around the simulated parameters, drawn from the
+        seed alone, so the same seed always gives the same result. Used by benchmarks.py to time the scheduler and
+        post-processing without the cost (and the variance) of real fits.
+
+        Arguments:
+        model_def, instrument, simulation_params_dic, fit_params_dic: as for xspec_simulations.simulation
+        latency: median seconds a run takes
+        latency_sigma: log-normal scatter of the run time (0 for a constant latency)
+        hang_rate: fraction of runs that sleep for hang_seconds (to exercise the task timeout)
+        error_rate: fraction of runs that raise a RuntimeError
+        '''
+        if instrument not in ('maxi', 'xrt'):
+            raise ValueError('Only maxi or xrt allowed.')
+        self.model = model_def
+        self.sim_params_dic = simulation_params_dic
+        self.fit_params_dic = fit_params_dic
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.hang_rate = hang_rate
+        self.error_rate = error_rate
+        self.hang_seconds = hang_seconds
+
+    def reset(self,simulation_params_dic,fit_params_dic):
+        self.sim_params_dic = simulation_params_dic
+        self.fit_params_dic = fit_params_dic
+        return self
+
+    def preload(self):
+        pass
+
+    def run(self,id='',spec_dir='',seed=None,exposure=None,backExposure=None,**kwargs):
+
+        '''
+        Perform a fake simulation run
+
+        Arguments:
+        id, spec_dir: unused, kept so the call is interchangeable with xspec_simulations.simulation.run
+        seed: seed of the draws (latency, failures and fitted values)
+        exposure, backExposure: exposure of the spectrum; the scatter of the fitted values shrinks as 1/sqrt(exposure)
+
+        Output:
+        The same (fit result dictionary, total flux) tuple as numpy_simulations.numpy_simulation.run
+        '''
+        timer = stage_timer()
+        rng = np.random.default_rng(seed)
+        draw = rng.random()
+        if draw < self.hang_rate:
+            time.sleep(self.hang_seconds)
+        elif draw < self.hang_rate + self.error_rate:
+            raise RuntimeError('fake fit failure')
+        if self.latency > 0:
+            time.sleep(self.latency * np.exp(self.latency_sigma * rng.standard_normal()))
+
+        scatter = 0.1 * np.sqrt(1000.0 / (exposure if exposure else 1000.0))
+        nH, gamma, pl_norm, temp, disk_norm = (float(self.sim_params_dic[i]) for i in range(1, 6))
+        disk_norm_fit = disk_norm * np.exp(scatter * rng.standard_normal())
+        fit = {'gamma': gamma + scatter * rng.standard_normal(), 'power_norm': pl_norm * np.exp(scatter * rng.standard_normal()),
+               'temp': temp * np.exp(0.5 * scatter * rng.standard_normal()), 'disk_norm': disk_norm_fit,
+               'disk_norm_error': (disk_norm_fit * np.exp(-1.645 * scatter), disk_norm_fit * np.exp(1.645 * scatter)),
+               'disk_norm_sigma_log': scatter,
+               'statistic': float(rng.chisquare(100)), 'dof': 100}
+        tot_flux = 1e-9 * (pl_norm + disk_norm * 1e-3) * np.exp(-nH / 10) * np.exp(scatter * rng.standard_normal())
+        timer.lap('fit')
+        return fit, tot_flux
@@ -0,0 +1,74 @@
+import functools
+import numpy as np
+from numpy_simulations import ezdiskbb_photon_spectrum, KEV_TO_ERG
+
+# Energy band (keV) in which the disc-to-total flux ratio is defined for each instrument
+INSTRUMENT_BANDS = {
+    'maxi': (2.0, 20.0),
+    'xrt': (0.7, 10.0),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def band_grid(e_low,e_high,n_points=2001):
+    """
+    Cached logarithmic energy grid (keV) and Simpson weights in ln(E) for integrating over [e_low, e_high].
+    n_points must be odd.
+    """
+    log_e = np.linspace(np.log(e_low), np.log(e_high), n_points)
+    weights = np.ones(n_points)
+    weights[1:-1:2] = 4
+    weights[2:-1:2] = 2
+    weights *= (log_e[1] - log_e[0]) / 3
+    return np.exp(log_e), weights
+
+
+def powerlaw_flux(gamma,e_low,e_high):
+    """
+    Analytic energy flux (erg/cm^2/s) of a powerlaw of unit norm in [e_low, e_high] keV.
+    gamma may be an array.
+    """
+    gamma = np.asarray(gamma, dtype=float)
+    two_minus = np.where(np.isclose(gamma, 2.0), 1.0, 2 - gamma)
+    flux = np.where(np.isclose(gamma, 2.0), np.log(e_high / e_low), (e_high**two_minus - e_low**two_minus) / two_minus)
+    return flux * KEV_TO_ERG
+
+
+def ezdiskbb_flux(temp,e_low,e_high):
+    """
+    Energy flux (erg/cm^2/s) of an ezdiskbb of unit norm in [e_low, e_high] keV, integrated with Simpson's rule
+    on the cached band grid. temp may be an array.
+    """
+    energies, weights = band_grid(e_low, e_high)
+    temp = np.asarray(temp, dtype=float)
+    spectrum = ezdiskbb_photon_spectrum(energies, temp[..., None], 1.0)
+    # E * N(E) dE = E^2 * N(E) d(ln E)
+    return np.sum(spectrum * energies**2 * weights, axis=-1) * KEV_TO_ERG
+
+
+@functools.lru_cache(maxsize=4096)
+def component_fluxes(gamma,temp,e_low,e_high):
+    """
+    Memoized unit-norm (powerlaw, ezdiskbb) energy fluxes for one (gamma, temp) pair in [e_low, e_high] keV.
+    """
+    return float(powerlaw_flux(gamma, e_low, e_high)), float(ezdiskbb_flux(temp, e_low, e_high))
+
+
+def powerlaw_norms(gamma,temp,ezdiskbb_norms,ratio_pl_to_disk,band=(2.0,20.0)):
+    """
+    Powerlaw norms that give a powerlaw-to-disc energy flux ratio of ratio_pl_to_disk in the band, for a whole
+    array of disc norms at once. Both fluxes are linear in their norms, so only the unit-norm fluxes are computed
+    (once per (gamma, temp, band)).
+
+    Args:
+        gamma (float): Powerlaw photon index.
+        temp (float): ezdiskbb T_max in keV.
+        ezdiskbb_norms (float or array-like): Disc norms.
+        ratio_pl_to_disk (float): Ratio of the powerlaw to the disc flux in the band.
+        band (tuple, optional): (e_low, e_high) in keV. Defaults to (2.0, 20.0); see INSTRUMENT_BANDS.
+
+    Returns:
+        float or ndarray: Powerlaw norms, with the shape of ezdiskbb_norms.
+    """
+    pl_flux, disk_flux = component_fluxes(float(gamma), float(temp), float(band[0]), float(band[1]))
+    return np.asarray(ezdiskbb_norms) * ratio_pl_to_disk * disk_flux / pl_flux
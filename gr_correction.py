@@ -0,0 +1,189 @@
+import os
+import numpy as np
+
+G = 6.6743e-11  # SI units
+c = 2.998e8  # SI units
+kappa = 1.7
+m_sun = 1.989e30  # SI units
+
+
+def _tolerance_ladder(atol=1e-08, n_steps=40):
+    """
+    The sequence of absolute tolerances tried by idx_of_value_from_grid, built with the same repeated
+    multiplication so that the matches are bit-for-bit identical.
+    """
+    ladder = [atol]
+    for _ in range(n_steps):
+        ladder.append(ladder[-1] * 10)
+    return np.array(ladder)
+
+
+class grid_index:
+
+    def __init__(self,grid,rtol=1e-05,atol=1e-08):
+        '''
+        Sorted index over a 1D grid that reproduces idx_of_value_from_grid (np.isclose match with a tolerance
+        raised tenfold until something matches, then the median of the tied indices) for arrays of values at once.
+
+        Arguments:
+        grid: monotonic 1D array (e.g. a_grid or i_grid from gGR_gNT_J1655.h5)
+        '''
+        self.grid = np.asarray(grid, dtype=float)
+        self.rtol = rtol
+        self.ladder = _tolerance_ladder(atol)
+        steps = np.diff(self.grid)
+        if not (np.all(steps > 0) or np.all(steps < 0)):
+            raise ValueError('grid_index needs a strictly monotonic grid.')
+        self.order = np.argsort(self.grid, kind='stable')
+        self.sorted = self.grid[self.order]
+
+    def _close(self,sorted_idx,values,thresholds):
+        inside = (sorted_idx >= 0) & (sorted_idx < len(self.sorted))
+        grid_values = self.sorted[np.clip(sorted_idx, 0, len(self.sorted) - 1)]
+        return inside & (np.abs(grid_values - values) <= thresholds)
+
+    def nearest(self,values):
+        '''
+        Returns the grid index selected for each value, with the same tie rule as idx_of_value_from_grid, and a
+        boolean array flagging values for which more than one grid point matched.
+        '''
+        values = np.asarray(values, dtype=float)
+        n = len(self.sorted)
+        pos = np.searchsorted(self.sorted, values)
+        left = np.clip(pos - 1, 0, n - 1)
+        right = np.clip(pos, 0, n - 1)
+        distance = np.minimum(np.abs(self.sorted[left] - values), np.abs(self.sorted[right] - values))
+        # Smallest tolerance on the ladder at which np.isclose finds at least one match
+        step = np.sum(distance[..., None] > self.ladder + self.rtol * np.abs(values)[..., None], axis=-1)
+        thresholds = self.ladder[np.clip(step, 0, len(self.ladder) - 1)] + self.rtol * np.abs(values)
+
+        lo = np.searchsorted(self.sorted, values - thresholds, side='left')
+        hi = np.searchsorted(self.sorted, values + thresholds, side='right') - 1
+        # Floating point rounding in values -/+ thresholds can move the edges by one point
+        lo = np.where(self._close(lo - 1, values, thresholds), lo - 1, lo)
+        lo = np.where(~self._close(lo, values, thresholds) & (lo < hi), lo + 1, lo)
+        hi = np.where(self._close(hi + 1, values, thresholds), hi + 1, hi)
+        hi = np.where(~self._close(hi, values, thresholds) & (hi > lo), hi - 1, hi)
+
+        first = np.minimum(self.order[lo], self.order[hi])
+        last = np.maximum(self.order[lo], self.order[hi])
+        return first + (last - first) // 2, hi > lo
+
+    def fractional(self,values):
+        '''
+        Returns the bracketing grid indices and linear interpolation weights for each value (clamped to the grid).
+        '''
+        values = np.clip(np.asarray(values, dtype=float), self.sorted[0], self.sorted[-1])
+        pos = np.clip(np.searchsorted(self.sorted, values, side='right') - 1, 0, len(self.sorted) - 2)
+        weight = (values - self.sorted[pos]) / (self.sorted[pos + 1] - self.sorted[pos])
+        return self.order[pos], self.order[pos + 1], weight
+
+
+class correction_table(dict):
+
+    def __init__(self,data,mode='nearest',verbose=True):
+        '''
+        GR correction lookup built once from the arrays of gGR_gNT_J1655.h5 (the dictionary returned by
+        correction_file). It is still a dictionary of those arrays, so code indexing it directly keeps working.
+
+        Arguments:
+        data: dictionary with 'a_grid', 'r_grid', 'i_grid', 'gGR_grid' and 'gNT_grid'
+        mode: 'nearest' picks grid values like get_total_correction_GR_and_Rin_Rg_ratio always did (median of
+              ties); 'linear' interpolates the correction factors and Rin/Rg between grid points
+        verbose: print a warning the first time a value ties between several grid points
+        '''
+        super().__init__(data)
+        if mode not in ('nearest', 'linear'):
+            raise ValueError("mode must be 'nearest' or 'linear'.")
+        self.mode = mode
+        self.verbose = verbose
+        self.a_index = grid_index(data['a_grid'])
+        self.i_index = grid_index(data['i_grid'])
+        self._memo = {}
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self), self.mode, self.verbose))
+
+    def _compute(self,inc,a,limb_dark):
+        a_grid, r_grid, i_grid = self['a_grid'], self['r_grid'], self['i_grid']
+        gGR_grid, gNT_grid = self['gGR_grid'], self['gNT_grid']
+
+        if self.mode == 'nearest':
+            a_idx, a_tied = self.a_index.nearest(a)
+            i_idx, i_tied = self.i_index.nearest(inc)
+            if self.verbose and (a_tied.any() or i_tied.any()):
+                print("Warning: found more than one grid value (for GR correction) that are equally close to %d of the requested spin/inclination values. Taking the median values as the ones to be closest." % np.count_nonzero(a_tied | i_tied))
+            GR_correction = gGR_grid[a_idx, i_idx] * gNT_grid[a_idx]
+            Rin_ratio = r_grid[a_idx]
+            selected_a = a_grid[a_idx]
+            selected_i = i_grid[i_idx]
+        else:
+            a_lo, a_hi, wa = self.a_index.fractional(a)
+            i_lo, i_hi, wi = self.i_index.fractional(inc)
+            gGR = ((1 - wa) * (1 - wi) * gGR_grid[a_lo, i_lo] + wa * (1 - wi) * gGR_grid[a_hi, i_lo]
+                   + (1 - wa) * wi * gGR_grid[a_lo, i_hi] + wa * wi * gGR_grid[a_hi, i_hi])
+            GR_correction = gGR * ((1 - wa) * gNT_grid[a_lo] + wa * gNT_grid[a_hi])
+            Rin_ratio = (1 - wa) * r_grid[a_lo] + wa * r_grid[a_hi]
+            selected_a = np.asarray(a, dtype=float)
+            selected_i = np.asarray(inc, dtype=float)
+
+        cos_i = np.cos(selected_i * (np.pi / 180))
+        limb_darkening = (1/2 + (3/4) * cos_i) if limb_dark else 1
+        return GR_correction * cos_i * limb_darkening, Rin_ratio, selected_a, selected_i
+
+    def correction(self,inc,a,limb_dark=True):
+        '''
+        Vectorized equivalent of get_total_correction_GR_and_Rin_Rg_ratio. Repeated (inc, a) pairs are computed
+        once: scalar queries are memoized on the table and arrays are reduced to their unique pairs.
+
+        Returns:
+            tuple: total correction (GR x cos i x limb darkening), Rin/Rg, selected spin and selected inclination,
+            each broadcast to the shape of inc and a.
+        '''
+        if np.ndim(inc) == 0 and np.ndim(a) == 0:
+            key = (float(inc), float(a), bool(limb_dark))
+            if key not in self._memo:
+                self._memo[key] = tuple(np.asarray(x)[0] for x in self._compute(np.array([key[0]]), np.array([key[1]]), limb_dark))
+            return self._memo[key]
+
+        inc, a = np.broadcast_arrays(np.asarray(inc, dtype=float), np.asarray(a, dtype=float))
+        pairs, inverse = np.unique(np.stack((inc.ravel(), a.ravel()), axis=1), axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        unique_results = self._compute(pairs[:, 0], pairs[:, 1], limb_dark)
+        return tuple(np.asarray(x)[inverse].reshape(inc.shape) for x in unique_results)
+
+    def to_norm(self,d,mass,a,inc,limb_dark=True):
+        '''
+        ezdiskbb norm for distances d (kpc) and masses (solar masses); all arguments broadcast against each other.
+        '''
+        corr, Rin_ratio, _, _ = self.correction(inc, a, limb_dark=limb_dark)
+        return (((Rin_ratio * G * m_sun * 1e-2) / ((kappa ** 2) * (c ** 2)))**2) * corr * (np.asarray(mass) / np.asarray(d))**2
+
+    def to_d(self,norm,mass,a,inc,limb_dark=True):
+        '''
+        Distance (kpc) for ezdiskbb norms and masses (solar masses); all arguments broadcast against each other.
+        '''
+        corr, Rin_ratio, _, _ = self.correction(inc, a, limb_dark=limb_dark)
+        return ((Rin_ratio * G * m_sun * 1e-2) / ((kappa ** 2) * (c ** 2))) * np.sqrt(1 / np.asarray(norm, dtype=float)) * np.sqrt(corr) * np.asarray(mass)
+
+
+CACHE_KEYS = ('a_grid', 'r_grid', 'i_grid', 'gGR_grid', 'gNT_grid')
+
+
+def write_npy_cache(data,cache_dir):
+    """
+    Writes the correction arrays to one .npy file per array in cache_dir, so that worker processes can
+    memory-map them (see load_npy_cache) instead of unpickling a copy per task.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    for key in CACHE_KEYS:
+        np.save(os.path.join(cache_dir, key + '.npy'), np.asarray(data[key]))
+
+
+def load_npy_cache(cache_dir,mode='nearest',verbose=True):
+    """
+    Builds a correction_table on read-only memory maps of the arrays written by write_npy_cache. The pages are
+    shared by every process on the node that maps the same files.
+    """
+    data = {key: np.load(os.path.join(cache_dir, key + '.npy'), mmap_mode='r') for key in CACHE_KEYS}
+    return correction_table(data,mode=mode,verbose=verbose)
@@ -0,0 +1,203 @@
+import numpy as np
+
+# ftgrouppha grouptypes implemented here (the opt* types need the response and are not)
+GROUP_TYPES = ('constant', 'min', 'bmin', 'snmin')
+
+
+def group_counts(src_counts, bkg_counts=None, grouptype='snmin', groupscale=3.0, bkg_ratio=1.0, quality=None, window=8):
+    """
+    In-memory equivalent of ftgrouppha for one spectrum or an (n, n_channels) batch. Consecutive channels are
+    grouped until the group meets the criterion of grouptype:
+
+    'constant': groupscale channels
+    'min': at least groupscale source counts
+    'bmin': at least groupscale background counts
+    'snmin': background-subtracted signal-to-noise (S - r*B) / sqrt(S + r^2*B) of at least groupscale, with
+             r = bkg_ratio the background scaling (see background_ratio)
+
+    Channels with non-zero input quality are left ungrouped, keep their quality and end the group before them. A
+    group that ends (at a bad channel or the last channel) without meeting the criterion is flagged bad
+    (quality 2); for 'constant' the last, shorter group is kept.
+
+    The groups are found one at a time for all rows together: the counts of a group are differences of cumulative
+    sums, so the end of the group opened at a channel is the first channel of the next window channels (or of
+    the following windows) whose running total meets the criterion, found with one array operation. Runs of
+    channels that meet the criterion on their own (one-channel groups) are skipped in one step.
+
+    Returns:
+        grouping (1 at the start of a group, -1 otherwise) and quality arrays, in OGIP convention.
+    """
+    if grouptype not in GROUP_TYPES:
+        raise ValueError("grouptype must be one of %s" % ", ".join(GROUP_TYPES))
+    single = np.ndim(src_counts) == 1
+    src_counts = np.atleast_2d(np.asarray(src_counts, dtype=float))
+    if bkg_counts is None:
+        if grouptype in ('bmin', 'snmin'):
+            raise ValueError("grouptype '%s' needs background counts" % grouptype)
+        bkg_counts = np.zeros(src_counts.shape[1])
+    bkg_counts = np.broadcast_to(np.atleast_2d(np.asarray(bkg_counts, dtype=float)), src_counts.shape)
+    n, n_chan = src_counts.shape
+    if quality is None:
+        new_quality = np.zeros((n, n_chan), dtype=int)
+    else:
+        new_quality = np.array(np.broadcast_to(np.atleast_2d(quality), (n, n_chan)), dtype=int)
+    good = new_quality == 0
+
+    # Cumulative counts over good channels (column j holds the sum of channels < j), and for every channel the
+    # next bad and the next good channel at or after it (n_chan if none)
+    zeros = np.zeros((n, 1))
+    src_sum = np.concatenate((zeros, np.cumsum(np.where(good, src_counts, 0), axis=1)), axis=1)
+    bkg_sum = np.concatenate((zeros, np.cumsum(np.where(good, bkg_counts, 0), axis=1)), axis=1)
+    channels = np.arange(n_chan)
+    last = np.full((n, 1), n_chan)
+    next_bad = np.concatenate((np.minimum.accumulate(np.where(good, n_chan, channels)[:, ::-1], axis=1)[:, ::-1], last), axis=1)
+    next_good = np.concatenate((np.minimum.accumulate(np.where(good, channels, n_chan)[:, ::-1], axis=1)[:, ::-1], last), axis=1)
+
+    def meets(row, first, end):
+        # Criterion for the groups of channels first..end (inclusive) of the rows row
+        if grouptype == 'constant':
+            return end - first + 1 >= groupscale
+        if grouptype == 'bmin':
+            return bkg_sum[row, end + 1] - bkg_sum[row, first] >= groupscale
+        s = src_sum[row, end + 1] - src_sum[row, first]
+        if grouptype == 'min':
+            return s >= groupscale
+        b = bkg_sum[row, end + 1] - bkg_sum[row, first]
+        noise = np.sqrt(s + bkg_ratio**2 * b)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (noise > 0) & ((s - bkg_ratio*b) / noise >= groupscale)
+
+    # First channel at or after each channel that is not a good one-channel group
+    rows = np.arange(n)
+    one_channel = good & meets(rows[:, None], channels[None, :], channels[None, :])
+    next_multi = np.concatenate((np.minimum.accumulate(np.where(one_channel, n_chan, channels)[:, ::-1], axis=1)[:, ::-1], last), axis=1)
+
+    start = next_good[:, 0].copy()
+    position = start.copy()
+    offsets = np.arange(window)
+    groups = []
+    while True:
+        active = start < n_chan
+        if not active.any():
+            break
+        skip = active & (position == start) & one_channel[rows, np.minimum(start, n_chan - 1)]
+        if skip.any():
+            start[skip] = next_good[skip, next_multi[skip, start[skip]]]
+            position[skip] = start[skip]
+            active = start < n_chan
+            if not active.any():
+                break
+        row, first, scan = rows[active], start[active], position[active]
+        limit = next_bad[row, first]
+        end = scan[:, None] + offsets
+        inside = end < limit[:, None]
+        closed = meets(row[:, None], first[:, None], np.minimum(end, n_chan - 1)) & inside
+        found = closed.any(axis=1)
+        done = found | (scan + window >= limit)
+        group_end = np.where(found, scan + np.argmax(closed, axis=1), limit - 1)
+        groups.append((row[done], first[done], group_end[done], found[done]))
+        start[row[done]] = next_good[row[done], group_end[done] + 1]
+        position[row[done]] = start[row[done]]
+        position[row[~done]] += window
+
+    # Channels after the first of a group are -1; groups that never met the criterion are flagged bad
+    row, first, group_end, complete = (np.concatenate(column) for column in zip(*groups)) if groups else (np.empty(0, dtype=int),) * 3 + (np.empty(0, dtype=bool),)
+    inner = np.zeros((n, n_chan + 1), dtype=int)
+    np.add.at(inner, (row, first + 1), 1)
+    np.add.at(inner, (row, group_end + 1), -1)
+    grouping = np.where(np.cumsum(inner, axis=1)[:, :n_chan] > 0, -1, 1)
+    if grouptype != 'constant':
+        bad = ~complete
+        incomplete = np.zeros((n, n_chan + 1), dtype=int)
+        np.add.at(incomplete, (row[bad], first[bad]), 1)
+        np.add.at(incomplete, (row[bad], group_end[bad] + 1), -1)
+        new_quality[(np.cumsum(incomplete, axis=1)[:, :n_chan] > 0) & good] = 2
+    if single:
+        return grouping[0], new_quality[0]
+    return grouping, new_quality
+
+
+def group_snmin(src_counts, bkg_counts, bkg_ratio, minsn=3.0, quality=None):
+    """
+    ftgrouppha grouptype='snmin' with groupscale=minsn (see group_counts).
+    """
+    return group_counts(src_counts, bkg_counts, grouptype='snmin', groupscale=minsn, bkg_ratio=bkg_ratio, quality=quality)
+
+
+def read_pha(filename):
+    """
+    Counts, quality and the scaling keywords (exposure, backscal, areascal) of an OGIP PHA file. Unlike
+    numpy_simulations.read_spectrum nothing is cached, since faked spectra are read once.
+    """
+    from astropy.io import fits
+    with fits.open(filename) as hdul:
+        hdu = hdul['SPECTRUM']
+        header = hdu.header
+        data = hdu.data
+        exposure = float(header['EXPOSURE'])
+        if 'COUNTS' in data.columns.names:
+            counts = np.asarray(data['COUNTS'], dtype=float)
+        else:
+            counts = np.asarray(data['RATE'], dtype=float) * exposure
+        if 'QUALITY' in data.columns.names:
+            quality = np.asarray(data['QUALITY'], dtype=int)
+        else:
+            quality = np.full(len(counts), int(header.get('QUALITY', 0)))
+        return {'counts': counts, 'quality': quality, 'exposure': exposure,
+                'backscal': float(header.get('BACKSCAL', 1.0)), 'areascal': float(header.get('AREASCAL', 1.0))}
+
+
+def background_ratio(source, background):
+    """
+    Scaling of background counts to the source spectrum, (t A b)_src / (t A b)_bkg from the exposure, AREASCAL and
+    BACKSCAL of two read_pha dictionaries, as XSPEC applies it.
+    """
+    return (source['exposure'] * source['areascal'] * source['backscal']) / (background['exposure'] * background['areascal'] * background['backscal'])
+
+
+def group_file(infile, backfile=None, grouptype='snmin', groupscale=3.0, outfile=None):
+    """
+    Groups a PHA file like ftgrouppha, without starting a HEASoft tool: the GROUPING and QUALITY columns are
+    written into infile itself (or into a copy, outfile), which XSPEC then reads as usual.
+
+    Returns:
+        grouping and quality arrays.
+    """
+    source = read_pha(infile)
+    background = read_pha(backfile) if backfile else None
+    grouping, quality = group_counts(source['counts'], background['counts'] if background else None, grouptype=grouptype,
+                                     groupscale=groupscale, bkg_ratio=background_ratio(source, background) if background else 1.0,
+                                     quality=source['quality'])
+    from astropy.io import fits
+    with fits.open(infile, mode='readonly' if outfile else 'update') as hdul:
+        index = hdul.index_of('SPECTRUM')
+        hdu = hdul[index]
+        columns = [column for column in hdu.columns if column.name not in ('GROUPING', 'QUALITY')]
+        columns += [fits.Column(name='GROUPING', format='I', array=grouping), fits.Column(name='QUALITY', format='I', array=quality)]
+        header = hdu.header.copy()
+        for keyword in ('GROUPING', 'QUALITY'):
+            if keyword in header:
+                del header[keyword]
+        hdul[index] = fits.BinTableHDU.from_columns(columns, header=header, name='SPECTRUM')
+        if outfile:
+            hdul.writeto(outfile, overwrite=True)
+    return grouping, quality
+
+
+def compare_with_ftgrouppha(infile, backfile=None, grouptype='snmin', groupscale=3.0, tmp_dir='.'):
+    """
+    Runs ftgrouppha and group_file on the same spectrum and returns the number of channels whose grouping or
+    quality differ. Needs heasoftpy and a HEASoft installation.
+    """
+    import os
+    import heasoftpy as hsp
+    from astropy.io import fits
+    reference = os.path.join(tmp_dir, 'ftgrouppha_reference.pha')
+    with hsp.utils.local_pfiles_context():
+        hsp.ftgrouppha(infile=infile, backfile=backfile if backfile else 'none', outfile=reference, grouptype=grouptype, groupscale=str(groupscale), clobber='yes')
+    with fits.open(reference) as hdul:
+        data = hdul['SPECTRUM'].data
+        expected_grouping = np.asarray(data['GROUPING'], dtype=int)
+        expected_quality = np.asarray(data['QUALITY'], dtype=int) if 'QUALITY' in data.columns.names else np.zeros(len(data), dtype=int)
+    grouping, quality = group_file(infile, backfile, grouptype=grouptype, groupscale=groupscale, outfile=os.path.join(tmp_dir, 'group_file_result.pha'))
+    return {'grouping': int(np.count_nonzero(grouping != expected_grouping)), 'quality': int(np.count_nonzero(quality != expected_quality))}
@@ -0,0 +1,49 @@
+import numpy as np
+
+
+def axis_brackets(axis,values,log=False):
+    """
+    Index k of the grid interval of values on a sorted 1D grid (clamped to its range) and their linear interpolation
+    weight w in it (value = (1 - w) grid[k] + w grid[k + 1]), plus a flag for values outside the grid. k and w are 0
+    on a one point grid.
+    """
+    axis = np.asarray(axis, dtype=float)
+    x = np.log(values) if log else np.asarray(values, dtype=float)
+    grid = np.log(axis) if log else axis
+    outside = (x < grid[0]) | (x > grid[-1])
+    x = np.clip(x, grid[0], grid[-1])
+    if len(grid) == 1:
+        return np.zeros(x.shape, dtype=int), np.zeros(x.shape), outside
+    k = np.clip(np.searchsorted(grid, x, side='right') - 1, 0, len(grid) - 2)
+    return k, (x - grid[k]) / (grid[k + 1] - grid[k]), outside
+
+
+def axis_weights(axis,values,log=False):
+    """
+    Linear interpolation weights of values on a sorted 1D grid (clamped to its range), as a dense (n_values, n_axis)
+    matrix, plus the interpolation error factor w(1 - w) of each value and a flag for values outside the grid.
+    """
+    k, w, outside = axis_brackets(axis, values, log=log)
+    if len(axis) == 1:
+        return np.ones(k.shape + (1,)), np.zeros(k.shape), outside, k
+    weights = np.zeros(k.shape + (len(axis),))
+    np.put_along_axis(weights, k[..., None], (1 - w)[..., None], axis=-1)
+    np.put_along_axis(weights, (k + 1)[..., None], w[..., None], axis=-1)
+    return weights, w * (1 - w), outside, k
+
+
+def curvature_bound(values,axis,log=False):
+    """
+    Bound on the linear interpolation error along the first axis of values, per interval, divided by w(1 - w):
+    |f''| h^2 / 2 from second divided differences (the largest of the two estimates touching the interval) when the
+    axis has three or more points, and |f(x_k+1) - f(x_k)| otherwise (curvature of the order of the variation).
+    """
+    grid = np.log(np.asarray(axis, dtype=float)) if log else np.asarray(axis, dtype=float)
+    values = np.asarray(values, dtype=float)
+    h = np.diff(grid).reshape((-1,) + (1,) * (values.ndim - 1))
+    if len(grid) < 3:
+        return np.abs(np.diff(values, axis=0))
+    slopes = np.diff(values, axis=0) / h
+    second = np.abs(2 * np.diff(slopes, axis=0) / (h[1:] + h[:-1]))
+    second = np.concatenate([second[:1], np.maximum(second[:-1], second[1:]), second[-1:]], axis=0) if len(second) > 1 else np.concatenate([second, second], axis=0)
+    return 0.5 * second * h ** 2
@@ -0,0 +1,811 @@
+import functools
+import os
+from collections import OrderedDict
+import numpy as np
+from grouping import group_snmin
+from profiling import stage_timer
+from uncertainty import covariance_interval
+try:
+    from scipy import sparse
+except ImportError:  # Responses are folded with a dense product
+    sparse = None
+
+KEV_TO_ERG = 1.602176634e-9
+
+# The model of this backend, the same as that of the XSPEC backend. wabs*(po+ezdiskbb) is also implemented, for
+# checks against XSPEC's wabs (Morrison & McCammon 1983), which absorbs about 1.4 times more at the same nH.
+MODEL = "tbabs*(po+ezdiskbb)"
+
+# XSPEC abundance and cross-section tables of tbabs (Wilms et al. 2000 abundances, Verner et al. 1996
+# cross-sections), set by observational_effects.setup_xspec for the XSPEC backend
+TBABS_ABUND = 'wilm'
+TBABS_XSECT = 'vern'
+
+# tbabs cross-section per H atom (TBABS_ABUND, TBABS_XSECT) on 10000 log-spaced energies from 0.1 to 20 keV: the
+# ENERGY (keV) and SIGMA (1e-22 cm^2) columns of the TBABS extension. The shipped file is the XSPEC table
+# distributed with astromodels (BSD-3-Clause); make_tbabs_table writes it again with PyXspec.
+TBABS_TABLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sim_files', 'xsect_tbabs_wilm.fits')
+
+# Morrison & McCammon (1983) photoabsorption coefficients. Each row is
+# (E_low [keV], c0, c1, c2) with sigma(E) = (c0 + c1*E + c2*E**2) * E**-3 * 1e-24 cm^2 per H atom.
+MM83_COEFFICIENTS = np.array([
+    [0.030, 17.3, 608.1, -2150.0],
+    [0.100, 34.6, 267.9, -476.1],
+    [0.284, 78.1, 18.8, 4.3],
+    [0.400, 71.4, 66.8, -51.4],
+    [0.532, 95.5, 145.8, -61.1],
+    [0.707, 308.9, -380.6, 294.0],
+    [0.867, 120.6, 169.3, -47.7],
+    [1.303, 141.3, 146.8, -31.5],
+    [1.840, 202.7, 104.7, -17.0],
+    [2.471, 342.7, 18.7, 0.0],
+    [3.210, 352.2, 18.7, 0.0],
+    [4.038, 433.9, -2.4, 0.75],
+    [7.111, 629.0, 30.9, 0.0],
+    [8.331, 701.2, 25.2, 0.0],
+])
+
+# Photon flux of a face-on disc of unit ezdiskbb norm ((R_in/km)/(D/10 kpc))^2 cos(i),
+# i.e. 4*pi/(h^3 c^2) * (1 km / 10 kpc)^2 in photons cm^-2 s^-1 keV^-3.
+EZDISKBB_CONST = 2.0761e-3
+# T_max / T_* for the zero-torque temperature profile T(r) = T_* (r/R_in)^(-3/4) (1 - sqrt(R_in/r))^(1/4)
+EZDISKBB_TMAX_RATIO = (36/49)**0.75 * (1/7)**0.25
+
+# XSPEC default (value, hard min, soft min, soft max, hard max) for the tbabs*(po+ezdiskbb) parameters (the nH
+# limits of wabs are the same)
+DEFAULT_PARAMS = {
+    1: [1.0, 0.0, 0.0, 1e5, 1e6],      # tbabs nH
+    2: [1.0, -3.0, -2.0, 9.0, 10.0],    # powerlaw PhoIndex
+    3: [1.0, 0.0, 0.0, 1e24, 1e24],     # powerlaw norm
+    4: [1.0, 0.01, 0.01, 100.0, 100.0], # ezdiskbb T_max
+    5: [1.0, 0.0, 0.0, 1e24, 1e24],     # ezdiskbb norm
+}
+
+# Responses with at most this fraction of non-zero elements are folded as sparse matrices (when scipy is available)
+SPARSE_MAX_DENSITY = 0.25
+
+# Entries per LRU cache of model components (one energy-grid or channel-grid spectrum each)
+COMPONENT_CACHE_SIZE = 2048
+
+# Arrays of a response kept in its .npy cache (indptr last, so its presence marks a complete cache)
+RESPONSE_KEYS = ('energ_lo', 'energ_hi', 'e_min', 'e_max', 'data', 'indices', 'indptr')
+
+_file_cache = {}
+
+
+def read_spectrum(filename):
+    """
+    Reads an OGIP PHA file (type I) and returns its counts and the keywords needed for faking/fitting.
+    Files are cached per process, so repeated calls with the same file name do not touch the disk.
+    """
+    if filename in _file_cache:
+        return _file_cache[filename]
+    from astropy.io import fits
+    with fits.open(filename) as hdul:
+        hdu = hdul['SPECTRUM']
+        header = hdu.header
+        data = hdu.data
+        if 'COUNTS' in data.columns.names:
+            counts = np.asarray(data['COUNTS'], dtype=float)
+        else:
+            counts = np.asarray(data['RATE'], dtype=float) * header['EXPOSURE']
+        quality = np.asarray(data['QUALITY'], dtype=int) if 'QUALITY' in data.columns.names else np.zeros(len(counts), dtype=int)
+        spectrum = {
+            'channel': np.asarray(data['CHANNEL'], dtype=int),
+            'counts': counts,
+            'quality': quality,
+            'exposure': float(header['EXPOSURE']),
+            'backscal': float(header.get('BACKSCAL', 1.0)),
+            'areascal': float(header.get('AREASCAL', 1.0)),
+        }
+    _file_cache[filename] = spectrum
+    return spectrum
+
+
+class response_matrix:
+
+    def __init__(self,data,indices,indptr,n_channels):
+        '''
+        Channel response (n_energies x n_channels) in CSR form: row i (model energy bin) has the values
+        data[indptr[i]:indptr[i+1]] in the channels indices[indptr[i]:indptr[i+1]]. The arrays may be read-only
+        memory maps shared by all processes (see response_npy_cache).
+        '''
+        self.data = data
+        self.indices = indices
+        self.indptr = indptr
+        self.shape = (len(indptr) - 1, n_channels)
+        self.density = len(data) / max(self.shape[0] * self.shape[1], 1)
+        self._sparse = None
+        self._dense = None
+
+    def toarray(self):
+        '''
+        Dense copy of the matrix (built once).
+        '''
+        if self._dense is None:
+            dense = np.zeros(self.shape)
+            dense[np.repeat(np.arange(self.shape[0]), np.diff(self.indptr)), self.indices] = self.data
+            self._dense = dense
+        return self._dense
+
+    def fold(self,photons):
+        '''
+        Folds photon spectra (n_energies, or n x n_energies for a batch) through the response: one sparse
+        matrix-matrix product, or a dense one for matrices that are not sparse enough to gain from it.
+        '''
+        if sparse is not None and self.density <= SPARSE_MAX_DENSITY:
+            if self._sparse is None:
+                self._sparse = sparse.csr_matrix((self.data, self.indices, self.indptr), shape=self.shape, copy=False)
+            return np.asarray(photons @ self._sparse)
+        return photons @ self.toarray()
+
+
+def read_ogip_response(filename, arf_filename=None):
+    """
+    Reads an OGIP RMF/RSP file (optionally multiplied by an ARF) into the arrays of RESPONSE_KEYS: the model energy
+    grid, the channel bounds (keV) and the matrix in CSR form, built directly from the response groups.
+    """
+    from astropy.io import fits
+    with fits.open(filename) as hdul:
+        matrix_hdu = hdul['MATRIX'] if 'MATRIX' in hdul else hdul['SPECRESP MATRIX']
+        ebounds = hdul['EBOUNDS'].data
+        rows = matrix_hdu.data
+        col_index = matrix_hdu.columns.names.index('F_CHAN') + 1
+        first_channel = int(matrix_hdu.header.get('TLMIN%d' % col_index, 1))
+        data, indices, indptr = [], [], [0]
+        for row in rows:
+            f_chan = np.atleast_1d(row['F_CHAN']) - first_channel
+            n_chans = np.atleast_1d(row['N_CHAN'])
+            values = np.atleast_1d(row['MATRIX'])
+            start, n_row = 0, 0
+            for g in range(int(row['N_GRP'])):
+                group = values[start:start+n_chans[g]]
+                keep = group != 0
+                data.append(group[keep])
+                indices.append(np.arange(f_chan[g], f_chan[g]+n_chans[g])[keep])
+                start += n_chans[g]
+                n_row += np.count_nonzero(keep)
+            indptr.append(indptr[-1] + n_row)
+        response = {
+            'energ_lo': np.asarray(rows['ENERG_LO'], dtype=float),
+            'energ_hi': np.asarray(rows['ENERG_HI'], dtype=float),
+            'e_min': np.asarray(ebounds['E_MIN'], dtype=float),
+            'e_max': np.asarray(ebounds['E_MAX'], dtype=float),
+            'data': np.concatenate(data + [np.zeros(0)]).astype(float),
+            'indices': np.concatenate(indices + [np.zeros(0, dtype=int)]).astype(np.int32),
+            'indptr': np.asarray(indptr, dtype=np.int64),
+        }
+    if arf_filename is not None:
+        with fits.open(arf_filename) as hdul:
+            specresp = np.asarray(hdul['SPECRESP'].data['SPECRESP'], dtype=float)
+        response['data'] = response['data'] * np.repeat(specresp, np.diff(response['indptr']))
+    return response
+
+
+def response_npy_cache(filename, arf_filename=None):
+    """
+    Directory of .npy files with the arrays of a response (written next to it once, or again when the RMF/RSP or
+    ARF is newer), which worker processes memory-map instead of each parsing and holding their own copy. Each
+    file is written under a temporary name and renamed, so workers that build the cache at the same time do not
+    read partial files. Returns None if the directory cannot be written.
+    """
+    cache_dir = os.path.splitext(filename)[0] + ('_' + os.path.splitext(os.path.basename(arf_filename))[0] if arf_filename else '') + '_npy'
+    marker = os.path.join(cache_dir, RESPONSE_KEYS[-1] + '.npy')
+    sources = [filename] + ([arf_filename] if arf_filename else [])
+    if os.path.isfile(marker) and os.path.getmtime(marker) >= max(os.path.getmtime(source) for source in sources):
+        return cache_dir
+    response = read_ogip_response(filename, arf_filename)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        for key in RESPONSE_KEYS:
+            tmp_name = os.path.join(cache_dir, '%s.%d.tmp.npy' % (key, os.getpid()))
+            np.save(tmp_name, response[key])
+            os.replace(tmp_name, os.path.join(cache_dir, key + '.npy'))
+    except OSError:
+        return None
+    return cache_dir
+
+
+def read_response(filename, arf_filename=None):
+    """
+    Reads an OGIP RMF/RSP file, optionally multiplied by an ARF, from its memory-mapped .npy cache (see
+    response_npy_cache). Responses are cached per process.
+
+    Returns:
+        dict with 'energ_lo', 'energ_hi' (model energy grid, keV), 'e_min', 'e_max' (channel bounds, keV),
+        'matrix' (response_matrix) and 'components' (model_components on this response, per absorption of
+        ABSORPTION).
+    """
+    key = (filename, arf_filename)
+    if key in _file_cache:
+        return _file_cache[key]
+    cache_dir = response_npy_cache(filename, arf_filename)
+    if cache_dir is not None:
+        arrays = {name: np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r') for name in RESPONSE_KEYS}
+    else:
+        arrays = read_ogip_response(filename, arf_filename)
+    response = {name: arrays[name] for name in ('energ_lo', 'energ_hi', 'e_min', 'e_max')}
+    response['matrix'] = response_matrix(arrays['data'], arrays['indices'], arrays['indptr'], len(arrays['e_min']))
+    response['components'] = {absorption: model_components(response,absorption=absorption) for absorption in ABSORPTION}
+    _file_cache[key] = response
+    return response
+
+
+def wabs_cross_section(energies):
+    """
+    Photoabsorption cross-section per hydrogen atom (in units of 1e22 cm^2) at the given energies (keV): the
+    Morrison & McCammon (1983) piecewise fit of XSPEC's wabs, extended with its last segment above 10 keV.
+    """
+    energies = np.asarray(energies, dtype=float)
+    idx = np.clip(np.searchsorted(MM83_COEFFICIENTS[:, 0], energies, side='right') - 1, 0, len(MM83_COEFFICIENTS) - 1)
+    c0, c1, c2 = MM83_COEFFICIENTS[idx, 1], MM83_COEFFICIENTS[idx, 2], MM83_COEFFICIENTS[idx, 3]
+    return (c0 + c1*energies + c2*energies**2) * energies**-3 * 1e-2
+
+
+def wabs(energ_lo, energ_hi, nH):
+    """
+    wabs absorption transmission evaluated at the centre of each energy bin for column density nH (1e22 cm^-2).
+    nH may be a scalar or an (n, 1) column to evaluate n models at once.
+    """
+    return np.exp(-np.asarray(nH) * wabs_cross_section((energ_lo + energ_hi) / 2))
+
+
+@functools.lru_cache(maxsize=None)
+def read_tbabs_table(filename=TBABS_TABLE):
+    """
+    Log energies and log cross-sections of a tbabs table (see TBABS_TABLE), and the log-log slopes of its first and
+    last factor of 2 in energy, which extend it beyond its ends.
+    """
+    from astropy.io import fits
+    with fits.open(filename) as hdul:
+        table = hdul['TBABS'].data
+        log_e, log_sigma = np.log(table['ENERGY'].astype(float)), np.log(table['SIGMA'].astype(float))
+    low, high = log_e <= log_e[0] + np.log(2), log_e >= log_e[-1] - np.log(2)
+    return log_e, log_sigma, np.polyfit(log_e[low], log_sigma[low], 1)[0], np.polyfit(log_e[high], log_sigma[high], 1)[0]
+
+
+def tbabs_cross_section(energies, filename=TBABS_TABLE):
+    """
+    Photoabsorption cross-section per hydrogen atom (in units of 1e22 cm^2) of XSPEC's tbabs at the given energies
+    (keV), interpolated in log-log from a cross-section table and extended as a power law beyond it.
+    """
+    log_e, log_sigma, low_slope, high_slope = read_tbabs_table(filename)
+    x = np.log(np.asarray(energies, dtype=float))
+    y = np.interp(x, log_e, log_sigma)
+    y = np.where(x < log_e[0], log_sigma[0] + low_slope * (x - log_e[0]), y)
+    y = np.where(x > log_e[-1], log_sigma[-1] + high_slope * (x - log_e[-1]), y)
+    return np.exp(y)
+
+
+def tbabs(energ_lo, energ_hi, nH):
+    """
+    tbabs absorption transmission evaluated at the centre of each energy bin for column density nH (1e22 cm^-2).
+    nH may be a scalar or an (n, 1) column to evaluate n models at once.
+    """
+    return np.exp(-np.asarray(nH) * tbabs_cross_section((energ_lo + energ_hi) / 2))
+
+
+# Absorption components of the numpy backend, by XSPEC name
+ABSORPTION = {'tbabs': tbabs, 'wabs': wabs}
+
+
+def make_tbabs_table(filename=TBABS_TABLE, e_low=0.1, e_high=20.0, n_energies=10000):
+    """
+    Writes a tbabs table (see TBABS_TABLE) from XSPEC's tbabs with TBABS_ABUND and TBABS_XSECT: the cross-section
+    is -ln(transmission) of nH = 1e22 cm^-2 at the centre of each of n_energies bins with log-spaced edges. Needs
+    PyXspec.
+    """
+    from astropy.io import fits
+    from xspec import AllModels, Model, Xset
+    Xset.abund = TBABS_ABUND
+    Xset.xsect = TBABS_XSECT
+    edges = np.geomspace(e_low, e_high, n_energies + 1)
+    # Narrow bins, so the transmission at the centre is the mean over the bin to float precision
+    AllModels.setEnergies('%g %g %d log' % (e_low, e_high, n_energies))
+    model = Model('tbabs*po', setPars={1: 1.0, 2: 0.0, 3: 1.0})
+    sigma = -np.log(np.array(model.values(0)) / np.diff(edges))
+    AllModels.clear()
+    AllModels.setEnergies('reset')
+    hdu = fits.BinTableHDU.from_columns([fits.Column(name='ENERGY', format='E', unit='keV', array=np.sqrt(edges[:-1] * edges[1:])),
+                                         fits.Column(name='SIGMA', format='E', unit='1e-22 cm^2', array=sigma)], name='TBABS')
+    hdu.header['TABLE'] = (TBABS_ABUND, 'Abundance table used for sigma(E)')
+    hdu.header['XSECT'] = (TBABS_XSECT, 'Photoionization cross-sections used for sigma(E)')
+    hdu.writeto(filename, overwrite=True)
+
+
+def powerlaw(energ_lo, energ_hi, gamma, norm):
+    """
+    Powerlaw photon flux (photons/cm^2/s) integrated analytically over each energy bin.
+    gamma and norm may be scalars or (n, 1) columns.
+    """
+    gamma = np.asarray(gamma, dtype=float)
+    one_minus = np.where(np.isclose(gamma, 1.0), 1.0, 1 - gamma)
+    integral = (energ_hi**one_minus - energ_lo**one_minus) / one_minus
+    return norm * np.where(np.isclose(gamma, 1.0), np.log(energ_hi / energ_lo), integral)
+
+
+@functools.lru_cache(maxsize=None)
+def ezdiskbb_radial_table(n_u=2000, n_radii=2000, r_out=1e3):
+    """
+    Tabulates the dimensionless radial integral I(u) = int x dx / (exp(u / tau(x)) - 1) of the ezdiskbb spectrum,
+    where u = E / T_* and tau(x) = x^(-3/4) (1 - x^(-1/2))^(1/4) for x = r / R_in from 1 to r_out.
+    The spectrum for any T_max then follows from a single interpolation, so models with different temperatures
+    can be evaluated together.
+    """
+    u = np.geomspace(1e-6, 1e3, n_u)
+    x = np.geomspace(1, r_out, n_radii)
+    tau = x**-0.75 * (1 - x**-0.5)**0.25
+    with np.errstate(over='ignore', divide='ignore'):
+        integrand = x / np.expm1(u[:, None] / tau[None, :])
+    integrand[:, 0] = 0
+    radial_integral = np.sum((integrand[:, 1:] + integrand[:, :-1]) / 2 * np.diff(x), axis=1)
+    return np.log(u), np.log(np.clip(radial_integral, 1e-300, None))
+
+
+def ezdiskbb_photon_spectrum(energies, T_max, norm):
+    """
+    Photon flux density (photons/cm^2/s/keV) of a multi-temperature disc with zero torque at the inner boundary
+    (Zimmerman et al. 2005). T_max and norm may be scalars or (n, 1) columns.
+    """
+    log_u, log_integral = ezdiskbb_radial_table()
+    u = energies / (np.asarray(T_max) / EZDISKBB_TMAX_RATIO)
+    radial_integral = np.exp(np.interp(np.log(u), log_u, log_integral, right=-np.inf))
+    return EZDISKBB_CONST * norm * energies**2 * radial_integral
+
+
+def ezdiskbb(energ_lo, energ_hi, T_max, norm):
+    """
+    ezdiskbb photon flux (photons/cm^2/s) integrated over each energy bin with Simpson's rule.
+    """
+    mid = (energ_lo + energ_hi) / 2
+    lo = ezdiskbb_photon_spectrum(energ_lo, T_max, norm)
+    mid = ezdiskbb_photon_spectrum(mid, T_max, norm)
+    hi = ezdiskbb_photon_spectrum(energ_hi, T_max, norm)
+    return (lo + 4*mid + hi) / 6 * (energ_hi - energ_lo)
+
+
+def model_photons(energ_lo, energ_hi, nH, gamma, pl_norm, T_max, disk_norm, absorption='tbabs'):
+    """
+    Evaluates tbabs*(po+ezdiskbb) (or the absorption of ABSORPTION named by absorption) on an energy grid,
+    returning photons/cm^2/s per bin. Passing (n, 1) parameter columns returns an (n, n_energies) matrix.
+    """
+    return ABSORPTION[absorption](energ_lo, energ_hi, nH) * (powerlaw(energ_lo, energ_hi, gamma, pl_norm) + ezdiskbb(energ_lo, energ_hi, T_max, disk_norm))
+
+
+def energy_flux(energ_lo, energ_hi, photons, e_low, e_high):
+    """
+    Energy flux (erg/cm^2/s) of a binned photon spectrum (or the rows of a matrix of spectra) in the band
+    [e_low, e_high] keV. Bins straddling the band edges contribute the fraction of their width that lies inside the band.
+    """
+    overlap = np.clip(np.minimum(energ_hi, e_high) - np.maximum(energ_lo, e_low), 0, None) / (energ_hi - energ_lo)
+    return np.sum(photons * overlap * (energ_lo + energ_hi) / 2, axis=-1) * KEV_TO_ERG
+
+
+class component_cache:
+
+    def __init__(self,maxsize=COMPONENT_CACHE_SIZE):
+        '''
+        Least recently used cache of spectra (one 1D array per hashable key), filled a batch at a time.
+        '''
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self,keys,compute):
+        '''
+        Rows for a list of keys as a 2D array. The distinct keys that are not cached are computed together by
+        compute(list of keys) -> 2D array and added, evicting the least recently used entries beyond maxsize.
+        '''
+        position = {}
+        for key in keys:
+            position.setdefault(key, len(position))
+        unique = list(position)
+        rows = [self.entries.get(key) for key in unique]
+        missing = [i for i, row in enumerate(rows) if row is None]
+        for i, row in enumerate(rows):
+            if row is not None:
+                self.entries.move_to_end(unique[i])
+        if missing:
+            computed = compute([unique[i] for i in missing])
+            for i, row in zip(missing, computed):
+                rows[i] = self.entries[unique[i]] = row.copy()
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        self.hits += len(unique) - len(missing)
+        self.misses += len(missing)
+        return np.stack(rows)[[position[key] for key in keys]]
+
+
+class model_components:
+
+    def __init__(self,response,maxsize=COMPONENT_CACHE_SIZE,absorption='tbabs'):
+        '''
+        tbabs*(po+ezdiskbb) on the energy grid of a response, from memoized components: the absorption per
+        nH, the unit-norm powerlaw per gamma and the unit-norm ezdiskbb per T_max, and the folded absorbed
+        powerlaw and disc per (nH, gamma) and (nH, T_max). Both norms scale the folded components, so models that
+        differ only in their norms (e.g. the norm columns of a fit Jacobian) are never evaluated or folded again.
+
+        Arguments:
+        response: dictionary from read_response
+        maxsize: entries of each LRU cache (energy-grid spectra and folded spectra)
+        absorption: name of the absorption component in ABSORPTION
+        '''
+        self.absorption = absorption
+        self.energ_lo = np.asarray(response['energ_lo'])
+        self.energ_hi = np.asarray(response['energ_hi'])
+        self.matrix = response['matrix']
+        self.spectra = component_cache(maxsize)
+        self.folded_spectra = component_cache(maxsize)
+
+    def _component(self,name,values):
+        function = {'absorption': lambda x: ABSORPTION[self.absorption](self.energ_lo, self.energ_hi, x),
+                    'powerlaw': lambda x: powerlaw(self.energ_lo, self.energ_hi, x, 1.0),
+                    'ezdiskbb': lambda x: ezdiskbb(self.energ_lo, self.energ_hi, x, 1.0)}[name]
+        return self.spectra.lookup([(name, value) for value in np.asarray(values, dtype=float).tolist()],
+                                   lambda keys: function(np.array([key[1] for key in keys])[:, None]))
+
+    def photons(self,values):
+        '''
+        Photons/cm^2/s per energy bin for an (n x 5) array of parameter vectors (nH, gamma, pl_norm, T_max,
+        disk_norm).
+        '''
+        values = np.atleast_2d(values)
+        return self._component('absorption', values[:, 0]) * (values[:, 2:3] * self._component('powerlaw', values[:, 1]) + values[:, 4:5] * self._component('ezdiskbb', values[:, 3]))
+
+    def folded(self,values):
+        '''
+        Folded count rate per channel for an (n x 5) array of parameter vectors. The components missing from the
+        cache are folded together in one matrix product.
+        '''
+        values = np.atleast_2d(values)
+        nH, gamma, T_max = (values[:, k].tolist() for k in (0, 1, 3))
+        keys = [('powerlaw',) + key for key in zip(nH, gamma)] + [('ezdiskbb',) + key for key in zip(nH, T_max)]
+
+        def fold(missing):
+            names, nH_values, shapes = zip(*missing)
+            absorbed = self._component('absorption', nH_values)
+            shape = np.empty_like(absorbed)
+            for name in ('powerlaw', 'ezdiskbb'):
+                rows = [i for i, key_name in enumerate(names) if key_name == name]
+                if rows:
+                    shape[rows] = self._component(name, [shapes[i] for i in rows])
+            return self.matrix.fold(absorbed * shape)
+
+        components = self.folded_spectra.lookup(keys, fold)
+        n = len(values)
+        return values[:, 2:3] * components[:n] + values[:, 4:5] * components[n:]
+
+
+def group_rows(values, group_id, n_groups):
+    """
+    Sums the channels of each row of values (n x n_channels) into that row's groups. group_id holds the group
+    index of every channel, or -1 for channels that are not used.
+    """
+    n = len(values)
+    flat = np.where(group_id >= 0, group_id + n_groups * np.arange(n)[:, None], n * n_groups)
+    return np.bincount(flat.ravel(), np.broadcast_to(values, flat.shape).ravel(), minlength=n*n_groups + 1)[:-1].reshape(n, n_groups)
+
+
+def parse_xspec_params(params_dic, defaults=DEFAULT_PARAMS):
+    """
+    Converts a PyXspec style parameter dictionary (e.g. {1:'0.5,0', 2:'2.3,,1.7,1.7,3.0,3.0'}) into
+    per-parameter [value, hard min, hard max, frozen] lists, falling back on the XSPEC defaults.
+    """
+    parsed = {}
+    for idx, (value, hard_min, _, _, hard_max) in defaults.items():
+        frozen = False
+        if idx in params_dic:
+            fields = str(params_dic[idx]).split(',')
+            fields += [''] * (6 - len(fields))
+            value = float(fields[0]) if fields[0].strip() else value
+            frozen = fields[1].strip() != '' and float(fields[1]) <= 0
+            hard_min = float(fields[2]) if fields[2].strip() else hard_min
+            hard_max = float(fields[5]) if fields[5].strip() else hard_max
+        parsed[idx] = [value, hard_min, hard_max, frozen]
+    return parsed
+
+
+def fit_spectra(components, group_id, rate, variance, params, max_iter=100, delta_stat=1e-3):
+    """
+    Vectorized Levenberg-Marquardt chi-square fit of tbabs*(po+ezdiskbb) to a batch of binned, background
+    subtracted spectra. Every row keeps its own damping factor and stops independently once its chi-square
+    improves by less than delta_stat (or cannot be improved); only rows still running are re-evaluated.
+
+    Args:
+        components: model_components of the response (cached components, folded in one product per evaluation).
+        group_id: (n x n_channels) group index of every channel for each spectrum, -1 for unused channels.
+        rate, variance: (n x n_groups) net count rate and its variance per group. Groups with zero variance
+            are not noticed.
+        params: output of parse_xspec_params, shared by all rows. Normalisations are fitted in log space, the
+            other free parameters are kept within their hard limits.
+
+    Returns:
+        dict with the best fit 'values' (n x 5, ordered like params), 'statistic', 'dof' and 'covariance'
+        (n x n_free x n_free, in the fitted space, i.e. log norms; NaN for parameters pegged at a limit).
+    """
+    n, n_groups = rate.shape
+    values = np.array([params[i][0] for i in range(1, 6)], dtype=float)
+    lower = np.array([params[i][1] for i in range(1, 6)], dtype=float)
+    upper = np.array([params[i][2] for i in range(1, 6)], dtype=float)
+    free = np.array([not params[i][3] for i in range(1, 6)])
+    log_scale = np.array([False, False, True, False, True])
+    noticed = variance > 0
+    sigma = np.where(noticed, np.sqrt(np.where(noticed, variance, 1)), np.inf)
+    n_free = np.count_nonzero(free)
+
+    def to_values(p):
+        v = np.tile(values, (len(p), 1))
+        v[:, free] = p
+        v[:, log_scale] = np.exp(v[:, log_scale])
+        return np.clip(v, lower, upper)
+
+    def folded_groups(v, rows):
+        return group_rows(components.folded(v), group_id[rows], n_groups)
+
+    def residuals(p, rows):
+        return (folded_groups(to_values(p), rows) - rate[rows]) / sigma[rows]
+
+    # Start the norms from a per-row linear least squares solution at the initial shape parameters
+    shape = np.tile(values, (2, 1))
+    shape[:, [2, 4]] = [[1.0, 0.0], [0.0, 1.0]]
+    design_components = components.folded(shape)
+    design = np.stack([group_rows(np.broadcast_to(c, (n, len(c))), group_id, n_groups) / sigma for c in design_components], axis=2)
+    normal = np.einsum('ngk,ngl->nkl', design, design) + 1e-30 * np.eye(2)
+    norms = np.linalg.solve(normal, np.einsum('ngk,ng->nk', design, rate / sigma)[..., None])[..., 0]
+    start = np.tile(values, (n, 1))
+    for col, k in ((0, 2), (1, 4)):
+        if free[k]:
+            fallback = 1e-3 * np.abs(norms).max(axis=1)
+            start[:, k] = np.where(norms[:, col] > 0, norms[:, col], np.where(fallback > 0, fallback, values[k]))
+    start[:, log_scale] = np.log(np.clip(start[:, log_scale], 1e-30, None))
+    lower_fit = np.where(log_scale, -np.inf, lower)[free]
+    upper_fit = np.where(log_scale, np.inf, upper)[free]
+
+    all_rows = np.arange(n)
+    p = start[:, free]
+    r = residuals(p, all_rows)
+    stat = np.sum(r**2, axis=1)
+    lam = np.full(n, 1e-3)
+    running = np.isfinite(stat)
+    jac = np.zeros((n, n_groups, n_free))
+    for _ in range(max_iter):
+        rows = np.flatnonzero(running)
+        if len(rows) == 0:
+            break
+        step = np.maximum(1e-6, 1e-4 * np.abs(p[rows]))
+        step = np.where(p[rows] + step > upper_fit, -step, step)
+        for k in range(n_free):
+            shifted = p[rows].copy()
+            shifted[:, k] += step[:, k]
+            jac[rows, :, k] = (residuals(shifted, rows) - r[rows]) / step[:, k:k+1]
+        alpha = np.einsum('ngk,ngl->nkl', jac[rows], jac[rows])
+        beta = np.einsum('ngk,ng->nk', jac[rows], r[rows])
+        diagonal = np.diagonal(alpha, axis1=1, axis2=2) + 1e-12
+        pending = np.ones(len(rows), dtype=bool)
+        improved = np.zeros(len(rows), dtype=bool)
+        converged = np.zeros(len(rows), dtype=bool)
+        while pending.any():
+            sub = np.flatnonzero(pending)
+            target = rows[sub]
+            damped = alpha[sub] + lam[target][:, None, None] * np.einsum('nk,kl->nkl', diagonal[sub], np.eye(n_free))
+            delta = np.linalg.solve(damped, -beta[sub][..., None])[..., 0]
+            p_new = np.clip(p[target] + delta, lower_fit, upper_fit)
+            r_new = residuals(p_new, target)
+            stat_new = np.sum(r_new**2, axis=1)
+            better = np.isfinite(stat_new) & (stat_new < stat[target])
+            accepted = target[better]
+            converged[sub[better]] = stat[accepted] - stat_new[better] < delta_stat
+            p[accepted], r[accepted], stat[accepted] = p_new[better], r_new[better], stat_new[better]
+            lam[accepted] = np.maximum(lam[accepted] / 10, 1e-10)
+            improved[sub[better]] = True
+            pending[sub[better]] = False
+            lam[target[~better]] *= 10
+            pending[sub[~better][lam[target[~better]] >= 1e10]] = False
+        running[rows[~improved | converged]] = False
+
+    # Parameters pegged at a hard limit are treated as frozen for the covariance, as XSPEC does for errors
+    covariance = np.full((n, n_free, n_free), np.nan)
+    active = (p > lower_fit) & (p < upper_fit)
+    for pattern in np.unique(active, axis=0):
+        rows = np.flatnonzero((active == pattern).all(axis=1))
+        j = jac[rows][:, :, pattern]
+        try:
+            inverse = np.linalg.inv(np.einsum('ngk,ngl->nkl', j, j))
+        except np.linalg.LinAlgError:
+            continue
+        covariance[np.ix_(rows, pattern, pattern)] = inverse
+
+    return {'values': to_values(p), 'statistic': stat, 'dof': np.count_nonzero(noticed, axis=1) - n_free, 'covariance': covariance, 'free': free, 'log_scale': log_scale}
+
+
+class numpy_simulation:
+
+    def __init__(self,model_def,instrument,simulation_params_dic,fit_params_dic):
+        '''
+        In-process drop-in for xspec_simulations.simulation: fakes and fits spectra with NumPy only, without
+        writing files or calling HEASoft tools. MODEL, tbabs*(po+ezdiskbb), and the same model with the other
+        absorptions of ABSORPTION are implemented.
+
+        Arguments are the same as for xspec_simulations.simulation.
+        '''
+        absorption, _, emission = model_def.replace(' ','').lower().partition('*')
+        if absorption not in ABSORPTION or emission not in ('(po+ezdiskbb)','(powerlaw+ezdiskbb)'):
+            raise ValueError('The numpy backend only implements %s, with the absorption %s.' % (MODEL, ' or '.join(ABSORPTION)))
+        self.model = model_def
+        self.absorption = absorption
+        self.sim_params_dic = simulation_params_dic
+        self.fit_params_dic = fit_params_dic
+        if instrument == 'maxi':
+            self.energyRange_low = 2.0
+            self.energyRange_high = 20.0
+            self.sourceFilename = "sim_files/gx339-4_g_low_src.pi"
+            self.responseFilename = "sim_files/gx339-4_g_low.rsp"
+            self.backgroundFilename = "sim_files/gx339-4_g_low_bgd.pi"
+        elif instrument == 'xrt':
+            self.energyRange_low = 0.7
+            self.energyRange_high = 10.0
+            self.sourceFilename = "sim_files/00010627114src_wt.pha"
+            self.responseFilename = "sim_files/swxwt0to2s6_20131212v015.rmf"
+            self.backgroundFilename = "sim_files/00010627114bgd_wt.pha"
+        else:
+            raise ValueError('Only maxi or xrt allowed.')
+
+    def reset(self,simulation_params_dic,fit_params_dic):
+        '''
+        Sets the parameters of the next run (see xspec_simulations.simulation.reset).
+        '''
+        self.sim_params_dic = simulation_params_dic
+        self.fit_params_dic = fit_params_dic
+        return self
+
+    def preload(self):
+        '''
+        Reads the source, background and response files of the instrument into the per-process cache ahead of the
+        first run.
+        '''
+        read_spectrum(self.sourceFilename)
+        read_spectrum(self.backgroundFilename)
+        read_response(self.responseFilename)
+
+    def fakeit(self,n=1,exposure=None,backExposure=None,rng=None):
+        '''
+        Draws Poisson source (including background) and background counts, mirroring XSPEC fakeit with a background file.
+        All n realizations are drawn from the same folded model.
+
+        Output:
+        Faked source and background counts (n x channels), the background scaling ratio and the source exposure
+        '''
+        rng = np.random.default_rng() if rng is None else rng
+        source = read_spectrum(self.sourceFilename)
+        background = read_spectrum(self.backgroundFilename)
+        response = read_response(self.responseFilename)
+        exposure = source['exposure'] if exposure is None else exposure
+        backExposure = background['exposure'] if backExposure is None else backExposure
+
+        v = [parse_xspec_params(self.sim_params_dic)[i][0] for i in range(1, 6)]
+        folded = response['components'][self.absorption].folded(np.array(v))[0]
+        bkg_rate = background['counts'] / background['exposure']
+        expected = folded * exposure + bkg_rate * exposure * source['backscal'] / background['backscal']
+        src_counts = rng.poisson(np.broadcast_to(expected, (n, len(expected))))
+        bkg_counts = rng.poisson(np.broadcast_to(bkg_rate * backExposure, (n, len(bkg_rate))))
+        bkg_ratio = (exposure / backExposure) * (source['backscal'] / background['backscal'])
+
+        return src_counts, bkg_counts, bkg_ratio, exposure
+
+    def run_batch(self,n,seed=None,exposure=None,backExposure=None):
+
+        '''
+        Fakes n realizations of the same model as one (n x channels) count matrix, groups every row to a minimum
+        S/N of 3 and fits all rows at once
+
+        Arguments:
+        n: number of realizations
+        seed: seed of the random generator used for the Poisson draws
+        exposure, backExposure: exposures of the faked source and background spectra
+
+        Output:
+        A list of n (fit result, total flux) tuples, see run
+        '''
+        timer = stage_timer()
+        rng = np.random.default_rng(seed)
+        source = read_spectrum(self.sourceFilename)
+        response = read_response(self.responseFilename)
+        energ_lo, energ_hi = response['energ_lo'], response['energ_hi']
+
+        src_counts, bkg_counts, bkg_ratio, exposure = self.fakeit(n=n,exposure=exposure,backExposure=backExposure,rng=rng)
+        timer.lap('fakeit')
+        grouping, quality = group_snmin(src_counts, bkg_counts, bkg_ratio, minsn=3.0, quality=source['quality'])
+
+        good = quality == 0
+        group_id = np.where(good, np.cumsum(grouping == 1, axis=1) - 1, -1)
+        n_groups = group_id.max() + 1
+        src = group_rows(src_counts, group_id, n_groups)
+        bkg = group_rows(bkg_counts, group_id, n_groups)
+        flat = (group_id + n_groups * np.arange(n)[:, None])[good]
+        e_low = np.full(n * n_groups, np.inf)
+        e_high = np.zeros(n * n_groups)
+        np.minimum.at(e_low, flat, np.broadcast_to(response['e_min'], good.shape)[good])
+        np.maximum.at(e_high, flat, np.broadcast_to(response['e_max'], good.shape)[good])
+        centre = ((e_low + e_high) / 2).reshape(n, n_groups)
+        n_chan = group_rows(good.astype(float), group_id, n_groups)
+        noticed = (n_chan > 0) & (centre >= self.energyRange_low) & (centre <= self.energyRange_high) & (src > 0)
+
+        rate = np.where(noticed, (src - bkg_ratio * bkg) / exposure, 0)
+        variance = np.where(noticed, (src + bkg_ratio**2 * bkg) / exposure**2, 0)
+        timer.lap('grouping')
+
+        fit = fit_spectra(response['components'][self.absorption], group_id, rate, variance, parse_xspec_params(self.fit_params_dic))
+        timer.lap('fit')
+
+        photons = response['components'][self.absorption].photons(fit['values'])
+        tot_flux = energy_flux(energ_lo, energ_hi, photons, self.energyRange_low, self.energyRange_high)
+        timer.lap('flux')
+
+        # 90% confidence (delta chi^2 = 2.706) interval on the disk norm from the fit covariance (of ln(norm))
+        disk_col = np.count_nonzero(fit['free'][:4])
+        if fit['free'][4]:
+            sigma_log = np.sqrt(fit['covariance'][:, disk_col, disk_col])
+        else:
+            sigma_log = np.full(n, np.nan)
+        norm_low, norm_up = covariance_interval(fit['values'][:, 4], sigma_log)
+
+        results = []
+        for row in range(n):
+            nH, gamma, pl_norm, T_max, disk_norm = fit['values'][row]
+            if not np.isfinite(fit['statistic'][row]) or fit['dof'][row] <= 0:
+                results.append(({'gamma': None, 'power_norm': None, 'temp': None, 'disk_norm': None, 'disk_norm_error': (None, None), 'disk_norm_sigma_log': None, 'statistic': None, 'dof': None}, None))
+                continue
+            if np.isfinite(sigma_log[row]):
+                error, sigma = (norm_low[row], norm_up[row]), sigma_log[row]
+            else:
+                error, sigma = (None, None), None
+            results.append(({'gamma': gamma, 'power_norm': pl_norm, 'temp': T_max, 'disk_norm': disk_norm, 'disk_norm_error': error, 'disk_norm_sigma_log': sigma, 'statistic': fit['statistic'][row], 'dof': fit['dof'][row]}, tot_flux[row]))
+        timer.lap('error')
+
+        return results
+
+    def run(self,id='',spec_dir='',seed=None,exposure=None,backExposure=None,**kwargs):
+
+        '''
+        Perform a simulation run (fake a spectrum, group it to a minimum S/N of 3 and then fit it) in memory
+
+        Arguments:
+        id, spec_dir: unused, kept so the call is interchangeable with xspec_simulations.simulation.run
+        seed: seed of the random generator used for the Poisson draws
+        exposure, backExposure: exposures of the faked source and background spectra
+
+        Output:
+        A dictionary with the fit results ('gamma','power_norm','temp','disk_norm','disk_norm_error','disk_norm_sigma_log',
+        'statistic','dof')
+        and the total absorbed flux in the instrument band. If fitting fails the fit values are None.
+        '''
+        return self.run_batch(1,seed=seed,exposure=exposure,backExposure=backExposure)[0]
+
+
+def compare_with_xspec(instrument,params,n_runs=20,exposure=1000.0,model=MODEL):
+    '''
+    Runs the XSPEC and numpy backends on the same input and returns the median fractional difference of the fitted
+    parameters and total flux. Needs a working PyXspec/HEASoft installation.
+
+    Arguments:
+    params: dictionary with keys 'nH','gamma','pl_norm','temp','disk_norm'
+    model: model of both backends: MODEL (default) or the same model with another absorption of ABSORPTION
+    '''
+    from xspec import Xset
+    from xspec_simulations import simulation
+
+    Xset.abund = TBABS_ABUND
+    Xset.xsect = TBABS_XSECT
+
+    sim_dic = {1: params['nH'], 2: params['gamma'], 3: params['pl_norm'], 4: params['temp'], 5: params['disk_norm']}
+    fit_dic = {1: str(params['nH']) + ",0", 2: "2.3,,1.7,1.7,3.0,3.0", 4: ',,0.1,0.1'}
+    xspec_values, numpy_values = [], []
+    for i in range(n_runs):
+        m, flux = simulation(model,instrument,sim_dic,fit_dic).run(id='compare_'+str(i),spec_dir='.',exposure=exposure,backExposure=exposure)
+        xspec_values.append((m.powerlaw.PhoIndex.values[0], m.ezdiskbb.T_max.values[0], m.ezdiskbb.norm.values[0], flux))
+        res, flux = numpy_simulation(model,instrument,sim_dic,fit_dic).run(seed=i,exposure=exposure,backExposure=exposure)
+        numpy_values.append((res['gamma'], res['temp'], res['disk_norm'], flux))
+
+    ratio = np.median(np.array(numpy_values, dtype=float), axis=0) / np.median(np.array(xspec_values, dtype=float), axis=0) - 1
+    return dict(zip(('gamma', 'temp', 'disk_norm', 'total_flux'), ratio))
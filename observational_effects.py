@@ -1,28 +1,34 @@
-from xspec import *
 import argparse
 import os
-import pandas as pd
 import numpy as np
 import time
-from multiprocessing import Pool, cpu_count, TimeoutError, set_start_method
-from tqdm import tqdm
-from xspec_simulations import *
+from multiprocessing import Pool
+from scheduler import task_scheduler
+from xspec_simulations import simulation
+from numpy_simulations import numpy_simulation, MODEL as NUMPY_MODEL, TBABS_ABUND, TBABS_XSECT
+from fake_backend import fake_simulation
+from flux_norm import powerlaw_norms, INSTRUMENT_BANDS
+from gr_correction import correction_table, write_npy_cache, load_npy_cache
+from cell_stats import cell_table
+from adaptive_sampling import adaptive_sampler
+from profiling import stage_timer, run_profile, prune_profiles
+from uncertainty import ERROR_METHODS, covariance_interval, log_sigma, monte_carlo_distance
 import random
-import urllib
-import h5py
 import subprocess
 import tempfile
 import sys
-import gc
+import signal
+import pickle
+from collections import Counter
 from datetime import datetime
 
-def find_peak(array):
-    if len(array) != 0:
-        counts, bins = np.histogram(array,bins='stone')
-        peak = (bins[np.argmax(counts)]+bins[np.argmax(counts)+1])/2
-    else:
-        peak = None
-    return peak
+# Per-process state shared by all tasks a worker runs (filled by init_worker)
+_worker_state = {}
+
+# Modules the fork server imports once for all workers (see make_scheduler); '__main__' is the running script and
+# worker_preload builds the tables every worker needs. PyXspec is added for the xspec backend; pandas, h5py and
+# tqdm are only needed by the parent process
+PRELOAD_MODULES = ['__main__', 'numpy', 'scipy.sparse', 'astropy.io.fits', 'observational_effects', 'worker_preload']
 
 def idx_of_value_from_grid(grid,value,atol=1e-08,verbose=False):
     """
@@ -42,12 +48,16 @@ def idx_of_value_from_grid(grid,value,atol=1e-08,verbose=False):
     return index
 
 
-def correction_file():
+def correction_file(mode='nearest'):
     """
     The function retrieves and uses data from the file 'gGR_gNT_J1655.h5' for these calculations.
+    The arrays are returned as a correction_table, which indexes the grids once for fast (batch) lookups;
+    mode='linear' interpolates between grid points instead of taking the nearest one.
     References:
         Greg Salvesen's repository for GR correction values: https://github.com/gregsalvesen/bhspinf
     """
+    import urllib.request
+    import h5py
     if not os.path.isfile('gGR_gNT_J1655.h5'):  
         urllib.request.urlretrieve("https://raw.githubusercontent.com/gregsalvesen/bhspinf/main/data/GR/gGR_gNT_J1655.h5","gGR_gNT_J1655.h5") ## Thanks Greg!!
     ## Copied from gregsalvesen/bhspinf/
@@ -60,102 +70,150 @@ def correction_file():
         gNT_grid = f['gNT'][:]       # 1D correction factor
 
         # Return a dictionary of arrays (or any other structure you prefer)
-        data = {
+        data = correction_table({
         'a_grid': a_grid,
         'r_grid': r_grid,
         'i_grid': i_grid,
         'gGR_grid': gGR_grid,
         'gNT_grid': gNT_grid
-        }
+        },mode=mode)
     
     return data
 
 
+def correction_npy_cache(cache_dir='gGR_gNT_J1655_npy'):
+    """
+    Writes the arrays of 'gGR_gNT_J1655.h5' to a directory of .npy files (once, or again when the HDF5 file is newer)
+    so that pool workers can memory-map the correction table instead of receiving a pickled copy with every task.
+
+    Returns:
+        str: The cache directory, to be passed to init_worker.
+    """
+    cached = os.path.join(cache_dir, 'gNT_grid.npy')
+    if not os.path.isfile(cached) or (os.path.isfile('gGR_gNT_J1655.h5') and os.path.getmtime(cached) < os.path.getmtime('gGR_gNT_J1655.h5')):
+        write_npy_cache(correction_file(), cache_dir)
+    return cache_dir
+
+
+def init_worker(cache_dir,args,tmp_dir,mode='nearest'):
+    """
+    Pool initializer: maps the correction table once per worker process and keeps the run-wide arguments, so tasks
+    only carry their small varying parameters. The simulation object of the backend and instrument is built and
+    preloaded here (XSPEC settings and model template, or the response and background files), together with the
+    flux tables of flux_norm, so the first task finds the worker warm.
+    """
+    _worker_state['f'] = load_npy_cache(cache_dir,mode=mode)
+    _worker_state['args'] = args
+    _worker_state['tmp_dir'] = tmp_dir
+    backend = getattr(args, 'backend', 'xspec')
+    try:
+        if backend == 'xspec':
+            setup_xspec()
+        get_simulation(args,{},{}).preload()
+        # Builds the flux tables of flux_norm, which are kept per process
+        scale_powerlaw_norm(args.gamma,args.temp,1.0,1.0,band=INSTRUMENT_BANDS[args.instrument])
+    except Exception:  # e.g. a missing response file: the tasks report the error
+        pass
+
+
+def get_simulation(args,sim_params,fit_params):
+    """
+    The simulation object for the backend and instrument of args, set to the parameters of a task. Objects are kept
+    in _worker_state, so the loaded files and the model template of an instrument are reused by every task of the
+    worker instead of being set up again.
+    """
+    backend = getattr(args, 'backend', 'xspec')
+    settings = getattr(args, 'fake_settings', {}) if backend == 'fake' else {}
+    key = (backend, args.instrument, tuple(sorted(settings.items())))
+    simulations = _worker_state.setdefault('simulations', {})
+    if key not in simulations:
+        if backend == 'fake':  # benchmarks.py: no spectra, settings from args.fake_settings
+            simulations[key] = fake_simulation("tbabs*(po+ezdiskbb)",args.instrument,sim_params,fit_params,**settings)
+        elif backend == 'numpy':
+            simulations[key] = numpy_simulation(NUMPY_MODEL,args.instrument,sim_params,fit_params)
+        else:
+            simulations[key] = simulation("tbabs*(po+ezdiskbb)",args.instrument,sim_params,fit_params)
+    return simulations[key].reset(sim_params,fit_params)
+
+
+def init_sweep_worker(cache_dir,configs,tmp_dir,mode='nearest'):
+    """
+    Initializer of the warm pool used by sweep.py: like init_worker, but keeps the list of all configurations the
+    pool will run, so a task only needs to carry the index of its configuration, and preloads the simulation of
+    every instrument in them.
+    """
+    init_worker(cache_dir,configs[0],tmp_dir,mode=mode)
+    _worker_state['configs'] = configs
+    for args in {(getattr(args, 'backend', 'xspec'), args.instrument): args for args in configs}.values():
+        try:
+            get_simulation(args,{},{}).preload()
+        except Exception:
+            pass
+
+
+def run_sweep_task(task):
+    """
+    Runs a (configuration index, *task) tuple of sweep.py with run_cell or run_simulation for that configuration.
+    """
+    args = _worker_state['configs'][task[0]]
+    _worker_state['args'] = args
+    return run_cell(task[1:]) if getattr(args, 'batched', False) else run_simulation(task[1:])
+
+
 def get_total_correction_GR_and_Rin_Rg_ratio(data,inc,a,limb_dark=True,verbose=True):
     """
     Calculates the total correction factor and the Rin/Rg ratio based on the provided inclination angle and spin parameter.
     The correction factors are derived using General Relativity (GR) correction values from Greg Salvesen's repository.
+    The grid search is done by gr_correction.correction_table (sorted index, median of ties, memoized); inc and a
+    may also be arrays.
 
     Args:
-        inc (array-like): Inclination angles in degrees. This should contain at least the minimum and maximum of the desired inclination range.
-        a (float, optional): Spin parameter, a dimensionless quantity representing the angular momentum of the black hole. Defaults to 0.
+        data (dict or correction_table): Output of correction_file.
+        inc (float or array-like): Inclination angle(s) in degrees.
+        a (float or array-like): Spin parameter, a dimensionless quantity representing the angular momentum of the black hole.
+        limb_dark (bool, optional): If False, the limb darkening factor is not applied. Defaults to True.
         verbose (bool, optional): If True, enables printing of warnings and additional information. Defaults to True.
-        inc_sample_method (str, optional): Method for sampling inclination values, can be 'uniform' or 'isotropic'. Defaults to 'uniform'.
-        i_indicies (list of int, optional): Pre-calculated inclination indices. If None, indices are calculated based on the inclination sample method.
 
     Returns:
         tuple: A tuple containing the following elements:
             - The GR correction factors multiplied by the cosine of inclination and limb darkening.
             - Rin/Rg ratio value.
             - Selected spin value from the spin grid.
-            - Array of selected inclination angles.
-            - Indices of the selected inclination angles in the inclination grid.
+            - Selected inclination angle from the inclination grid.
 
     References:
         Greg Salvesen's repository for GR correction values: https://github.com/gregsalvesen/bhspinf
     """
-    a_grid   = data['a_grid']  # [-]
-    r_grid   = data['r_grid']  # [Rg]
-    i_grid   = data['i_grid']  # [deg]
-    gGR_grid = data['gGR_grid']  # gGR(r[Rg], i[deg])
-    gNT_grid = data['gNT_grid']     # gNT(r[Rg])
-    ##
+    if not isinstance(data, correction_table):
+        data = correction_table(data,verbose=verbose)
 
-    atol = 1e-08
-    a_index, = np.where(np.isclose(a_grid,a,rtol=1e-05, atol=atol))
-    atol_tmp = atol
-    while len(a_index) == 0:
-        atol_tmp *= 10
-        a_index, = np.where(np.isclose(a_grid,a,rtol=1e-05, atol=atol_tmp))
-    if len(a_index) != 1:
-        a_index = a_index + (a_index[-1]-a_index[0]) // 2
-        if verbose==True:
-            print("Warning: found more than one spin grid value (for GR correction) that are equally close to the user specified spin value. Taking the median value %s as the one to be closest." % (a_grid[a_index[0]]))
-    Rin_ratio = r_grid[a_index]
-
-    inc_index = idx_of_value_from_grid(i_grid,inc,verbose=True)
-    
-    GR_correction = gGR_grid[a_index[0],inc_index[0]] * gNT_grid[a_index[0]]
-    limb_darkening = (1/2 + (3/4)*np.cos(i_grid[inc_index[0]]*(np.pi/180)))
-    cos_i = np.cos(i_grid[inc_index[0]]*(np.pi/180))
-    selected_i = i_grid[inc_index[0]]
-
-    # GR_correction = 1 ##Uncomment for removing GR corrections
-    if not limb_dark:
-      limb_darkening = 1
-
-    return (GR_correction*cos_i*limb_darkening,Rin_ratio[0],a_grid[a_index[0]],selected_i)
+    return data.correction(inc,a,limb_dark=limb_dark)
 
 def to_norm(f,d,mass,a,inc,limb_dark=True):
 
-    G = 6.6743e-11  # SI units
-    c = 2.998e8  # SI units
-    kappa = 1.7
-    m_sun = 1.989e30  # SI units
+    if not isinstance(f, correction_table):
+        f = correction_table(f)
 
-    # GR correction values
-    corr, Rin_ratio, _, _= get_total_correction_GR_and_Rin_Rg_ratio(f,inc, a, limb_dark=limb_dark, verbose=True)
-
-    norm = (((Rin_ratio * G * m_sun * 1e-2) / ((kappa ** 2) * (c ** 2)))**2) * corr * (mass/d)**2
-
-    return norm
+    return f.to_norm(d,mass,a,inc,limb_dark=limb_dark)
 
 def to_d(f,norm,mass,a,inc,limb_dark=True):
 
-    G = 6.6743e-11  # SI units
-    c = 2.998e8  # SI units
-    kappa = 1.7
-    m_sun = 1.989e30  # SI units
+    if not isinstance(f, correction_table):
+        f = correction_table(f)
 
-    # GR correction values
-    corr, Rin_ratio, _, _= get_total_correction_GR_and_Rin_Rg_ratio(f,inc, a, limb_dark=limb_dark, verbose=True)
+    return f.to_d(norm,mass,a,inc,limb_dark=limb_dark)
 
-    d = ((Rin_ratio * G * m_sun * 1e-2) / ((kappa ** 2) * (c ** 2))) * np.sqrt(1 / norm) * np.sqrt(corr) * (mass)
+def scale_powerlaw_norm(gamma,temp,ezdiskbb_norm,ratio_pl_to_disk,band=(2.0,20.0),method='analytic'):
+   """
+   Powerlaw norm giving a powerlaw-to-disc flux ratio of ratio_pl_to_disk in the energy band (keV).
+   The default method uses the memoized unit-norm fluxes of flux_norm (ezdiskbb_norm may be an array);
+   method='xspec' runs the two AllModels.calcFlux calls instead, for validation.
+   """
 
-    return d
+   if method == 'analytic':
+      return powerlaw_norms(gamma,temp,ezdiskbb_norm,ratio_pl_to_disk,band=band)
 
-def scale_powerlaw_norm(gamma,temp,ezdiskbb_norm,ratio_pl_to_disk):
-   
+   from xspec import AllModels, AllData, Model
    AllModels.clear()
    AllData.clear()
 
@@ -163,144 +221,433 @@ def scale_powerlaw_norm(gamma,temp,ezdiskbb_norm,ratio_pl_to_disk):
    m = Model(model,setPars={1:gamma,3:temp,4:ezdiskbb_norm})
    
    m.setPars({2: 0})
-   AllModels.calcFlux("2.0 20.0")
+   AllModels.calcFlux(str(band[0])+" "+str(band[1]))
    ezdiskbb_flux = m.flux[0]
    m.setPars({2: 1},{4: 0})
-   AllModels.calcFlux("2.0 20.0")
+   AllModels.calcFlux(str(band[0])+" "+str(band[1]))
    powerlaw_flux = m.flux[0]
    pl_norm = (ezdiskbb_flux * ratio_pl_to_disk) / powerlaw_flux
 
    return pl_norm
 
+def distance_errors(f,args,disk_norm,norm_low,norm_up,sigma_log,seed=None):
+    """
+    Distance interval (d_low, d_up) of fitted disk norms with the error method of args (see uncertainty.py):
+    'covariance' and 'profile' put the norm interval (from the fit covariance or Fit.error) through to_d, and
+    'montecarlo' takes the quantiles of the distances of args.n_mc draws per norm, with the args.mass_sigma,
+    args.a_sigma and args.inc_sigma uncertainties. The norms may be arrays (one per realization) of a cell.
+    """
+    if getattr(args, 'error_method', 'covariance') == 'montecarlo':
+        _, d_low, d_up = monte_carlo_distance(f,disk_norm,sigma_log,args.mass,args.a,args.inc,n_samples=getattr(args, 'n_mc', 1000),rng=np.random.default_rng(seed),
+                                              mass_sigma=getattr(args, 'mass_sigma', 0.0),a_sigma=getattr(args, 'a_sigma', 0.0),inc_sigma=getattr(args, 'inc_sigma', 0.0))
+        return (d_low, d_up) if np.ndim(disk_norm) else (d_low[0], d_up[0])
+    return to_d(f,norm_up,args.mass,args.a,args.inc,limb_dark=True), to_d(f,norm_low,args.mass,args.a,args.inc,limb_dark=True)
+
 def run_simulation(arguments):
-    Xset.seed = random.randint(0, 10000)
-    nH_value, d, args, iteration, tmp_dir, f = arguments
+    """
+    Fakes and fits one realization of an (nH, d) cell and converts the fitted disk norm to a distance.
+
+    Returns:
+        dict: the result row. A realization whose fit failed (or has no disk norm interval) raises a RuntimeError
+        (XSPEC: the exception of Fit.perform), so the scheduler retries it with a new seed and lists it as errored
+        once its retries are used up, instead of recording an empty row as completed.
+    """
+    if len(arguments) == 3:  # (nH, d, iteration) with the shared state from init_worker
+        nH_value, d, iteration = arguments
+        args, tmp_dir, f = _worker_state['args'], _worker_state['tmp_dir'], _worker_state['f']
+    else:
+        nH_value, d, args, iteration, tmp_dir, f = arguments
+    timer = stage_timer()
+    backend = getattr(args, 'backend', 'xspec')
+    seed = random.randint(0, 10000)
+    if backend == 'xspec':
+        from xspec import Xset, Fit
+        Xset.seed = seed
 
     ezdiskbb_norm = to_norm(f,d,args.mass,args.a,args.inc,limb_dark=True)
 
-    powerlaw_norm = scale_powerlaw_norm(args.gamma,args.temp,ezdiskbb_norm,(1-args.ratio_disk_to_tot)/args.ratio_disk_to_tot)
+    powerlaw_norm = scale_powerlaw_norm(args.gamma,args.temp,ezdiskbb_norm,(1-args.ratio_disk_to_tot)/args.ratio_disk_to_tot,band=INSTRUMENT_BANDS[args.instrument])
 
     gamma_fit_range = "2.3,,1.7,1.7,3.0,3.0"
 
     result = {"nH": nH_value, "d": d, "red_chi_squared": None, "gamma": None, "power_norm_fake": powerlaw_norm, "power_norm_fit": None, "temp": None, "disk_norm_fake": ezdiskbb_norm, "disk_norm_fit": None, "error_disk_norm_low": None, "error_disk_norm_up": None, "d_fit": None, "error_d_low": None , "error_d_up": None, "frac_uncert": None,"total_flux":None}
-    
-    sim1 = simulation("tbabs*(po+ezdiskbb)",args.instrument,{1: nH_value, 2:args.gamma, 3: powerlaw_norm, 4: args.temp, 5: ezdiskbb_norm},{1: str(nH_value) + ",0", 2: gamma_fit_range, 4: ',,0.1,0.1'})
-    m, tot_flux = sim1.run(id=iteration,spec_dir=tmp_dir,exposure=args.exposure,backExposure=args.exposure)
 
-    try:
-        result.update({"red_chi_squared": Fit.statistic / Fit.dof, "gamma": m.powerlaw.PhoIndex.values[0], "power_norm_fit": m.powerlaw.norm.values[0], "temp": m.ezdiskbb.T_max.values[0], "disk_norm_fit": m.ezdiskbb.norm.values[0], "error_disk_norm_low": m.ezdiskbb.norm.error[0], "error_disk_norm_up": m.ezdiskbb.norm.error[1], "d_fit": to_d(f,m.ezdiskbb.norm.values[0],args.mass,args.a,args.inc,limb_dark=True),"error_d_low": to_d(f,m.ezdiskbb.norm.error[1],args.mass,args.a,args.inc,limb_dark=True),"error_d_up": to_d(f,m.ezdiskbb.norm.error[0],args.mass,args.a,args.inc,limb_dark=True), "frac_uncert": (((to_d(f,m.ezdiskbb.norm.values[0],args.mass,args.a,args.inc,limb_dark=True)- to_d(f,m.ezdiskbb.norm.error[1],args.mass,args.a,args.inc,limb_dark=True)) + (to_d(f,m.ezdiskbb.norm.error[0],args.mass,args.a,args.inc,limb_dark=True)- to_d(f,m.ezdiskbb.norm.values[0],args.mass,args.a,args.inc,limb_dark=True))) / 2) / (to_d(f,m.ezdiskbb.norm.values[0],args.mass,args.a,args.inc,limb_dark=True)),"total_flux":tot_flux})
-    except:
-            pass
+    sim_params = {1: nH_value, 2:args.gamma, 3: powerlaw_norm, 4: args.temp, 5: ezdiskbb_norm}
+    fit_params = {1: str(nH_value) + ",0", 2: gamma_fit_range, 4: ',,0.1,0.1'}
+    sim1 = get_simulation(args,sim_params,fit_params)
+    error_method = getattr(args, 'error_method', 'covariance')
+    timer.lap('setup')
+
+    # The simulation objects time their own stages (fakeit, grouping, fit, error, flux)
+    if backend in ('numpy', 'fake'):
+        fit, tot_flux = sim1.run(id=iteration,spec_dir=tmp_dir,seed=seed,exposure=args.exposure,backExposure=args.exposure)
+    else:
+        m, tot_flux = sim1.run(id=iteration,spec_dir=tmp_dir,profile_errors=error_method == 'profile',exposure=args.exposure,backExposure=args.exposure)
+    timer.skip()
+
+    if backend in ('numpy', 'fake'):
+        if fit['disk_norm'] is None or fit['disk_norm_error'][0] is None:
+            raise RuntimeError('fit of realization %s at nH=%s, d=%s failed or has no disk norm interval' % (iteration, nH_value, d))
+        stat, dof, gamma, pl_norm, temp, disk_norm = fit['statistic'], fit['dof'], fit['gamma'], fit['power_norm'], fit['temp'], fit['disk_norm']
+        norm_low, norm_up = fit['disk_norm_error']
+        sigma_log = fit['disk_norm_sigma_log']
+    else:
+        stat, dof, gamma, pl_norm, temp, disk_norm = Fit.statistic, Fit.dof, m.powerlaw.PhoIndex.values[0], m.powerlaw.norm.values[0], m.ezdiskbb.T_max.values[0], m.ezdiskbb.norm.values[0]
+        sigma_log = float(log_sigma(disk_norm,m.ezdiskbb.norm.sigma))
+        if error_method == 'profile':
+            norm_low, norm_up = m.ezdiskbb.norm.error[0], m.ezdiskbb.norm.error[1]
+        elif np.isfinite(sigma_log) and dof > 0:
+            norm_low, norm_up = (float(x) for x in covariance_interval(disk_norm,sigma_log))
+        else:
+            raise RuntimeError('fit of realization %s at nH=%s, d=%s has no covariance for the disk norm' % (iteration, nH_value, d))
+
+    d_fit = to_d(f,disk_norm,args.mass,args.a,args.inc,limb_dark=True)
+    d_low, d_up = distance_errors(f,args,disk_norm,norm_low,norm_up,sigma_log,seed=seed)
+    result.update({"red_chi_squared": stat / dof, "gamma": gamma, "power_norm_fit": pl_norm, "temp": temp, "disk_norm_fit": disk_norm, "error_disk_norm_low": norm_low, "error_disk_norm_up": norm_up, "d_fit": d_fit,"error_d_low": d_low,"error_d_up": d_up, "frac_uncert": (((d_fit - d_low) + (d_up - d_fit)) / 2) / d_fit,"total_flux":tot_flux})
+    timer.lap('to_d')
 
     return result
 
-# Helper function to create a new pool and imap iterator
-def new_pool_and_iterator(processes,start_index):
-    pool_ = Pool(processes=processes)
-    # Only map the remaining tasks (from start_index onward)
-    it_ = pool_.imap(run_simulation, all_args[start_index:], chunksize=1)
-    return pool_, it_
+def run_cell(arguments):
+    """
+    Batched counterpart of run_simulation: fakes all realizations of one (nH, d) cell from a single folded model
+    and fits them together with the numpy backend.
+
+    Returns:
+        list: one result dictionary per realization, with the same keys as run_simulation. Realizations of the
+        cell whose fit failed keep empty values (a batch cannot retry single realizations); an exception retries
+        the whole cell.
+    """
+    if len(arguments) == 4:  # (nH, d, n_iterations, first_id) with the shared state from init_worker
+        nH_value, d, n_iterations, first_id = arguments
+        args, tmp_dir, f = _worker_state['args'], _worker_state['tmp_dir'], _worker_state['f']
+    else:
+        nH_value, d, args, n_iterations, first_id, tmp_dir, f = arguments
+    timer = stage_timer()
+    seed = random.randint(0, 2**31 - 1)
+
+    ezdiskbb_norm = to_norm(f,d,args.mass,args.a,args.inc,limb_dark=True)
+
+    powerlaw_norm = scale_powerlaw_norm(args.gamma,args.temp,ezdiskbb_norm,(1-args.ratio_disk_to_tot)/args.ratio_disk_to_tot,band=INSTRUMENT_BANDS[args.instrument])
+
+    gamma_fit_range = "2.3,,1.7,1.7,3.0,3.0"
+
+    sim1 = get_simulation(args,{1: nH_value, 2:args.gamma, 3: powerlaw_norm, 4: args.temp, 5: ezdiskbb_norm},{1: str(nH_value) + ",0", 2: gamma_fit_range, 4: ',,0.1,0.1'})
+    timer.lap('setup')
+    fits = sim1.run_batch(n_iterations,seed=seed,exposure=args.exposure,backExposure=args.exposure)
+    timer.skip()
+
+    # Distances and their intervals for all fitted realizations of the cell at once; a fit without a disk norm
+    # interval keeps an empty row, as in run_simulation
+    fitted = [k for k, (fit, _) in enumerate(fits) if fit['disk_norm'] is not None and fit['disk_norm_error'][0] is not None]
+    disk_norm = np.array([fits[k][0]['disk_norm'] for k in fitted], dtype=float)
+    norm_low, norm_up = (np.array([fits[k][0]['disk_norm_error'][j] for k in fitted], dtype=float) for j in (0, 1))
+    d_fit = to_d(f,disk_norm,args.mass,args.a,args.inc,limb_dark=True)
+    d_low, d_up = distance_errors(f,args,disk_norm,norm_low,norm_up,np.array([fits[k][0]['disk_norm_sigma_log'] for k in fitted], dtype=float),seed=seed)
+    frac_uncert = (((d_fit - d_low) + (d_up - d_fit)) / 2) / d_fit
+    row = dict(zip(fitted, range(len(fitted))))
+
+    results = []
+    for k, (fit, tot_flux) in enumerate(fits):
+        result = {"nH": nH_value, "d": d, "red_chi_squared": None, "gamma": None, "power_norm_fake": powerlaw_norm, "power_norm_fit": None, "temp": None, "disk_norm_fake": ezdiskbb_norm, "disk_norm_fit": None, "error_disk_norm_low": None, "error_disk_norm_up": None, "d_fit": None, "error_d_low": None , "error_d_up": None, "frac_uncert": None,"total_flux":None}
+        if k in row:
+            j = row[k]
+            result.update({"red_chi_squared": fit['statistic'] / fit['dof'], "gamma": fit['gamma'], "power_norm_fit": fit['power_norm'], "temp": fit['temp'], "disk_norm_fit": fit['disk_norm'], "error_disk_norm_low": norm_low[j], "error_disk_norm_up": norm_up[j], "d_fit": d_fit[j],"error_d_low": d_low[j],"error_d_up": d_up[j], "frac_uncert": frac_uncert[j],"total_flux":tot_flux})
+        results.append(result)
+    timer.lap('to_d')
+
+    return results
+
+def _discard(task):
+    return None
+
+def measure_task_overhead(legacy_task,task,processes=2,n_tasks=500,initargs=None):
+    """
+    Compares the pickled size and the pool dispatch latency (round trip of a no-op task) of a task tuple that
+    carries the full arguments and correction table with the short tuple used together with init_worker.
+
+    Returns:
+        dict: bytes per task and seconds per task for both layouts.
+    """
+    report = {'legacy_bytes': len(pickle.dumps(legacy_task)), 'bytes': len(pickle.dumps(task))}
+    for key, payload, pool_kwargs in (('legacy', legacy_task, {}), ('shared', task, {'initializer': init_worker, 'initargs': initargs} if initargs else {})):
+        with Pool(processes=processes, **pool_kwargs) as pool:
+            pool.map(_discard, [payload] * processes)  # warm up the workers
+            start = time.perf_counter()
+            pool.map(_discard, [payload] * n_tasks, chunksize=1)
+            report[key + '_dispatch_s'] = (time.perf_counter() - start) / n_tasks
+    return report
+
+def log_error(err_msg):
+    print(err_msg)
+    script_call = " ".join(sys.argv)
+    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with open("error_log.log", "a") as error_file:
+            error_file.write(f"{current_time}: {script_call}: {err_msg} \n")
+
+def reduce_results(df_full,nH_list,d_list,peak_method='histogram',n_boot=200):
+    """
+    Builds the reduced table (one row per (nH, d) cell: medians of the fitted parameters, distance peak and
+    fractional uncertainties) from the full table of realizations, e.g. as read back from a result_store.
+    During a run the same table is accumulated result by result (cell_stats.cell_table). peak_method and n_boot
+    select the peak estimator and the bootstrap replicates of the d_fit_peak interval (see mode_estimation).
+
+    Returns:
+        DataFrame: The table written to table_..._e<exposure>.csv.
+    """
+    cells = cell_table(nH_list, d_list, peak_method=peak_method, n_boot=n_boot)
+    cells.update_frame(df_full)
+    return cells.table()
 
-def main(all_args):
+def preload_modules(backend='xspec'):
+    return PRELOAD_MODULES + (['xspec', 'xspec_simulations'] if backend == 'xspec' else [])
+
+def make_scheduler(task_function=run_simulation,task_timeout=50,initializer=init_worker,initargs=None,max_retries=2,cell_key=None,profile_dir=None,profile_top=0,start_method=None,preload=None):
+    """
+    The task_scheduler used by main(): SLURM_CPUS_PER_TASK - 2 worker processes, each task with its own deadline;
+    only a worker that exceeds it is killed and replaced, and failed or timed out tasks are retried with a new seed
+    before they are given up on. With profile_dir and profile_top, cProfile dumps of the slowest tasks are kept.
+    With start_method='forkserver' (the default of the command line), workers are forked from a fork server that
+    imported the preload modules (default PRELOAD_MODULES), so a worker replaced after a timeout is ready after a
+    fork and init_worker. The calling script then needs an if __name__ == "__main__" guard.
+    """
     max_cores = int(os.environ.get('SLURM_CPUS_PER_TASK', 4))
     processes = max_cores - 2 # e.g., up to 100, or just use max_cores
     # processes = 200
     print(f"Starting simulations with up to {processes} processes")
 
-    results = []
-    timed_out_tasks = []
-    errored_tasks = []
-
-    timeout_counter = 0
-    max_consecutive_timeouts = 10
-
-    idx = 0  # We'll manually track the index over `all_args`.
+    return task_scheduler(task_function,processes,task_timeout=task_timeout,max_retries=max_retries,
+                          initializer=initializer if initargs is not None else None,initargs=initargs or (),
+                          cell_key=cell_key,max_consecutive_timeouts=10,profile_dir=profile_dir,profile_top=profile_top,
+                          start_method=start_method,preload=PRELOAD_MODULES if preload is None else preload,
+                          on_restart_error=lambda e: log_error(f"Failed to restart worker due to OSError: {e}"))
 
+def main(all_args,task_function=run_simulation,task_timeout=50,initargs=None,max_retries=2,on_result=None,scheduler=None,keep_results=True,profile=None,task_offset=0):
+    if scheduler is None:
+        scheduler = make_scheduler(task_function,task_timeout=task_timeout,initargs=initargs,max_retries=max_retries)
 
+    realizations = Counter()
+    def count_result(index, result):
+        for res in (result if isinstance(result, list) else [result]):
+            realizations[(res["nH"], res["d"])] += 1
+        if on_result is not None:
+            on_result(index, result)
 
-    # Initialize the first pool & iterator
-    pool, it = new_pool_and_iterator(processes,idx)
+    # Task timings go to the run profile (profiling.run_profile); task_offset strips a prefix such as the
+    # configuration index of sweep.py from the task tuples
+    on_timing = (lambda index, timing: profile.add(all_args[index][task_offset:], timing)) if profile is not None else None
 
+    from tqdm import tqdm
     with tqdm(total=len(all_args), desc="Running simulations") as pbar:
+        completed, timed_out_tasks, errored_tasks, report = scheduler.run(all_args,progress=pbar,on_result=count_result,keep_results=keep_results,on_timing=on_timing)
+    if profile is not None:
+        profile.add_report(report)
 
-        while idx < len(all_args):
-
-            if timeout_counter > max_consecutive_timeouts:
-                err_msg = "Maximum consecutive timeouts exceeded. Stopping."
-                print(err_msg)
-                script_call = " ".join(sys.argv)
-                current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                with open("error_log.log", "a") as error_file:
-                        error_file.write(f"{current_time}: {script_call}: {err_msg} \n")
-                break
-
-            try:
-                # Attempt to get the next result with a timeout
-                result = it.next(timeout=50)
-                results.append(result)
-                # Successfully got a result => reset timeout counter
-                timeout_counter = 0
-                pbar.update(1)
-                idx += 1
-
-            except TimeoutError:
-                timed_out_tasks.append(all_args[idx][:-1])
-                timeout_counter += 1
-                pbar.update(1)
-                print(f"Timeout #{timeout_counter} at index={idx}. Terminating pool and restarting...")
-                idx += 1  # Skip the timed-out task
-                if timeout_counter < 2:
-                    continue
-                else:
-                    pool.terminate()  
-                    pool.join()
-                    print("Pool is terminated")
-
-                    try:
-                        print("Forcing grabage collection before attempting to restart pool")
-                        gc.collect()
-                        # Re-create the pool and iterator for remaining tasks
-                        print("Attempting to restart pool...")
-                        pool, it = new_pool_and_iterator(processes,idx)
-                    except OSError as e:
-                        err_msg = f"Failed to restart pool due to OSError: {e}"
-                        print(err_msg)
-                        script_call = " ".join(sys.argv)
-                        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        with open("error_log.log", "a") as error_file:
-                                error_file.write(f"{current_time}: {script_call}: {err_msg} \n")
-
-            except Exception as e:
-                errored_tasks.append((all_args[idx], str(e)))
-                print(f"Task at index={idx} errored out: {e}. Skipping.")
-                timeout_counter = 0  # reset for non-timeout errors
-                pbar.update(1)
-                idx += 1
-                # We do NOT terminate the pool here, but you could if desired
-
-    # Cleanly close any remaining pool after finishing
-    if timeout_counter > max_consecutive_timeouts:
-        pool.terminate()
-    else:
-        pool.close()
-    pool.join()
+    if report['aborted']:
+        log_error("Maximum consecutive timeouts exceeded. Stopping.")
+
+    results = []
+    for _, result in sorted(completed, key=lambda item: item[0]):
+        if isinstance(result, list):  # a whole cell from run_cell
+            results.extend(result)
+        else:
+            results.append(result)
 
     print("Loop finished. Returning results.")
-    return results, timed_out_tasks, errored_tasks
+    print(f"Completed {report['completed']}/{report['tasks']} tasks ({report['retries']} retries, {report['timed_out']} timed out, {report['errored']} errored, {report['not_run']} not run)")
+    if report['elapsed'] > 0:
+        print(f"{report['completed'] / report['elapsed']:.2f} tasks/s, workers busy {100 * report['busy'] / (report['elapsed'] * report['processes']):.0f}% of the time")
+    for restart, label in ((False, 'started'), (True, 'restarted')):
+        starts = [start for start in report['workers'] if start['restart'] == restart]
+        if starts:
+            print(f"{len(starts)} workers {label}: {np.mean([start['startup'] for start in starts]):.3f} s to ready on average ({np.mean([start['init'] for start in starts]):.3f} s in init_worker)")
+    print("Per-cell completions (nH, d): tasks completed/timed out/errored, realizations")
+    for cell, counts in sorted(report['cells'].items()):
+        print(f"  {cell}: {counts['completed']}/{counts['timed_out']}/{counts['errored']}, {realizations[cell]}")
 
+    return results, timed_out_tasks, errored_tasks
 
-if __name__ == "__main__":
-
-    # set_start_method('spawn')
-    # random.seed(42)
 
+def setup_xspec():
+    try:
+        from xspec import Xset
+    except ImportError:
+        raise ImportError('PyXspec is not available, use --backend numpy')
     Xset.parallel.leven = 1
     Xset.parallel.error = 1
     Xset.chatter = 0
     Xset.logChatter = 0
     Xset.allowPrompting = False
+    # The abundances and cross-sections tbabs is meant with, and those of the numpy backend
+    Xset.abund = TBABS_ABUND
+    Xset.xsect = TBABS_XSECT
+
+def build_tasks(nH_list,d_list,n_iterations=300,batched=False):
+    """
+    Task tuples for one configuration: (nH, d, iteration) per realization, or (nH, d, n_iterations, first_id) per
+    (nH, d) cell when batched. The last element is the task id used by the result store.
+    """
+    counter = 0  # Initialize a counter
+    all_args = []
+    for nH_value in nH_list:
+        for d in d_list: 
+            if batched:
+                all_args.append((nH_value, d, n_iterations, counter))
+                counter += n_iterations
+                continue
+            for iteration in range(n_iterations):
+                unique_iteration = counter  # Use the counter as a unique identifier
+                all_args.append((nH_value, d, unique_iteration))
+                counter += 1
+    return all_args
+
+def table_name(args):
+    """
+    Path prefix of the result tables of one configuration (without the _full.csv/.csv/_store.h5 suffix). Tables of
+    the XSPEC backend have no backend in their name, as before there were other backends; the others end in
+    _<backend> (e.g. table_..._e1000.0_numpy), so they never share a table or result store with an XSPEC run.
+    """
+    backend = getattr(args, 'backend', 'xspec')
+    return "results/"+str(args.instrument)+"_results/table_g"+str(args.gamma)+"_T"+str(args.temp)+"_a"+str(args.a)+"_m"+str(args.mass)+"_i"+str(args.inc)+"_r"+str(args.ratio_disk_to_tot)+"_e"+str(args.exposure)+("" if backend == 'xspec' else "_"+backend)
+
+def open_store(args,n_iterations=300,store_path=None):
+    from result_store import result_store
+    return result_store(store_path if store_path else table_name(args)+"_store.h5",
+                        {"gamma": args.gamma, "temp": args.temp, "a": args.a, "mass": args.mass, "inc": args.inc, "ratio_disk_to_tot": args.ratio_disk_to_tot,
+                         "exposure": args.exposure, "instrument": args.instrument, "backend": getattr(args, 'backend', 'xspec'), "batched": bool(getattr(args, 'batched', False)), "n_iterations": n_iterations,
+                         "error_method": getattr(args, 'error_method', 'covariance')})
+
+def run_configuration(args,nH_list,d_list,n_iterations=300,scheduler=None,initargs=None,store_path=None,reduce_only=False,task_prefix=(),measure_ipc=False,partial_interval=300,cprofile_top=0):
+    """
+    Runs (or resumes) one (gamma, temp, a, mass, inc, ratio_disk_to_tot, exposure, instrument) configuration over the
+    nH x d grid and writes its full and reduced tables, rebuilt from the result store, and the throughput profile of
+    the run (table_..._profile.csv/.json, see profiling.run_profile).
+
+    Args:
+        args: argparse.Namespace with the configuration (as parsed in __main__).
+        nH_list, d_list (list): Grid of nH (1e22 cm^-2) and distances (kpc).
+        n_iterations (int, optional): Realizations per (nH, d) cell, or the most a cell can get in an adaptive run
+            (args.target_median and/or args.target_peak set, see adaptive_sampling.adaptive_sampler; args.min_count
+            and args.round_size are its other settings). Defaults to 300.
+        scheduler (task_scheduler, optional): Scheduler (e.g. a warm pool shared by several configurations). By default
+            one is started for this configuration with init_worker(*initargs).
+        initargs (tuple, optional): (cache_dir, args, tmp_dir) for init_worker.
+        store_path (str, optional): Result store; defaults to table_name(args) + "_store.h5".
+        reduce_only (bool, optional): Only rebuild the tables from the store.
+        task_prefix (tuple, optional): Prepended to every task tuple (e.g. the configuration index of sweep.py).
+        partial_interval (float, optional): Seconds between writes of the live reduced table (table_..._partial.csv)
+            while the run is going; None to disable.
+        cprofile_top (int, optional): Keep cProfile dumps of this many slowest tasks in table_..._cprofile/ (only
+            when the scheduler is started here, not with a shared one). Defaults to 0 (no profiling).
+
+    Returns:
+        tuple: Timed out tasks and errored tasks.
+    """
+    os.makedirs("results/"+str(args.instrument)+"_results", exist_ok=True)
+    name = table_name(args)
+    batched = bool(getattr(args, 'batched', False))
+    task_function = run_cell if batched else run_simulation
+
+    # Adaptive runs (a target precision is given) simulate in rounds until every cell has converged, with at most
+    # n_iterations realizations per cell
+    sampler = None
+    if getattr(args, 'target_median', None) is not None or getattr(args, 'target_peak', None) is not None:
+        sampler = adaptive_sampler(nH_list,d_list,target_median=getattr(args, 'target_median', None),target_peak=getattr(args, 'target_peak', None),
+                                   min_count=getattr(args, 'min_count', 50),max_count=n_iterations,round_size=getattr(args, 'round_size', 50))
+
+    # Results are appended to the store as tasks finish; tasks already in it (from an interrupted run) are skipped
+    store = open_store(args,n_iterations=n_iterations,store_path=store_path)
+    done = store.done_tasks()
+    if sampler is None:
+        all_args = build_tasks(nH_list,d_list,n_iterations=n_iterations,batched=batched)
+        if done:
+            print(f"Resuming from {store.path}: {len(done)} of {len(all_args)} tasks already done")
+        all_args = [task_prefix + task for task in all_args if task[-1] not in done]
+    else:
+        sampler.resume(store.task_rows())
+        if done:
+            print(f"Resuming from {store.path}: {len(done)} tasks already done")
+
+    if measure_ipc:
+        legacy_task = (nH_list[0], d_list[0], args, 0, initargs[2], correction_file())
+        overhead = measure_task_overhead(legacy_task, (nH_list[0], d_list[0], 0), initargs=initargs)
+        print(f"Per-task IPC: {overhead['legacy_bytes']} -> {overhead['bytes']} pickled bytes, dispatch {overhead['legacy_dispatch_s']*1e6:.0f} -> {overhead['shared_dispatch_s']*1e6:.0f} us")
+
+    # The reduced table is accumulated cell by cell as results arrive (seeded with the results of earlier runs)
+    cells = cell_table(nH_list, d_list, peak_method=getattr(args, 'peak_method', 'histogram'), n_boot=getattr(args, 'n_boot', 200))
+    if done:
+        cells.update_frame(store.to_dataframe())
+    last_partial = [time.monotonic()]
+    profile = run_profile({"instrument": args.instrument, "backend": getattr(args, 'backend', 'xspec'), "batched": batched})
+
+    def run_tasks(tasks):
+        def store_result(index, result):
+            task = tasks[index][len(task_prefix):]
+            store.append(task[-1], task[0], task[1], result)
+            profile.add_realizations(len(result) if isinstance(result, list) else 1)
+            cells.update(result)
+            if partial_interval is not None and time.monotonic() - last_partial[0] > partial_interval:
+                cells.table().to_csv(name+"_partial.csv", index=False)
+                last_partial[0] = time.monotonic()
+        _, timed_out, errored = main(tasks,task_function=task_function,task_timeout=getattr(args, 'task_timeout', 50),initargs=initargs,
+                                     max_retries=getattr(args, 'max_retries', 2),on_result=store_result,scheduler=scheduler,keep_results=False,
+                                     profile=profile,task_offset=len(task_prefix))
+        return timed_out, errored
+
+    timeouts, errors = [], []
+    if not reduce_only and (sampler is not None or all_args):
+        # SLURM sends SIGTERM on preemption/time limit: exit through the store's context so buffered rows are written
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+        # The rounds of an adaptive run share one warm pool
+        own_scheduler = scheduler is None
+        if own_scheduler:
+            scheduler = make_scheduler(task_function,task_timeout=getattr(args, 'task_timeout', 50),initargs=initargs,max_retries=getattr(args, 'max_retries', 2),
+                                       profile_dir=name+"_cprofile" if cprofile_top else None,profile_top=cprofile_top,
+                                       start_method=getattr(args, 'start_method', None),preload=preload_modules(getattr(args, 'backend', 'xspec')))
+            scheduler.start()
+        try:
+            with store:
+                if sampler is None:
+                    timeouts, errors = run_tasks(all_args)
+                else:
+                    round_index = 0
+                    while True:
+                        tasks = [task_prefix + task for task in sampler.next_round(cells, batched=batched)]
+                        if not tasks:
+                            break
+                        round_index += 1
+                        print(f"Round {round_index}: {len(tasks)} tasks for {len({task[len(task_prefix):][:2] for task in tasks})} unconverged cells")
+                        timed_out, errored = run_tasks(tasks)
+                        timeouts += timed_out
+                        errors += errored
+        finally:
+            if own_scheduler:
+                scheduler.close()
+            profile.write(name)
+            if own_scheduler and cprofile_top:
+                kept = prune_profiles(name+"_cprofile", cprofile_top)
+                print(f"cProfile dumps of the {len(kept)} slowest tasks in {name}_cprofile")
+
+    df_red = cells.table()
+    if sampler is not None:
+        status = sampler.status(cells)
+        df_red["converged"] = status["converged"]
+        print(f"{int(status['converged'].sum())} of {len(df_red)} cells converged, {int(status['count'].sum())} realizations")
+    df_red.to_csv(name+".csv", index=False)
+    if os.path.isfile(name+"_partial.csv"):
+        os.remove(name+"_partial.csv")
+
+    # The full table holds everything in the store, including results of earlier (interrupted) runs
+    store.to_dataframe().to_csv(name+"_full.csv", index=False)
+
+    return timeouts, errors
+
+
+if __name__ == "__main__":
+
+    # set_start_method('spawn')
+    # random.seed(42)
 
-    
     parser = argparse.ArgumentParser(description='Tests nH effect for different distance on fake spectra given a gamma, temp, spin (a), mass, inclination (inc), ratio_disk_to_pl, and spectrum exposure')
     parser.add_argument('gamma', type=float)
     parser.add_argument('temp', type=float)
@@ -310,10 +657,42 @@ if __name__ == "__main__":
     parser.add_argument('ratio_disk_to_tot', type=float)
     parser.add_argument('exposure', type=float)
     parser.add_argument('instrument', type=str)
+    parser.add_argument('--backend', type=str, choices=['xspec','numpy'], default='xspec', help='xspec (PyXspec) or numpy (in-process, no HEASoft needed)')
+    parser.add_argument('--batched', action='store_true', help='simulate and fit all iterations of a (nH, d) cell as one task (numpy backend only)')
+    parser.add_argument('--measure-ipc', action='store_true', help='print the pickled bytes and dispatch latency per task with and without the shared correction table')
+    parser.add_argument('--max-retries', type=int, default=2, help='times a timed out or failed task is retried with a new seed')
+    parser.add_argument('--store', type=str, default=None, help='HDF5 result store to append to and resume from (default: results/<instrument>_results/table_..._store.h5)')
+    parser.add_argument('--reduce-only', action='store_true', help='only rebuild the full and reduced tables from the result store, without running the remaining tasks')
+    parser.add_argument('--partial-interval', type=float, default=300, help='seconds between writes of the live reduced table (table_..._partial.csv) during the run')
+    parser.add_argument('--peak-method', type=str, choices=['histogram','kde'], default='histogram', help='estimator of d_fit_peak: histogram with Stone\'s bin rule (default) or FFT kernel density estimate')
+    parser.add_argument('--n-boot', type=int, default=200, help='bootstrap replicates for the d_fit_peak interval (0 to skip)')
+    parser.add_argument('--task-timeout', type=float, default=None, help='seconds to wait for a task (default 50, or 600 with --batched)')
+    parser.add_argument('--target-median', type=float, default=None, help='adaptive sampling: simulate each cell until the half width of the interval of its median d_fit is below this fraction of d')
+    parser.add_argument('--target-peak', type=float, default=None, help='adaptive sampling: simulate each cell until the half width of the bootstrap interval of d_fit_peak is below this fraction of d')
+    parser.add_argument('--min-count', type=int, default=50, help='adaptive sampling: realizations per cell before convergence is checked')
+    parser.add_argument('--max-count', type=int, default=300, help='adaptive sampling: most realizations per cell (the fixed count otherwise)')
+    parser.add_argument('--round-size', type=int, default=50, help='adaptive sampling: fewest realizations an unconverged cell gets per round')
+    parser.add_argument('--error-method', type=str, choices=list(ERROR_METHODS), default='covariance', help='distance interval: covariance (norm interval from the fit covariance, default), montecarlo (distance quantiles of norms drawn from the covariance) or profile (XSPEC Fit.error on every free parameter, slow; the numpy backend uses the covariance)')
+    parser.add_argument('--n-mc', type=int, default=1000, help='montecarlo error method: draws per realization')
+    parser.add_argument('--mass-sigma', type=float, default=0.0, help='montecarlo error method: 1-sigma uncertainty of the mass (solar masses) included in the distance interval')
+    parser.add_argument('--a-sigma', type=float, default=0.0, help='montecarlo error method: 1-sigma uncertainty of the spin')
+    parser.add_argument('--inc-sigma', type=float, default=0.0, help='montecarlo error method: 1-sigma uncertainty of the inclination (degrees)')
+    parser.add_argument('--start-method', type=str, choices=['forkserver','fork','spawn'], default='forkserver', help='how worker processes are started (forkserver: forked from a preloaded template process)')
+    parser.add_argument('--cprofile-top', type=int, default=0, help='keep cProfile dumps of this many slowest tasks (table_..._cprofile/, view with snakeviz or pstats)')
 
     # Parse the argument
     args = parser.parse_args()
 
+    if args.batched and args.backend != 'numpy':
+        parser.error('--batched requires --backend numpy')
+    if args.task_timeout is None:
+        args.task_timeout = 600 if args.batched else 50
+    if args.target_peak is not None and args.n_boot == 0:
+        parser.error('--target-peak needs the bootstrap interval of d_fit_peak (--n-boot > 0)')
+
+    if args.backend == 'xspec':
+        setup_xspec()
+
     d_list = [1,2,3,4,5,6,8,12,18,26]
     nH_list = [0.1,0.5,5,10]
 
@@ -322,63 +701,16 @@ if __name__ == "__main__":
 
     start_time = time.perf_counter()
 
-    all_args = []
-    
     tmp_dir_name = tempfile.mkdtemp(prefix="tmp_", dir="/dev/shm")
     print(f"Created temporary directory: {tmp_dir_name}")
 
-    counter = 0  # Initialize a counter
+    # The correction table and run-wide arguments are given to each worker once (init_worker), not with every task
+    cache_dir = correction_npy_cache()
+    initargs = (cache_dir, args, tmp_dir_name)
 
-    f = correction_file()
+    n_iterations = args.max_count
 
-
-    all_args = []
-    for nH_value in nH_list:
-        for d in d_list: 
-            for iteration in range(300):
-                unique_iteration = counter  # Use the counter as a unique identifier
-                all_args.append((nH_value, d, args, unique_iteration, tmp_dir_name,f))
-                counter += 1
-
-    results, timeouts, errors = main(all_args)
-
-    os.makedirs("results/"+str(args.instrument)+"_results", exist_ok=True)
-    
-    df_full = pd.DataFrame(results)
-    df_full.to_csv("results/"+str(args.instrument)+"_results/table_g"+str(args.gamma)+"_T"+str(args.temp)+"_a"+str(args.a)+"_m"+str(args.mass)+"_i"+str(args.inc)+"_r"+str(args.ratio_disk_to_tot)+"_e"+str(args.exposure)+"_full.csv", index=False)
-    
-    table_red = []
-
-    for nH_value in nH_list:
-        for d in d_list: 
-            filtered_results = [res for res in results if res["d"] == d and res["nH"] == nH_value]
-            df = pd.DataFrame(filtered_results)
-            peak = (find_peak(df['d_fit'].dropna().to_numpy())) if 'd_fit' in df.columns else None
-            peak_flux = (find_peak(df['total_flux'].dropna().to_numpy())) if 'total_flux' in df.columns else None
-            table_red.append({
-                "nH": nH_value,
-                "red_chi_squared": df["red_chi_squared"].median() if 'red_chi_squared' in df.columns else None,
-                "gamma": df["gamma"].median() if 'gamma' in df.columns else None,
-                "power_norm_fake": filtered_results[0]["power_norm_fake"] if filtered_results else None,
-                "power_norm_fit": df["power_norm_fit"].median() if 'power_norm_fit' in df.columns else None,
-                "temp": df["temp"].median() if 'temp' in df.columns else None,
-                "disk_norm_fake": filtered_results[0]["disk_norm_fake"] if filtered_results else None,
-                "disk_norm_fit": df["disk_norm_fit"].median() if 'disk_norm_fit' in df.columns else None,
-                "error_disk_norm": (df["disk_norm_fit"].median() - filtered_results[0]["disk_norm_fake"]) if 'disk_norm_fit' in df.columns and filtered_results else None,
-                "d": d,
-                "d_fit": df["d_fit"].median() if 'd_fit' in df.columns else None,
-                "error_d": (df["d_fit"].median() - filtered_results[0]["d"]) if 'd_fit' in df.columns and filtered_results else None,
-                "frac_uncert": ((df["d_fit"].median() - filtered_results[0]["d"]) / filtered_results[0]["d"]) if 'd_fit' in df.columns and filtered_results else None,
-                "d_fit_peak": peak,
-                "error_d_peak": (peak-d) if peak else None,
-                "frac_uncert_peak": ((peak-d) / d) if peak else None,
-                "med_frac_uncert": df["frac_uncert"].median() if 'frac_uncert' in df.columns else None,
-                "total_flux": df["total_flux"].median() if 'total_flux' in df.columns else None,
-                "peak_flux": peak_flux
-            })
-
-    df_red = pd.DataFrame(table_red)
-    df_red.to_csv("results/"+str(args.instrument)+"_results/table_g"+str(args.gamma)+"_T"+str(args.temp)+"_a"+str(args.a)+"_m"+str(args.mass)+"_i"+str(args.inc)+"_r"+str(args.ratio_disk_to_tot)+"_e"+str(args.exposure)+".csv", index=False)
+    timeouts, errors = run_configuration(args,nH_list,d_list,n_iterations=n_iterations,initargs=initargs,store_path=args.store,reduce_only=args.reduce_only,measure_ipc=args.measure_ipc,partial_interval=args.partial_interval,cprofile_top=args.cprofile_top)
 
     command = f'rm -rf '+tmp_dir_name
     process = subprocess.Popen(command, shell=True)
@@ -388,4 +720,4 @@ if __name__ == "__main__":
     total_time = end_time - start_time
     print(f"The script took {total_time} seconds to complete.")
     print("Timed Out:", timeouts)
-    print("Errored:", errors)
\ No newline at end of file
+    print("Errored:", errors)
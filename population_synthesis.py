@@ -0,0 +1,306 @@
+import argparse
+import os
+import time
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool, cpu_count
+from interpolation import axis_weights
+
+# Distance grid (kpc) of the *_density.npy files (pair_visualize.ipynb)
+DISTANCE_GRID = np.linspace(0.215, 40, 3979)
+
+# Galactic model of Grimm, Gilfanov & Sunyaev (2002, GR02): bulge, disc (with a central hole) and spheroid, with the
+# parameters and relative normalizations used in compare_theory_distributions.ipynb. Lengths in kpc.
+GR02 = {
+    'bulge': {'rho0': 1.19, 'q': 0.6, 'r0': 1.0, 'rt': 1.9, 'gamma': 1.8},
+    'disc': {'rho0': 2.79, 'rm': 6.5, 'rd': 3.5, 'rz': 0.41},
+    'spheroid': {'rho0': 22.38, 'Re': 2.8, 'b': 7.669},
+}
+
+# Galactocentric distance of the Sun (kpc), as in compare_theory_distributions.ipynb
+SUN_DISTANCE = 8.5
+
+# Plane-parallel gas layer for the absorption column: midplane density (cm^-3) and scale height (kpc)
+GAS_DENSITY = 1.0
+GAS_SCALE_HEIGHT = 0.15
+KPC_CM = 3.0857e21
+
+# Instruments with a flux-limited selection; 'all' applies no selection and no distance bias. Their flux limit and
+# absorption e-folding column depend on the survey being modelled and are given with every run (flux_limit and
+# nH_efold of synthesize, --flux-limit and --nH-efold).
+INSTRUMENTS = ('maxi', 'xrt')
+
+# Soft state luminosities (erg/s), drawn log-uniformly
+LUMINOSITY_RANGE = (2e37, 3e38)
+
+
+def density_bulge(r,z,p=GR02['bulge']):
+    """
+    GR02 bulge: rho0 (sqrt(r^2 + z^2/q^2)/r0)^-gamma exp(-(r^2 + z^2/q^2)/rt^2), r the cylindrical radius (kpc).
+    """
+    m2 = r**2 + (z / p['q'])**2
+    return p['rho0'] * (np.sqrt(m2) / p['r0'])**(-p['gamma']) * np.exp(-m2 / p['rt']**2)
+
+
+def density_disc(r,z,p=GR02['disc']):
+    """
+    GR02 disc: rho0 exp(-(rm/r)^3 - r/rd - |z|/rz).
+    """
+    with np.errstate(divide='ignore', over='ignore'):
+        return p['rho0'] * np.exp(-(p['rm'] / r)**3 - r / p['rd'] - np.abs(z) / p['rz'])
+
+
+def density_spheroid(r,z,p=GR02['spheroid']):
+    """
+    GR02 spheroid: rho0 exp(-b (R/Re)^(1/4)) / (R/Re)^(7/8), R the spherical radius.
+    """
+    x = np.sqrt(r**2 + z**2) / p['Re']
+    return p['rho0'] * np.exp(-p['b'] * x**0.25) / x**(7/8)
+
+
+COMPONENTS = {'bulge': density_bulge, 'disc': density_disc, 'spheroid': density_spheroid}
+
+
+class component_sampler:
+
+    def __init__(self,density,params,r_max=25.0,z_max=5.0,n_r=1000,n_z=800):
+        '''
+        Samples (r, z) of an axisymmetric density by inverting the cumulative mass of an (r, z) grid: a cell is
+        picked by its mass (density at the cell centre x 2 pi r dr dz) and the point is drawn within the cell
+        (uniform in r^2 and z, i.e. uniform in volume).
+
+        Arguments:
+        density: function (r, z, params) -> density
+        r_max, z_max: extent of the grid (kpc); mass beyond it is ignored
+        n_r, n_z: grid cells in r and z
+        '''
+        self.r_edges = np.linspace(0, r_max, n_r + 1)
+        self.z_edges = np.linspace(-z_max, z_max, n_z + 1)
+        r = (self.r_edges[:-1] + self.r_edges[1:]) / 2
+        z = (self.z_edges[:-1] + self.z_edges[1:]) / 2
+        mass = density(r[:, None], z[None, :], params) * (np.pi * np.diff(self.r_edges**2))[:, None] * np.diff(self.z_edges)[None, :]
+        self.cumulative = np.cumsum(mass.ravel())
+        self.mass = self.cumulative[-1]
+        self.n_z = n_z
+
+    def sample(self,n,rng):
+        cell = np.searchsorted(self.cumulative, rng.random(n) * self.mass, side='right')
+        i, j = np.divmod(np.minimum(cell, len(self.cumulative) - 1), self.n_z)
+        r_lo, r_hi = self.r_edges[i], self.r_edges[i + 1]
+        r = np.sqrt(r_lo**2 + rng.random(n) * (r_hi**2 - r_lo**2))
+        z = self.z_edges[j] + rng.random(n) * (self.z_edges[j + 1] - self.z_edges[j])
+        return r, z
+
+
+class galaxy_model:
+
+    def __init__(self,params=GR02,components=('bulge','disc','spheroid'),**grid):
+        '''
+        Mixture of the GR02 components, each weighted by its mass. sample() returns Galactocentric Cartesian
+        positions (kpc) with the Sun at (0, SUN_DISTANCE, 0).
+        '''
+        self.samplers = [component_sampler(COMPONENTS[name], params[name], **grid) for name in components]
+        masses = np.array([sampler.mass for sampler in self.samplers])
+        self.weights = masses / masses.sum()
+        self.components = components
+
+    def sample(self,n,rng):
+        counts = rng.multinomial(n, self.weights)
+        r, z = np.empty(n), np.empty(n)
+        start = 0
+        for sampler, count in zip(self.samplers, counts):
+            r[start:start + count], z[start:start + count] = sampler.sample(count, rng)
+            start += count
+        phi = rng.random(n) * 2 * np.pi
+        return r * np.cos(phi), r * np.sin(phi), z
+
+
+def heliocentric_distance(x,y,z,sun_distance=SUN_DISTANCE):
+    return np.sqrt(x**2 + (y - sun_distance)**2 + z**2)
+
+
+def column_density(d,z,gas_density=GAS_DENSITY,scale_height=GAS_SCALE_HEIGHT):
+    """
+    nH (1e22 cm^-2) to a source at distance d and height z (kpc) through a plane-parallel gas layer
+    n0 exp(-|z|/h) seen from the midplane: n0 d h (1 - exp(-|z|/h)) / |z|, which tends to n0 d for z -> 0.
+    """
+    x = np.abs(z) / scale_height
+    with np.errstate(divide='ignore', invalid='ignore'):
+        path = np.where(x > 1e-8, -np.expm1(-x) / x, 1.0)
+    return gas_density * d * path * KPC_CM / 1e22
+
+
+def detected(d,nH,rng,flux_limit,nH_efold,luminosity_range=LUMINOSITY_RANGE):
+    """
+    Flux-limited selection: sources with a log-uniform soft state luminosity, absorbed by exp(-nH/nH_efold), that
+    are brighter than flux_limit.
+    """
+    log_l = rng.uniform(np.log10(luminosity_range[0]), np.log10(luminosity_range[1]), len(d))
+    flux = 10**log_l / (4 * np.pi * (d * KPC_CM)**2) * np.exp(-nH / nH_efold)
+    return flux >= flux_limit
+
+
+class table_bias:
+
+    def __init__(self,path,bias_column='frac_uncert_peak',scatter_column='med_frac_uncert'):
+        '''
+        Distance bias and scatter from a reduced result table of observational_effects.py (table_..._e<exposure>.csv):
+        the fractional bias of the distance peak and the median fractional uncertainty per (nH, d) cell, interpolated
+        in log nH and log d (clamped to the grid). Cells without a distance estimate are NaN, and sources there
+        drop out of the selection.
+        '''
+        df = pd.read_csv(path)
+        self.nH = np.unique(df['nH'].values)
+        self.d = np.unique(df['d'].values)
+        index = pd.MultiIndex.from_product([self.nH, self.d])
+        frame = df.set_index(['nH', 'd'])
+        self.bias = frame[bias_column].reindex(index).values.reshape(len(self.nH), len(self.d))
+        self.scatter = np.abs(frame[scatter_column].reindex(index).values.reshape(len(self.nH), len(self.d)))
+
+    def __call__(self,d,nH):
+        w_nH = axis_weights(self.nH, np.maximum(nH, 1e-6), log=True)[0]
+        w_d = axis_weights(self.d, d, log=True)[0]
+        # A cell without an estimate only counts where it has weight
+        missing = np.einsum('ni,nj,ij->n', w_nH, w_d, (np.isnan(self.bias) | np.isnan(self.scatter)).astype(float)) > 0
+        bias = np.einsum('ni,nj,ij->n', w_nH, w_d, np.nan_to_num(self.bias))
+        scatter = np.einsum('ni,nj,ij->n', w_nH, w_d, np.nan_to_num(self.scatter))
+        bias[missing] = np.nan
+        scatter[missing] = np.nan
+        return bias, scatter
+
+
+def histogram_edges(grid=DISTANCE_GRID):
+    """
+    Bin edges centred on the grid points.
+    """
+    step = np.diff(grid)
+    return np.concatenate(([grid[0] - step[0] / 2], grid[:-1] + step / 2, [grid[-1] + step[-1] / 2]))
+
+
+# Per-process state of the synthesis workers (filled by _init_synthesis)
+_synthesis_state = {}
+
+def _init_synthesis(settings):
+    _synthesis_state.update(settings)
+    _synthesis_state['model'] = galaxy_model(settings['params'], settings['components'])
+    _synthesis_state['edges'] = histogram_edges(settings['grid'])
+
+
+def _synthesize_chunk(job):
+    """
+    Samples one chunk and returns (realization, counts per distance bin, number of sources sampled, number selected).
+    """
+    realization, n, seed = job
+    state = _synthesis_state
+    rng = np.random.default_rng(seed)
+    x, y, z = state['model'].sample(n, rng)
+    d = heliocentric_distance(x, y, z, state['sun_distance'])
+    selection = state['selection']
+    if selection is not None:
+        nH = column_density(d, z, state['gas_density'], state['scale_height'])
+        keep = detected(d, nH, rng, selection['flux_limit'], selection['nH_efold'], state['luminosity_range'])
+        d, nH = d[keep], nH[keep]
+        if state['bias'] is not None:
+            bias, scatter = state['bias'](d, nH)
+            estimated = np.isfinite(bias) & np.isfinite(scatter)
+            d = d[estimated] * (1 + bias[estimated]) * np.exp(scatter[estimated] * rng.standard_normal(np.count_nonzero(estimated)))
+    edges = state['edges']
+    bins = np.searchsorted(edges, d, side='right') - 1
+    inside = (bins >= 0) & (bins < len(edges) - 1)
+    return realization, np.bincount(bins[inside], minlength=len(edges) - 1), n, len(d)
+
+
+def synthesize(n_samples,instrument='all',flux_limit=None,nH_efold=None,n_realizations=1,chunk_size=1000000,
+               processes=None,seed=0,params=GR02,components=('bulge','disc','spheroid'),bias=None,grid=DISTANCE_GRID,
+               sun_distance=SUN_DISTANCE,gas_density=GAS_DENSITY,scale_height=GAS_SCALE_HEIGHT,
+               luminosity_range=LUMINOSITY_RANGE):
+    """
+    Distance distribution of a synthetic BH-LMXB population: n_samples sources per realization are drawn from the
+    Galactic model in chunks of at most chunk_size (so memory does not grow with n_samples), put through the
+    selection of the instrument and the distance bias, and binned on the distance grid. Chunks run on processes
+    worker processes; every chunk has its own seed from np.random.SeedSequence(seed), so a run is reproducible for
+    the same seed, n_samples and chunk_size whatever the number of processes.
+
+    Args:
+        n_samples (int): Sources drawn per realization (before selection).
+        instrument (str): 'maxi' or 'xrt' (flux-limited selection) or 'all' (every source, true distances).
+        flux_limit (float): Flux limit (erg/cm^2/s) of the selection; required unless instrument is 'all'.
+        nH_efold (float): Column (1e22 cm^-2) over which absorption reduces the band flux of the instrument by 1/e;
+            required unless instrument is 'all'.
+        n_realizations (int): Independent realizations, e.g. for error bands.
+        bias (callable, optional): (d, nH) -> (fractional bias, fractional scatter) of the measured distance, e.g. a
+            table_bias. Without it the selected sources keep their true distances.
+        processes (int, optional): Worker processes (default: all cores).
+
+    Returns:
+        dict: 'density' (mean over realizations, per kpc: sum(density * np.gradient(grid)) is 1, so sources beyond
+        the grid are left out of the normalization), 'realizations' (n_realizations x len(grid) densities), 'counts'
+        (binned sources per realization), 'n_samples' and 'n_selected' per realization. The shipped *_density.npy
+        files share the grid but not this normalization: they are exponential fits to histograms of measured
+        distances (pair_visualize.ipynb) and integrate to about 4.4 (all, xrt) and 3.9 (maxi) over the grid.
+    """
+    if instrument != 'all' and instrument not in INSTRUMENTS:
+        raise ValueError('instrument must be one of all, %s' % ', '.join(INSTRUMENTS))
+    if instrument != 'all' and (flux_limit is None or nH_efold is None):
+        raise ValueError('the %s selection needs flux_limit and nH_efold' % instrument)
+    selection = {'flux_limit': flux_limit, 'nH_efold': nH_efold} if instrument != 'all' else None
+    settings = {'params': params, 'components': components, 'grid': np.asarray(grid), 'sun_distance': sun_distance,
+                'gas_density': gas_density, 'scale_height': scale_height, 'luminosity_range': luminosity_range,
+                'selection': selection, 'bias': bias if instrument != 'all' else None}
+    sizes = [chunk_size] * (n_samples // chunk_size) + ([n_samples % chunk_size] if n_samples % chunk_size else [])
+    seeds = np.random.SeedSequence(seed).spawn(n_realizations * len(sizes))
+    jobs = [(k, n, seeds[k * len(sizes) + i]) for k in range(n_realizations) for i, n in enumerate(sizes)]
+
+    counts = np.zeros((n_realizations, len(grid)), dtype=np.int64)
+    sampled = np.zeros(n_realizations, dtype=np.int64)
+    selected = np.zeros(n_realizations, dtype=np.int64)
+    processes = processes if processes else cpu_count()
+    if processes == 1:
+        _init_synthesis(settings)
+        chunks = map(_synthesize_chunk, jobs)
+        pool = None
+    else:
+        pool = Pool(processes=processes, initializer=_init_synthesis, initargs=(settings,))
+        chunks = pool.imap_unordered(_synthesize_chunk, jobs)
+    try:
+        for realization, chunk_counts, n, n_selected in chunks:
+            counts[realization] += chunk_counts
+            sampled[realization] += n
+            selected[realization] += n_selected
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    step = np.gradient(np.asarray(grid, dtype=float))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        realizations = counts / (counts.sum(axis=1, keepdims=True) * step)
+    return {'density': np.nanmean(realizations, axis=0), 'realizations': realizations, 'counts': counts,
+            'n_samples': sampled, 'n_selected': selected}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Synthesizes the distance distribution of Galactic BH-LMXBs (GR02 bulge, disc and spheroid) for an instrument and writes it in the format of the *_density.npy files')
+    parser.add_argument('instrument', type=str, choices=['all'] + list(INSTRUMENTS))
+    parser.add_argument('--flux-limit', type=float, default=None, help='flux limit (erg/cm^2/s) of the selection, required unless instrument is all')
+    parser.add_argument('--nH-efold', type=float, default=None, help='column (1e22 cm^-2) over which absorption reduces the band flux by 1/e, required unless instrument is all')
+    parser.add_argument('--n-samples', type=float, default=1e7, help='sources drawn per realization')
+    parser.add_argument('--n-realizations', type=int, default=1, help='independent realizations (written to <output>_realizations.npy when > 1)')
+    parser.add_argument('--chunk-size', type=float, default=1e6, help='sources per chunk (sets the memory per worker)')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--bias-table', type=str, default=None, help='reduced result table (table_..._e<exposure>.csv) with the distance bias per (nH, d)')
+    parser.add_argument('--output', type=str, default=None, help='output .npy (default <instrument>_synthetic_density.npy)')
+    args = parser.parse_args()
+    if args.instrument != 'all' and (args.flux_limit is None or args.nH_efold is None):
+        parser.error('the %s selection needs --flux-limit and --nH-efold' % args.instrument)
+
+    start_time = time.perf_counter()
+    result = synthesize(int(args.n_samples), args.instrument, args.flux_limit, args.nH_efold, n_realizations=args.n_realizations, chunk_size=int(args.chunk_size),
+                        processes=args.processes, seed=args.seed, bias=table_bias(args.bias_table) if args.bias_table else None)
+    output = args.output if args.output else args.instrument + '_synthetic_density.npy'
+    np.save(output, result['density'])
+    if args.n_realizations > 1:
+        np.save(os.path.splitext(output)[0] + '_realizations.npy', result['realizations'])
+    print(f"{int(result['n_selected'].sum())} of {int(result['n_samples'].sum())} sources selected, density written to {output} ({time.perf_counter() - start_time:.1f} s)")
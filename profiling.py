@@ -0,0 +1,193 @@
+import heapq
+import json
+import os
+import time
+from collections import defaultdict
+import numpy as np
+
+# Per-process totals of the stages timed during the current task (read and reset by collect)
+_stages = defaultdict(float)
+
+# Edges (s) of the latency histograms: 4 logarithmic bins per decade from 0.1 ms to 1000 s
+HISTOGRAM_EDGES = np.logspace(-4, 3, 29)
+
+
+class stage_timer:
+
+    def __init__(self):
+        '''
+        Times consecutive stages of a task with one perf_counter call per stage: lap(name) adds the time since
+        the previous lap (or since the timer was created) to the stage name of this process, so the worker can
+        report it with the result of the task (see collect).
+        '''
+        self.last = time.perf_counter()
+
+    def lap(self,stage):
+        now = time.perf_counter()
+        _stages[stage] += now - self.last
+        self.last = now
+
+    def skip(self):
+        '''
+        Starts the next stage now, without recording the time since the previous lap (for a call that times its
+        own stages, e.g. the run of a simulation object).
+        '''
+        self.last = time.perf_counter()
+
+
+def collect():
+    """
+    Returns the stage times recorded since the last call (dictionary {stage: seconds}) and resets them.
+    """
+    stages = dict(_stages)
+    _stages.clear()
+    return stages
+
+
+class slowest_profiles:
+
+    def __init__(self,profile_dir,n):
+        '''
+        Keeps cProfile dumps of the n slowest tasks a worker ran in profile_dir (file names start with the duration,
+        so the n slowest of all workers can be selected afterwards, see prune_profiles).
+        '''
+        self.profile_dir = profile_dir
+        self.n = n
+        self.heap = []
+        os.makedirs(profile_dir, exist_ok=True)
+
+    def add(self,profiler,duration,index):
+        if len(self.heap) == self.n and duration <= self.heap[0][0]:
+            return
+        path = os.path.join(self.profile_dir, 'task_%011.4fs_%d_%d.prof' % (duration, index, os.getpid()))
+        profiler.dump_stats(path)
+        heapq.heappush(self.heap, (duration, path))
+        if len(self.heap) > self.n:
+            _, evicted = heapq.heappop(self.heap)
+            if os.path.isfile(evicted):
+                os.remove(evicted)
+
+
+def prune_profiles(profile_dir,n):
+    """
+    Deletes all but the n slowest cProfile dumps in profile_dir and returns the paths that are kept.
+    """
+    if not os.path.isdir(profile_dir):
+        return []
+    paths = sorted((os.path.join(profile_dir, name) for name in os.listdir(profile_dir) if name.endswith('.prof')), reverse=True)
+    for path in paths[n:]:
+        os.remove(path)
+    return paths[:n]
+
+
+def latency_summary(seconds):
+    """
+    Count, mean, percentiles and the histogram (counts in HISTOGRAM_EDGES bins) of a list of durations.
+    """
+    seconds = np.asarray(seconds, dtype=float)
+    if len(seconds) == 0:
+        return {'count': 0}
+    p50, p90, p99 = np.percentile(seconds, [50, 90, 99])
+    counts, _ = np.histogram(np.clip(seconds, HISTOGRAM_EDGES[0], HISTOGRAM_EDGES[-1]), bins=HISTOGRAM_EDGES)
+    return {'count': len(seconds), 'total': float(seconds.sum()), 'mean': float(seconds.mean()), 'p50': float(p50), 'p90': float(p90),
+            'p99': float(p99), 'max': float(seconds.max()), 'histogram': counts.tolist()}
+
+
+class run_profile:
+
+    def __init__(self,run_params=None):
+        '''
+        Collects the timing reports of the tasks of one run (see task_scheduler.run, on_timing) and the scheduler
+        reports, and writes the throughput profile: per-task rows (CSV) and a summary with per-stage and per-cell
+        latency histograms, tasks/sec per core, worker utilisation, the cold and warm start of every worker and the
+        worker seconds per realization (JSON). The summary also keeps run_params (e.g. instrument, backend and
+        batched), which sweep.py uses to estimate the cost of configurations from earlier runs.
+        '''
+        self.run_params = dict(run_params or {})
+        self.realizations = 0
+        self.rows = []
+        self.workers = []
+        self.elapsed = 0.0
+        self.busy = 0.0
+        self.worker_seconds = 0.0
+        self.cells = defaultdict(lambda: {'completed': 0, 'timed_out': 0, 'errored': 0, 'retries': 0})
+
+    def add(self,task,info):
+        '''
+        Adds the timing of one completed task: task is the task tuple (nH, d, ...), info the dictionary from the
+        scheduler ('wall' and 'cpu' time in the worker, 'stages', and the 'dispatched'/'received' times).
+        '''
+        row = {'task_id': task[-1], 'nH': task[0], 'd': task[1], 'attempt': info['attempt'], 'pid': info['pid'], 'first': bool(info.get('first', False)),
+               'wall': info['wall'], 'cpu': info['cpu'], 'ipc': max(info['received'] - info['dispatched'] - info['wall'], 0.0)}
+        row.update({'stage_' + stage: seconds for stage, seconds in info['stages'].items()})
+        self.rows.append(row)
+
+    def add_realizations(self,n):
+        '''
+        Counts the realizations returned by a completed task (one, or the cell of a batched task).
+        '''
+        self.realizations += n
+
+    def add_report(self,report):
+        '''
+        Adds a scheduler report (one per scheduler.run call, e.g. per round of an adaptive run).
+        '''
+        self.elapsed += report['elapsed']
+        self.busy += report['busy']
+        self.worker_seconds += report['elapsed'] * report['processes']
+        self.workers += report.get('workers', [])
+        for cell, counts in report['cells'].items():
+            for key, value in counts.items():
+                self.cells[cell][key] += value
+
+    def worker_starts(self):
+        '''
+        One row per worker started during the run: the seconds from process start to ready ('startup', of which
+        'init' in the initializer), whether it replaced another worker ('restart'), the wall time of its first
+        (cold) task and the median wall time of its later (warm) tasks.
+        '''
+        import pandas as pd
+        df = self.tasks()
+        rows = []
+        for start in self.workers:
+            wall = df.loc[df['pid'] == start['pid']] if len(df) else df
+            rows.append(dict(start, cold_task=wall.loc[wall['first'], 'wall'].max() if len(wall) else np.nan,
+                             warm_task=wall.loc[~wall['first'], 'wall'].median() if len(wall) else np.nan))
+        return pd.DataFrame(rows, columns=['pid', 'restart', 'startup', 'init', 'cold_task', 'warm_task'])
+
+    def tasks(self):
+        import pandas as pd
+        return pd.DataFrame(self.rows)
+
+    def summary(self):
+        df = self.tasks()
+        stages = sorted(column[len('stage_'):] for column in df.columns if column.startswith('stage_'))
+        summary = {
+            'histogram_edges': HISTOGRAM_EDGES.tolist(),
+            'tasks': len(df),
+            'elapsed': self.elapsed,
+            'tasks_per_second': len(df) / self.elapsed if self.elapsed else None,
+            'tasks_per_second_per_core': len(df) / self.worker_seconds if self.worker_seconds else None,
+            'worker_utilisation': self.busy / self.worker_seconds if self.worker_seconds else None,
+            'run': self.run_params,
+            'realizations': self.realizations,
+            'seconds_per_realization': float(df['wall'].sum()) / self.realizations if self.realizations and len(df) else None,
+            'task': latency_summary(df['wall']) if len(df) else {'count': 0},
+            'ipc': latency_summary(df['ipc']) if len(df) else {'count': 0},
+            'stages': {stage: latency_summary(df['stage_' + stage].dropna()) for stage in stages},
+            'workers': self.worker_starts().to_dict('records'),
+            'cells': [],
+        }
+        for cell in sorted(set(self.cells) | set(zip(df['nH'], df['d'])) if len(df) else self.cells):
+            wall = df.loc[(df['nH'] == cell[0]) & (df['d'] == cell[1]), 'wall'] if len(df) else []
+            summary['cells'].append(dict({'nH': cell[0], 'd': cell[1]}, **self.cells.get(cell, {}), **latency_summary(wall)))
+        return summary
+
+    def write(self,prefix):
+        '''
+        Writes prefix + '_profile.csv' (one row per completed task, stage columns in seconds) and
+        prefix + '_profile.json' (summary).
+        '''
+        self.tasks().to_csv(prefix + '_profile.csv', index=False)
+        with open(prefix + '_profile.json', 'w') as fh:
+            json.dump(self.summary(), fh, indent=1, default=float)
@@ -0,0 +1,208 @@
+import glob
+import os
+import time
+import numpy as np
+import pandas as pd
+import h5py
+
+# Columns of the result dictionaries returned by run_simulation/run_cell (None is stored as NaN)
+RESULT_COLUMNS = ("nH", "d", "red_chi_squared", "gamma", "power_norm_fake", "power_norm_fit", "temp", "disk_norm_fake",
+                  "disk_norm_fit", "error_disk_norm_low", "error_disk_norm_up", "d_fit", "error_d_low", "error_d_up",
+                  "frac_uncert", "total_flux")
+
+ROW_COLUMNS = ('row_id',) + RESULT_COLUMNS
+TASK_COLUMNS = ('task_id', 'nH', 'd', 'n_rows')
+
+# Attributes of the main file that are not run parameters
+STORE_ATTRS = ('n_rows', 'n_tasks', 'batches')
+
+
+def write_atomic(path,rows,tasks,attrs):
+    '''
+    Writes a complete store file (groups 'rows' and 'tasks' with one column each, and attributes) to a temporary
+    file and renames it to path with os.replace, so path holds either the previous file or the new one.
+    '''
+    tmp = path + '.tmp'
+    with h5py.File(tmp, 'w') as fh:
+        fh.attrs.update(attrs)
+        fh.attrs['n_rows'] = len(rows)
+        fh.attrs['n_tasks'] = len(tasks)
+        for group, columns, data in (('rows', ROW_COLUMNS, rows), ('tasks', TASK_COLUMNS, tasks)):
+            grp = fh.create_group(group)
+            for i, column in enumerate(columns):
+                dtype = 'i8' if column in ('row_id', 'task_id', 'n_rows') else 'f8'
+                grp.create_dataset(column, data=data[:, i].astype(dtype))
+    with open(tmp, 'rb+') as fh:
+        os.fsync(fh.fileno())
+    os.replace(tmp, path)
+
+
+def read_columns(path):
+    '''
+    Returns the rows (n, len(ROW_COLUMNS)) and tasks (m, len(TASK_COLUMNS)) of a store or batch file as float arrays.
+    '''
+    with h5py.File(path, 'r') as fh:
+        n_rows, n_tasks = int(fh.attrs['n_rows']), int(fh.attrs['n_tasks'])
+        rows = np.column_stack([fh['rows'][column][:n_rows] for column in ROW_COLUMNS]).astype(float)
+        tasks = np.column_stack([fh['tasks'][column][:n_tasks] for column in TASK_COLUMNS]).astype(float)
+    return rows.reshape(n_rows, len(ROW_COLUMNS)), tasks.reshape(n_tasks, len(TASK_COLUMNS))
+
+
+def batch_files(path):
+    '''
+    Sorted (index, path) of the batch files of a store that are not merged into its main file yet.
+    '''
+    with h5py.File(path, 'r') as fh:
+        merged = int(fh.attrs.get('batches', 0))
+    files = []
+    for filename in glob.glob(os.path.join(path + '.batches', '*.h5')):
+        index = int(os.path.basename(filename)[:-3])
+        if index > merged:
+            files.append((index, filename))
+    return sorted(files)
+
+
+def read_store(path,attempts=3):
+    '''
+    Returns the rows and tasks of a store: its main file and the batch files not merged into it yet. Reading does not
+    modify the store, so it can be done while another process writes it (a batch file merged and deleted meanwhile
+    is read again from the main file).
+    '''
+    for attempt in range(attempts):
+        try:
+            parts = [read_columns(path)] + [read_columns(filename) for _, filename in batch_files(path)]
+            return np.concatenate([rows for rows, _ in parts]), np.concatenate([tasks for _, tasks in parts])
+        except FileNotFoundError:
+            if attempt == attempts - 1:
+                raise
+
+
+class result_store:
+
+    def __init__(self,path,run_params,flush_every=500,flush_interval=60):
+        '''
+        Appendable HDF5 store for the per-realization results of one observational_effects.py run. Results are
+        buffered and written in batches while the run is going, so a preempted or killed job only loses the last
+        unflushed batch, and a restarted job can skip the tasks that are already in the store.
+
+        Layout: the file at path holds the run parameters as attributes and the merged results, one column per
+        result key plus 'row_id' (realization id) in the group 'rows', and 'task_id', 'nH', 'd' and 'n_rows' in the
+        group 'tasks'. Each flush writes its batch as a new file with the same groups in path + '.batches/', and no
+        file is ever modified in place: every file is written under a temporary name and renamed with os.replace,
+        so a job killed while writing leaves the previous files intact and at most a stray .tmp file. The batches
+        are merged into the main file when the store is opened again and when its context exits; the main file
+        records the last merged batch ('batches' attribute), so batch files left over by a kill during the merge
+        are not counted twice.
+
+        Arguments:
+        path: .h5 file, created if it does not exist
+        run_params: dictionary of the run-wide parameters (gamma, temp, a, mass, inc, ratio, exposure, instrument,
+                    backend, ...); an existing store written with other values raises a ValueError
+        flush_every: number of buffered rows that triggers a write
+        flush_interval: seconds after which buffered rows are written even if flush_every is not reached
+        '''
+        self.path = path
+        self.batch_dir = path + '.batches'
+        self.run_params = {key: (str(value) if not isinstance(value, (int, float, bool, np.number)) else value) for key, value in run_params.items()}
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._rows = []
+        self._tasks = []
+        self._last_flush = time.monotonic()
+
+        for tmp in glob.glob(path + '.tmp') + glob.glob(os.path.join(self.batch_dir, '*.tmp')):
+            os.remove(tmp)
+        if os.path.isfile(path):
+            with h5py.File(path, 'r') as fh:
+                stored = {key: (value.decode() if isinstance(value, bytes) else value) for key, value in fh.attrs.items() if key not in STORE_ATTRS}
+            mismatched = [key for key in self.run_params if key in stored and stored[key] != self.run_params[key]]
+            if mismatched:
+                raise ValueError("Result store %s was written with different %s; use another file or remove it." % (path, ", ".join(mismatched)))
+            self.merge()
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            write_atomic(path, np.zeros((0, len(ROW_COLUMNS))), np.zeros((0, len(TASK_COLUMNS))), dict(self.run_params, batches=0))
+        os.makedirs(self.batch_dir, exist_ok=True)
+        self._next_batch = max([self._merged_batches()] + [index for index, _ in batch_files(self.path)]) + 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.flush()
+        self.merge()
+
+    def _merged_batches(self):
+        with h5py.File(self.path, 'r') as fh:
+            return int(fh.attrs.get('batches', 0))
+
+    def merge(self):
+        '''
+        Merges the batch files into the main file (rewritten under a temporary name and swapped in with os.replace)
+        and deletes them, and every batch file that was already merged.
+        '''
+        batches = batch_files(self.path)
+        if batches:
+            rows, tasks = read_store(self.path)
+            with h5py.File(self.path, 'r') as fh:
+                attrs = {key: value for key, value in fh.attrs.items() if key not in STORE_ATTRS}
+            write_atomic(self.path, rows, tasks, dict(attrs, batches=batches[-1][0]))
+        merged = self._merged_batches()
+        for path in glob.glob(os.path.join(self.batch_dir, '*.h5')):
+            if int(os.path.basename(path)[:-3]) <= merged:
+                os.remove(path)
+
+    def done_tasks(self):
+        '''
+        Returns the set of task ids whose results are in the store.
+        '''
+        _, tasks = read_store(self.path)
+        return set(tasks[:, 0].astype(int).tolist()) | {task[0] for task in self._tasks}
+
+    def task_rows(self):
+        '''
+        Returns a dictionary {task id: number of rows} of the tasks in the store.
+        '''
+        _, tasks = read_store(self.path)
+        rows = dict(zip(tasks[:, 0].astype(int).tolist(), tasks[:, 3].astype(int).tolist()))
+        rows.update({task[0]: task[3] for task in self._tasks})
+        return rows
+
+    def append(self,task_id,nH,d,result,first_row_id=None):
+        '''
+        Buffers the results of one finished task (a result dictionary, or a list of them for a batched cell) and
+        writes the buffer when it is large or old enough. Row ids are first_row_id, first_row_id + 1, ...
+        (default: task_id).
+        '''
+        results = result if isinstance(result, list) else [result]
+        first_row_id = task_id if first_row_id is None else first_row_id
+        for k, res in enumerate(results):
+            self._rows.append([first_row_id + k] + [np.nan if res.get(column) is None else res[column] for column in RESULT_COLUMNS])
+        self._tasks.append((task_id, nH, d, len(results)))
+        if len(self._rows) >= self.flush_every or time.monotonic() - self._last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes the buffered rows and tasks as the next batch file (complete or absent on disk, see write_atomic).
+        '''
+        self._last_flush = time.monotonic()
+        if not self._tasks:
+            return
+        rows = np.array(self._rows, dtype=float).reshape(len(self._rows), len(ROW_COLUMNS))
+        tasks = np.array(self._tasks, dtype=float)
+        write_atomic(os.path.join(self.batch_dir, '%08d.h5' % self._next_batch), rows, tasks, {})
+        self._next_batch += 1
+        self._rows = []
+        self._tasks = []
+
+    def to_dataframe(self):
+        '''
+        Returns all flushed results as a DataFrame with the columns of the _full.csv table, sorted by realization id
+        (the order a complete run without restarts produces).
+        '''
+        self.flush()
+        rows, _ = read_store(self.path)
+        order = np.argsort(rows[:, 0], kind='stable')
+        df = pd.DataFrame({column: rows[order, i + 1] for i, column in enumerate(RESULT_COLUMNS)})
+        return df.reset_index(drop=True)
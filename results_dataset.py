@@ -0,0 +1,306 @@
+import argparse
+import glob
+import json
+import os
+import re
+import shutil
+import numpy as np
+import pandas as pd
+
+# Parameters of a configuration, named as in bias_emulator.VARIABLES, in the order of the table file names
+PARAMETERS = ('g', 'T', 'a', 'm', 'i', 'r', 'e')
+
+# table_g.._T.._a.._m.._i.._r.._e<exposure>.csv (reduced) and ..._full.csv (full), with _<backend> after the exposure
+# for backends other than XSPEC (observational_effects.table_name); _partial, _profile and _store files do not match
+FILE_PATTERN = re.compile(r'table_g(?P<g>[^_]+)_T(?P<T>[^_]+)_a(?P<a>[^_]+)_m(?P<m>[^_]+)_i(?P<i>[^_]+)_r(?P<r>[^_]+)_e(?P<e>[0-9.eE+-]+?)(?:_(?P<backend>numpy|fake))?(?P<full>_full)?\.csv$')
+
+# Backend of the tables without a backend in their name
+DEFAULT_BACKEND = 'xspec'
+
+TABLES = ('full', 'reduced')
+MANIFEST = 'manifest.json'
+DATASET_VERSION = 1
+
+# Columns are raw little-endian arrays, so that R can read them with readBin (see README)
+VALUE_DTYPE = '<f8'
+INSTRUMENT_DTYPE = '<i4'
+
+
+def parse_table_name(filename):
+    """
+    (table, parameters, instrument, backend) of a result table file name, or None if it is not a full or reduced
+    table.
+    """
+    match = FILE_PATTERN.search(os.path.basename(filename))
+    if match is None:
+        return None
+    params = {name: float(match.group(name)) for name in PARAMETERS}
+    folder = os.path.basename(os.path.dirname(os.path.abspath(filename)))
+    instrument = folder[:-len('_results')] if folder.endswith('_results') else ''
+    return ('full' if match.group('full') else 'reduced'), params, instrument, match.group('backend') or DEFAULT_BACKEND
+
+
+def sorted_range(values,condition):
+    """
+    Slice [start, stop) of the sorted values that match a (low, high) range (None for an open end) or a single
+    value, by binary search.
+    """
+    low, high = condition if isinstance(condition, tuple) else (condition, condition)
+    return np.array([np.searchsorted(values, low, side='left') if low is not None else 0,
+                     np.searchsorted(values, high, side='right') if high is not None else len(values)])
+
+
+class results_dataset:
+
+    def __init__(self,path):
+        '''
+        Columnar dataset of all full and reduced result tables. Every column of each table ('full': one row per
+        realization, 'reduced': one row per (nH, d) cell) is a raw little-endian array in path/<dir>/<column>.bin
+        (float64, or int32 codes for 'instrument'), memory-mapped when read, where dir is the directory of the table
+        in the manifest (the table name, then <table>.<n> after the n-th compact()). Each ingested CSV is one block
+        of consecutive rows, sorted by (nH, d) and carrying its configuration (instrument and the PARAMETERS
+        columns); path/manifest.json lists the blocks with their parameters, row range and the mtime and size of
+        their file.
+
+        Queries select blocks by their parameters in the manifest, narrow each block to the matching nH range and,
+        within each nH value, to the matching d range by binary search, and read only the matching rows of the
+        requested columns. Rows of a block whose file changed are marked inactive on the next ingest and dropped by
+        compact().
+
+        Arguments:
+        path: dataset directory, created if it does not exist
+        '''
+        self.path = path
+        manifest_path = os.path.join(path, MANIFEST)
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as fh:
+                self.manifest = json.load(fh)
+            if self.manifest.get('version') != DATASET_VERSION:
+                raise ValueError('%s was written by another version of results_dataset; ingest it again.' % path)
+            # Drop rows appended after the last manifest write (an interrupted ingest) and the columns of an
+            # interrupted compact()
+            for table, info in self.manifest['tables'].items():
+                info.setdefault('dir', table)
+                for directory in glob.glob(os.path.join(path, table + '.*')) + [os.path.join(path, table)]:
+                    if os.path.isdir(directory) and os.path.basename(directory) != info['dir']:
+                        shutil.rmtree(directory)
+                for column, dtype in info['columns'].items():
+                    filename = self._column_path(table, column)
+                    if os.path.getsize(filename) != info['n_rows'] * np.dtype(dtype).itemsize:
+                        with open(filename, 'r+b') as fh:
+                            fh.truncate(info['n_rows'] * np.dtype(dtype).itemsize)
+        else:
+            self.manifest = {'version': DATASET_VERSION, 'instruments': [],
+                             'tables': {table: {'n_rows': 0, 'columns': {}, 'dir': table} for table in TABLES}, 'blocks': []}
+        self._maps = {}
+
+    def _column_path(self,table,column):
+        return os.path.join(self.path, self.manifest['tables'][table]['dir'], column + '.bin')
+
+    def _write_manifest(self,manifest=None):
+        # manifest (default: the current one) takes effect once it has replaced the file
+        manifest = self.manifest if manifest is None else manifest
+        tmp_path = os.path.join(self.path, MANIFEST + '.tmp')
+        with open(tmp_path, 'w') as fh:
+            json.dump(manifest, fh, indent=1)
+        os.replace(tmp_path, os.path.join(self.path, MANIFEST))
+        self.manifest = manifest
+        self._maps = {}
+
+    def columns(self,table='full'):
+        return list(self.manifest['tables'][table]['columns'])
+
+    def column(self,table,name):
+        '''
+        Read-only memory map of a whole column.
+        '''
+        key = (table, name)
+        if key not in self._maps:
+            info = self.manifest['tables'][table]
+            if info['n_rows'] == 0:
+                return np.empty(0, dtype=info['columns'][name])
+            self._maps[key] = np.memmap(self._column_path(table, name), dtype=info['columns'][name], mode='r', shape=(info['n_rows'],))
+        return self._maps[key]
+
+    def _append(self,table,df):
+        info = self.manifest['tables'][table]
+        os.makedirs(os.path.join(self.path, info['dir']), exist_ok=True)
+        # Columns seen for the first time are filled with NaN for the rows already in the dataset
+        for name in df.columns:
+            if name not in info['columns']:
+                info['columns'][name] = VALUE_DTYPE
+                np.full(info['n_rows'], np.nan, dtype=VALUE_DTYPE).tofile(self._column_path(table, name))
+        for name, dtype in info['columns'].items():
+            values = df[name].values if name in df.columns else np.full(len(df), np.nan)
+            with open(self._column_path(table, name), 'ab') as fh:
+                np.asarray(values, dtype=dtype).tofile(fh)
+        start = info['n_rows']
+        info['n_rows'] += len(df)
+        return start, info['n_rows']
+
+    def ingest(self,pattern='results/*_results/table_*.csv',verbose=True):
+        '''
+        Adds the full and reduced tables matching pattern that are not in the dataset yet, or that changed (by
+        mtime or size) since they were ingested; the rows of the older version are marked inactive.
+
+        Output:
+        number of files ingested
+        '''
+        known = {}
+        for k, block in enumerate(self.manifest['blocks']):
+            if block['active']:
+                known[block['file']] = k
+        n_files = 0
+        for filename in sorted(glob.glob(pattern)):
+            parsed = parse_table_name(filename)
+            if parsed is None:
+                continue
+            table, params, instrument, backend = parsed
+            key = os.path.abspath(filename)
+            stat = os.stat(filename)
+            if key in known:
+                block = self.manifest['blocks'][known[key]]
+                if block['mtime'] == stat.st_mtime_ns and block['size'] == stat.st_size:
+                    continue
+                block['active'] = False
+            df = pd.read_csv(filename).apply(pd.to_numeric, errors='coerce')
+            df = df.sort_values(['nH', 'd'], kind='stable').reset_index(drop=True)
+            if instrument not in self.manifest['instruments']:
+                self.manifest['instruments'].append(instrument)
+            df['instrument'] = self.manifest['instruments'].index(instrument)
+            self.manifest['tables'][table]['columns'].setdefault('instrument', INSTRUMENT_DTYPE)
+            for name, value in params.items():
+                df[name] = value
+            start, stop = self._append(table, df)
+            self.manifest['blocks'].append({'file': key, 'table': table, 'instrument': instrument, 'backend': backend, 'params': params,
+                                            'start': start, 'stop': stop, 'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'active': True})
+            n_files += 1
+            # The manifest is written after every file, so an interrupted ingest keeps what it finished
+            self._write_manifest()
+        if verbose:
+            print(f"Ingested {n_files} tables into {self.path}: {self.manifest['tables']['full']['n_rows']} full rows, {self.manifest['tables']['reduced']['n_rows']} reduced rows")
+        return n_files
+
+    def compact(self):
+        '''
+        Rewrites the columns without the rows of inactive blocks. The new columns are written to a new directory
+        per table and take effect with the manifest (replaced with os.replace once all of them are written), so an
+        interrupted compact() leaves the dataset as it was; the old directories are removed afterwards.
+        '''
+        manifest = json.loads(json.dumps(self.manifest))
+        old_dirs = []
+        for table in TABLES:
+            info = manifest['tables'][table]
+            old_dirs.append(os.path.join(self.path, info['dir']))
+            info['generation'] = info.get('generation', 0) + 1
+            info['dir'] = '%s.%d' % (table, info['generation'])
+            if info['columns']:
+                os.makedirs(os.path.join(self.path, info['dir']))
+            blocks = [block for block in manifest['blocks'] if block['table'] == table and block['active']]
+            keep = np.concatenate([np.arange(block['start'], block['stop']) for block in blocks]) if blocks else np.empty(0, dtype=int)
+            for name, dtype in info['columns'].items():
+                values = np.array(self.column(table, name)[keep]) if info['n_rows'] else np.empty(0, dtype=dtype)
+                with open(os.path.join(self.path, info['dir'], name + '.bin'), 'wb') as fh:
+                    values.astype(dtype).tofile(fh)
+                    fh.flush()
+                    os.fsync(fh.fileno())
+            start = 0
+            for block in blocks:
+                block['start'], block['stop'] = start, start + block['stop'] - block['start']
+                start = block['stop']
+            info['n_rows'] = start
+        manifest['blocks'] = [block for block in manifest['blocks'] if block['active']]
+        self._write_manifest(manifest)
+        for directory in old_dirs:
+            if os.path.isdir(directory):
+                shutil.rmtree(directory)
+
+    def query(self,table='full',columns=None,**filters):
+        '''
+        Rows of a table matching all filters, as a DataFrame. A filter is a value (equality), a (low, high) tuple
+        (inclusive range, None for an open end) or a list (any of the values); it can be given for instrument,
+        backend, the PARAMETERS, nH, d or any other column. Note that gamma and temp are the fitted columns; the
+        simulated values are g and T.
+
+        Arguments:
+        table: 'full' or 'reduced'
+        columns: columns to return (default: all); the parameter columns, instrument and backend are always
+                 included
+
+        Example: query('reduced', ['d_fit_peak'], instrument='maxi', g=2.0, nH=(0.1, 5), d=[2, 8])
+        '''
+        unknown = set(filters) - set(self.columns(table)) - {'instrument', 'backend'}
+        if unknown:
+            raise ValueError('Unknown columns: %s' % ', '.join(sorted(unknown)))
+
+        def matches(values, condition):
+            values = np.asarray(values)
+            if isinstance(condition, tuple):
+                low, high = condition
+                mask = np.ones(values.shape, dtype=bool)
+                if low is not None:
+                    mask &= values >= low
+                if high is not None:
+                    mask &= values <= high
+                return mask
+            if isinstance(condition, (list, np.ndarray, set)):
+                return np.isin(values, list(condition))
+            return values == condition
+
+        rows, backends = [], []
+        nH = self.column(table, 'nH') if 'nH' in self.columns(table) else None
+        for block in self.manifest['blocks']:
+            if block['table'] != table or not block['active']:
+                continue
+            if 'instrument' in filters and not matches([block['instrument']], filters['instrument'])[0]:
+                continue
+            backend = block.get('backend', DEFAULT_BACKEND)
+            if 'backend' in filters and not matches([backend], filters['backend'])[0]:
+                continue
+            if not all(matches([block['params'][name]], filters[name])[0] for name in PARAMETERS if name in filters):
+                continue
+            start, stop = block['start'], block['stop']
+            # Blocks are sorted by nH: a range or single value is a contiguous slice found by binary search
+            condition = filters.get('nH')
+            if condition is not None and not isinstance(condition, (list, np.ndarray, set)):
+                start, stop = start + sorted_range(nH[start:stop], condition)
+            # and by d within each nH value: a d range or value is found by binary search in every run of one nH
+            condition = filters.get('d')
+            searched = condition is not None and not isinstance(condition, (list, np.ndarray, set)) and nH is not None and 'd' in self.columns(table)
+            if searched:
+                runs = np.flatnonzero(np.diff(nH[start:stop])) + 1
+                bounds = np.concatenate([[0], runs, [stop - start]]) + start
+                d = self.column(table, 'd')
+                index = np.concatenate([np.arange(*(run_start + sorted_range(d[run_start:run_stop], condition))) for run_start, run_stop in zip(bounds[:-1], bounds[1:])])
+            else:
+                index = np.arange(start, stop)
+            for name, condition in filters.items():
+                if name in PARAMETERS or name in ('instrument', 'backend') or (name == 'd' and searched) or len(index) == 0:
+                    continue
+                index = index[matches(self.column(table, name)[index], condition)]
+            rows.append(index)
+            backends.append(np.full(len(index), backend, dtype=object))
+        index = np.concatenate(rows) if rows else np.empty(0, dtype=int)
+
+        names = [name for name in self.columns(table) if name != 'instrument' and name not in PARAMETERS] if columns is None else list(columns)
+        df = pd.DataFrame({name: np.asarray(self.column(table, name)[index]) for name in names})
+        instruments = np.array(self.manifest['instruments'], dtype=object)
+        df['instrument'] = instruments[np.asarray(self.column(table, 'instrument')[index])] if len(index) else []
+        df['backend'] = np.concatenate(backends) if len(index) else []
+        for name in PARAMETERS:
+            df[name] = np.asarray(self.column(table, name)[index])
+        return df
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Ingests the full and reduced result tables into one memory-mapped columnar dataset (only new or changed files are read)')
+    parser.add_argument('--dataset', type=str, default='results/dataset', help='dataset directory')
+    parser.add_argument('--pattern', type=str, default='results/*_results/table_*.csv', help='glob of the result tables')
+    parser.add_argument('--compact', action='store_true', help='drop the rows of tables that were ingested again')
+    args = parser.parse_args()
+
+    dataset = results_dataset(args.dataset)
+    dataset.ingest(args.pattern)
+    if args.compact:
+        dataset.compact()
@@ -0,0 +1,300 @@
+import cProfile
+import os
+import random
+import sys
+import time
+import multiprocessing as mp
+from collections import deque, defaultdict
+from multiprocessing.connection import wait
+import profiling
+
+
+def _worker_loop(conn,function,initializer,initargs,profile_dir=None,profile_top=0):
+    """
+    Runs in each worker process: receives (task index, seed, task) messages, seeds the random module (which the
+    simulation functions draw their XSPEC/NumPy seeds from) and sends back (task index, status, payload, timing),
+    timing being the wall and CPU time of the task and its stage times (see profiling.stage_timer). With
+    profile_dir, every task runs under cProfile and the dumps of this worker's profile_top slowest tasks are kept.
+    The timing of the first task also holds the (wall clock) time the worker was ready and the seconds its
+    initializer took.
+    """
+    start = time.perf_counter()
+    if initializer is not None:
+        initializer(*initargs)
+    startup = {'ready': time.time(), 'init': time.perf_counter() - start, 'first': True}
+    profiles = profiling.slowest_profiles(profile_dir, profile_top) if profile_dir and profile_top else None
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        index, seed, task = message
+        random.seed(seed)
+        profiling.collect()
+        profiler = cProfile.Profile() if profiles is not None else None
+        start, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            if profiler is not None:
+                profiler.enable()
+            try:
+                result = function(task)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+            timing = dict({'wall': time.perf_counter() - start, 'cpu': time.process_time() - start_cpu, 'stages': profiling.collect(), 'pid': os.getpid()}, **startup)
+            if profiler is not None:
+                profiles.add(profiler, timing['wall'], index)
+            conn.send((index, 'done', result, timing))
+        except Exception as e:
+            conn.send((index, 'error', repr(e), dict({'pid': os.getpid()}, **startup)))
+        startup = {}
+    conn.close()
+
+
+class task_scheduler:
+
+    def __init__(self,function,processes,task_timeout=50,max_retries=2,initializer=None,initargs=(),cell_key=None,max_consecutive_timeouts=10,seed=None,on_restart_error=None,profile_dir=None,profile_top=0,start_method=None,preload=()):
+        '''
+        Process pool with real per-task deadlines. Every worker has its own pipe, so a task that runs past
+        task_timeout is handled by killing and replacing only that worker; the other workers keep their in-flight
+        tasks. Failed or timed out tasks are queued again (at the back, with a new seed) up to max_retries times,
+        and results are collected in whatever order they finish.
+
+        Arguments:
+        function: picklable function run on each task
+        processes: number of worker processes
+        task_timeout: seconds a single task may run before its worker is recycled
+        max_retries: extra attempts for a task that timed out, raised or crashed its worker
+        initializer, initargs: called once in every (re)started worker, like multiprocessing.Pool
+        cell_key: function mapping a task to the cell it belongs to, for the per-cell report (default: task[:2])
+        max_consecutive_timeouts: stop the run after this many timeouts in a row without a completed task
+        on_restart_error: called with the OSError if a replacement worker cannot be started
+        profile_dir, profile_top: keep cProfile dumps of the profile_top slowest tasks of every worker in profile_dir
+                                  (profiling.prune_profiles then keeps the slowest of all workers)
+        start_method: multiprocessing start method of the workers (default: the platform default). With
+                      'forkserver', workers are forked from a server process that imported the preload modules
+                      once, so starting a worker (or replacing one after a timeout) only costs a fork and the
+                      initializer, not the imports.
+        preload: modules imported by the fork server ('__main__' for the running script)
+        '''
+        self.function = function
+        self.processes = processes
+        self.task_timeout = task_timeout
+        self.max_retries = max_retries
+        self.initializer = initializer
+        self.initargs = initargs
+        self.cell_key = cell_key if cell_key is not None else (lambda task: tuple(task[:2]))
+        self.max_consecutive_timeouts = max_consecutive_timeouts
+        self.rng = random.Random(seed)
+        self.on_restart_error = on_restart_error
+        self.profile_dir = profile_dir
+        self.profile_top = profile_top
+        self.context = mp.get_context(start_method)
+        if start_method == 'forkserver' and preload:
+            preload = list(preload)
+            dirs = [os.path.dirname(os.path.abspath(__file__))]
+            # Every worker imports the running script again (as __mp_main__). Python before 3.13 ignores '__main__'
+            # in the preload list, so the script is preloaded as a module, which imports what it needs in the server
+            main_file = getattr(sys.modules['__main__'], '__file__', None)
+            if '__main__' in preload and main_file:
+                preload.append(os.path.splitext(os.path.basename(main_file))[0])
+                dirs.append(os.path.dirname(os.path.abspath(main_file)))
+            # The fork server is a new interpreter that does not get the sys.path of this process: the directories
+            # of these modules and of the script are put on its PYTHONPATH
+            paths = [path for path in os.environ.get('PYTHONPATH', '').split(os.pathsep) if path]
+            os.environ['PYTHONPATH'] = os.pathsep.join([path for path in dict.fromkeys(dirs) if path not in paths] + paths)
+            self.context.set_forkserver_preload(preload)
+        self.workers = []
+        self.starts = []
+
+    def _start_worker(self,restart=False):
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=_worker_loop, args=(child_conn, self.function, self.initializer, self.initargs, self.profile_dir, self.profile_top), daemon=True)
+        started = time.time()
+        process.start()
+        child_conn.close()
+        return {'process': process, 'conn': parent_conn, 'busy': None, 'started': started, 'restart': restart}
+
+    def _worker_ready(self,worker,timing):
+        # The first message of a worker tells when it was ready: its start-up time is counted from process.start()
+        if timing and 'ready' in timing:
+            self.starts.append({'pid': timing['pid'], 'restart': worker['restart'], 'startup': timing['ready'] - worker['started'], 'init': timing['init']})
+
+    def _replace_worker(self,worker):
+        worker['process'].kill()
+        worker['process'].join()
+        worker['conn'].close()
+        self.workers.remove(worker)
+        try:
+            self.workers.append(self._start_worker(restart=True))
+        except OSError as e:
+            if self.on_restart_error is not None:
+                self.on_restart_error(e)
+            if not self.workers:
+                raise
+
+    def start(self):
+        '''
+        Starts the workers ahead of time. Until close() is called, consecutive calls to run() reuse these (warm)
+        workers instead of starting and stopping a pool for every batch of tasks.
+        '''
+        if not self.workers:
+            self.workers = [self._start_worker() for _ in range(self.processes)]
+
+    def close(self):
+        self._shutdown()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+    def _shutdown(self):
+        for worker in self.workers:
+            try:
+                worker['conn'].send(None)
+            except (OSError, BrokenPipeError):
+                pass
+        for worker in self.workers:
+            worker['process'].join(timeout=5)
+            if worker['process'].is_alive():
+                worker['process'].kill()
+                worker['process'].join()
+            worker['conn'].close()
+        self.workers = []
+
+    def run(self,tasks,progress=None,on_result=None,poll_interval=0.5,keep_results=True,on_timing=None):
+        '''
+        Runs all tasks and returns once each has completed or used up its retries.
+
+        Arguments:
+        tasks: list of tasks
+        progress: optional tqdm-like object, updated once per task that reaches a final state
+        on_result: optional callback(index, result) called as soon as a task completes
+        keep_results: if False, results are only passed to on_result and the returned list stays empty
+        on_timing: optional callback(index, timing) for every completed task, timing being a dictionary with the
+                   'wall' and 'cpu' seconds of the task in the worker, its 'stages' (profiling.stage_timer), the
+                   worker 'pid', the 'attempt' and the monotonic 'dispatched' and 'received' times; the first task
+                   of a worker also has 'first', 'ready' and 'init' (see _worker_loop)
+
+        Output:
+        results (list of (task index, result) in completion order), timed out tasks, errored tasks
+        (as (task, message)) and a report with per-cell completion counts, the elapsed seconds and the seconds
+        workers were busy with tasks, and the start-up seconds of the workers that started during the run
+        ('workers': pid, whether it replaced another worker, seconds from start to ready and initializer seconds)
+        '''
+        pending = deque((index, 0) for index in range(len(tasks)))
+        attempts = defaultdict(int)
+        results, timed_out, errored = [], [], []
+        cells = defaultdict(lambda: {'completed': 0, 'timed_out': 0, 'errored': 0, 'retries': 0})
+        consecutive_timeouts = 0
+        n_completed = 0
+        aborted = False
+        busy_seconds = 0.0
+        run_start = time.monotonic()
+        n_starts = len(self.starts)
+
+        def finish(index, status, payload=None):
+            cell = cells[self.cell_key(tasks[index])]
+            nonlocal n_completed
+            if status == 'done':
+                n_completed += 1
+                if keep_results:
+                    results.append((index, payload))
+                cell['completed'] += 1
+                if on_result is not None:
+                    on_result(index, payload)
+            elif status == 'timeout':
+                timed_out.append(tasks[index])
+                cell['timed_out'] += 1
+            else:
+                errored.append((tasks[index], payload))
+                cell['errored'] += 1
+            if progress is not None:
+                progress.update(1)
+
+        def failed(index, status, payload=None):
+            if attempts[index] <= self.max_retries:
+                cells[self.cell_key(tasks[index])]['retries'] += 1
+                pending.append((index, attempts[index]))
+            else:
+                finish(index, status, payload)
+
+        persistent = bool(self.workers)
+        idle = False
+        self.start()
+        try:
+            while pending or any(w['busy'] is not None for w in self.workers):
+                if consecutive_timeouts > self.max_consecutive_timeouts:
+                    aborted = True
+                    break
+
+                for worker in self.workers:
+                    if worker['busy'] is None and pending:
+                        index, _ = pending.popleft()
+                        attempts[index] += 1
+                        worker['conn'].send((index, self.rng.randrange(2**31), tasks[index]))
+                        worker['busy'] = (index, time.monotonic())
+
+                busy = [w for w in self.workers if w['busy'] is not None]
+                ready = wait([w['conn'] for w in busy] + [w['process'].sentinel for w in busy], timeout=poll_interval)
+
+                for worker in busy:
+                    index, started = worker['busy']
+                    if worker['conn'] in ready:
+                        try:
+                            _, status, payload, timing = worker['conn'].recv()
+                        except (EOFError, OSError):
+                            busy_seconds += time.monotonic() - started
+                            self._replace_worker(worker)
+                            failed(index, 'error', 'worker exited with code %s' % worker['process'].exitcode)
+                            continue
+                        received = time.monotonic()
+                        self._worker_ready(worker, timing)
+                        if status in ('done', 'error'):
+                            busy_seconds += received - started
+                            worker['busy'] = None
+                        if status == 'done':
+                            consecutive_timeouts = 0
+                            if on_timing is not None:
+                                on_timing(index, dict(timing, attempt=attempts[index], dispatched=started, received=received))
+                            finish(index, 'done', payload)
+                            continue
+                        if status == 'error':
+                            failed(index, 'error', payload)
+                            continue
+                    if not worker['process'].is_alive():
+                        busy_seconds += time.monotonic() - started
+                        self._replace_worker(worker)
+                        failed(index, 'error', 'worker exited with code %s' % worker['process'].exitcode)
+                    elif time.monotonic() - started > self.task_timeout:
+                        busy_seconds += time.monotonic() - started
+                        consecutive_timeouts += 1
+                        print(f"Task at index={index} exceeded {self.task_timeout} s (attempt {attempts[index]}). Recycling its worker.")
+                        self._replace_worker(worker)
+                        failed(index, 'timeout')
+            idle = not aborted
+        finally:
+            # A warm pool is kept only if no worker is left in the middle of a task
+            if not persistent or not idle:
+                self._shutdown()
+
+        report = {
+            'tasks': len(tasks),
+            'completed': n_completed,
+            'timed_out': len(timed_out),
+            'errored': len(errored),
+            'retries': sum(cell['retries'] for cell in cells.values()),
+            'aborted': aborted,
+            'not_run': len(tasks) - n_completed - len(timed_out) - len(errored),
+            'cells': dict(cells),
+            'processes': self.processes,
+            'elapsed': time.monotonic() - run_start,
+            'busy': busy_seconds,
+            'workers': self.starts[n_starts:],
+        }
+        return results, timed_out, errored, report
@@ -0,0 +1,334 @@
+import argparse
+import glob
+import heapq
+import itertools
+import json
+import os
+import statistics
+import subprocess
+import tempfile
+import time
+from collections import defaultdict
+from observational_effects import (setup_xspec, make_scheduler, init_sweep_worker, run_sweep_task, run_configuration,
+                                   correction_npy_cache, table_name, build_tasks, preload_modules)
+
+# Parameters of one observational_effects.py configuration, in the order of its command line
+PARAMETERS = ('gamma', 'temp', 'a', 'mass', 'inc', 'ratio_disk_to_tot', 'exposure')
+
+# Throughput profiles of earlier runs (profiling.run_profile), from which the cost of a realization is measured
+PROFILE_PATTERN = 'results/*_results/table_*_profile.json'
+
+
+def expand_grid(spec):
+    '''
+    Expands a grid specification into the list of distinct configurations (argparse.Namespace objects with the
+    attributes observational_effects.py parses from its command line).
+
+    Arguments:
+    spec: dictionary (e.g. loaded from JSON) with
+          "parameters": {name: list of values} for the names in PARAMETERS (a single value is also accepted)
+          "instrument": list of instruments (default ["maxi"])
+          "mode": "product" (every combination, the default) or "pairwise" (every pair of parameters varied
+                  together over their values with all other parameters at "defaults", like the effects_data tables)
+          "defaults": {name: value}, needed for "pairwise"
+          "backend", "batched", "task_timeout", "max_retries", "peak_method", "n_boot", "target_median",
+          "target_peak", "min_count", "round_size", "start_method", "error_method", "n_mc", "mass_sigma", "a_sigma",
+          "inc_sigma": as the command line options of
+          observational_effects.py
+
+    Output:
+    list of configurations, duplicates removed (first occurrence kept)
+    '''
+    parameters = {name: (values if isinstance(values, list) else [values]) for name, values in spec['parameters'].items()}
+    unknown = set(parameters) - set(PARAMETERS)
+    if unknown:
+        raise ValueError('Unknown parameters in grid specification: %s' % ', '.join(sorted(unknown)))
+    mode = spec.get('mode', 'product')
+    defaults = spec.get('defaults', {})
+
+    if mode == 'product':
+        missing = [name for name in PARAMETERS if name not in parameters and name not in defaults]
+        if missing:
+            raise ValueError('No values given for %s' % ', '.join(missing))
+        grids = [parameters.get(name, [defaults.get(name)]) for name in PARAMETERS]
+        points = [dict(zip(PARAMETERS, values)) for values in itertools.product(*grids)]
+    elif mode == 'pairwise':
+        missing = [name for name in PARAMETERS if name not in defaults]
+        if missing:
+            raise ValueError('"pairwise" needs defaults for %s' % ', '.join(missing))
+        points = []
+        for first, second in itertools.combinations([name for name in PARAMETERS if name in parameters], 2):
+            for value_1, value_2 in itertools.product(parameters[first], parameters[second]):
+                points.append(dict(defaults, **{first: value_1, second: value_2}))
+    else:
+        raise ValueError("mode must be 'product' or 'pairwise'.")
+
+    backend = spec.get('backend', 'xspec')
+    batched = bool(spec.get('batched', False))
+    if batched and backend != 'numpy':
+        raise ValueError('"batched" requires the numpy backend')
+    options = {'backend': backend, 'batched': batched,
+               'task_timeout': spec.get('task_timeout', 600 if batched else 50),
+               'max_retries': spec.get('max_retries', 2),
+               'peak_method': spec.get('peak_method', 'histogram'), 'n_boot': spec.get('n_boot', 200),
+               'target_median': spec.get('target_median'), 'target_peak': spec.get('target_peak'),
+               'min_count': spec.get('min_count', 50), 'round_size': spec.get('round_size', 50),
+               'start_method': spec.get('start_method', 'forkserver'),
+               'error_method': spec.get('error_method', 'covariance'), 'n_mc': spec.get('n_mc', 1000),
+               'mass_sigma': spec.get('mass_sigma', 0.0), 'a_sigma': spec.get('a_sigma', 0.0), 'inc_sigma': spec.get('inc_sigma', 0.0)}
+
+    configs = {}
+    for instrument in spec.get('instrument', ['maxi']):
+        for point in points:
+            # Floats, so that table names match those of the command line (e.g. m8.0, not m8)
+            values = tuple(float(point[name]) for name in PARAMETERS)
+            key = values + (instrument,)
+            if key not in configs:
+                configs[key] = argparse.Namespace(**dict(zip(PARAMETERS, values)), instrument=instrument, **options)
+    return list(configs.values())
+
+
+def profile_cost_weights(pattern=PROFILE_PATTERN):
+    '''
+    Measured worker seconds per realization of every (instrument, backend, batched), pooled over the throughput
+    profiles of earlier runs (profiles that do not record their run parameters and realizations are skipped).
+    '''
+    seconds, realizations = defaultdict(float), defaultdict(int)
+    for filename in glob.glob(pattern):
+        with open(filename) as fh:
+            summary = json.load(fh)
+        run = summary.get('run')
+        if not run or not summary.get('realizations'):
+            continue
+        key = (run['instrument'], run['backend'], bool(run['batched']))
+        seconds[key] += summary['task'].get('total', 0.0)
+        realizations[key] += summary['realizations']
+    return {key: seconds[key] / realizations[key] for key in seconds}
+
+
+def estimate_cost(config,n_realizations,measured=None,cost_weights=None):
+    '''
+    Estimated worker seconds of n_realizations of a configuration: n_realizations times the seconds per realization
+    of its instrument in cost_weights ("cost_weights" of the grid specification), or else measured for its
+    (instrument, backend, batched) (see profile_cost_weights). A configuration that has neither gets the median of
+    the measured weights, or 1 when nothing was measured yet (the shards then get similar numbers of realizations).
+    '''
+    measured = measured or {}
+    cost_weights = cost_weights or {}
+    key = (config.instrument, config.backend, bool(config.batched))
+    if config.instrument in cost_weights:
+        weight = cost_weights[config.instrument]
+    elif key in measured:
+        weight = measured[key]
+    else:
+        weight = statistics.median(measured.values()) if measured else 1.0
+    return n_realizations * weight
+
+
+def partition(costs,n_shards):
+    '''
+    Splits configurations into n_shards with similar total cost (longest processing time first: each configuration,
+    most expensive first, goes to the currently cheapest shard). Deterministic, so every array task computes the
+    same partition independently.
+
+    Output:
+    list of n_shards lists of configuration indices
+    '''
+    shards = [[] for _ in range(n_shards)]
+    heap = [(0.0, shard) for shard in range(n_shards)]
+    for index in sorted(range(len(costs)), key=lambda i: (-costs[i], i)):
+        load, shard = heapq.heappop(heap)
+        shards[shard].append(index)
+        heapq.heappush(heap, (load + costs[index], shard))
+    return [sorted(shard) for shard in shards]
+
+
+def configuration_done(config,n_tasks,n_iterations):
+    '''
+    True if the reduced table of a configuration exists and its result store (if any, older runs have none) holds
+    all of its tasks. Adaptive runs only write the reduced table once every cell is done.
+    '''
+    name = table_name(config)
+    if not os.path.isfile(name + '.csv'):
+        return False
+    if config.target_median is not None or config.target_peak is not None or not os.path.isfile(name + '_store.h5'):
+        return True
+    return len(stored_tasks(config)) >= n_tasks
+
+
+def stored_tasks(config):
+    '''
+    Task ids in the result store of a configuration (none if it has no store), read without modifying the store, as
+    another shard may be writing it.
+    '''
+    from result_store import read_store
+    path = table_name(config) + '_store.h5'
+    if not os.path.isfile(path):
+        return set()
+    return set(read_store(path)[1][:, 0].astype(int).tolist())
+
+
+def load_plan(path,make,write=True):
+    '''
+    Partition shared by the shards of one submission: read from path if a shard already wrote it, otherwise made
+    with make() and written (os.link of a complete temporary file, which fails if another shard was first), so that
+    shards starting at different times all use the partition of the configurations that were pending when the first
+    one started. Without a path every shard makes its own; with write=False (a dry run) a new plan is not written.
+    '''
+    if path is None:
+        return make()
+    if not os.path.isfile(path):
+        plan = make()
+        if not write:
+            return plan
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as fh:
+            json.dump(plan, fh, indent=1)
+        try:
+            os.link(tmp_path, path)
+            return plan
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def shard_from_environment():
+    '''
+    (shard index, number of shards) from a SLURM job array (SLURM_ARRAY_TASK_ID, SLURM_ARRAY_TASK_COUNT) or, for
+    one process per node in a multi-node job, from SLURM_NODEID and SLURM_NNODES; (0, 1) otherwise.
+    '''
+    if 'SLURM_ARRAY_TASK_ID' in os.environ and 'SLURM_ARRAY_TASK_COUNT' in os.environ:
+        return int(os.environ['SLURM_ARRAY_TASK_ID']) - int(os.environ.get('SLURM_ARRAY_TASK_MIN', 0)), int(os.environ['SLURM_ARRAY_TASK_COUNT'])
+    if 'SLURM_NNODES' in os.environ:
+        return int(os.environ.get('SLURM_NODEID', 0)), int(os.environ['SLURM_NNODES'])
+    return 0, 1
+
+
+def plan_from_environment(spec_path):
+    '''
+    Plan file of the shards of one SLURM submission (spec path + '.plan_<job id>.json', with the job id of the array
+    or of the multi-node job); None outside SLURM.
+    '''
+    job_id = os.environ.get('SLURM_ARRAY_JOB_ID', os.environ.get('SLURM_JOB_ID'))
+    return None if job_id is None else '%s.plan_%s.json' % (spec_path, job_id)
+
+
+def plan_sweep(spec,n_shards):
+    '''
+    Partition of the pending configurations of a grid specification (see run_sweep) into n_shards by their
+    remaining estimated cost: the realizations missing from their result stores (all of the grid for a new or
+    adaptive configuration) at the cost of their instrument, backend and mode (see estimate_cost).
+
+    Output:
+    dictionary with 'shards' (n_shards lists of table names), 'costs' ({table name: estimated worker seconds} of
+    the pending configurations) and 'measured' (the [instrument, backend, batched, seconds per realization] used)
+    '''
+    nH_list = spec.get('nH', [0.1,0.5,5,10])
+    d_list = spec.get('d', [1,2,3,4,5,6,8,12,18,26])
+    n_iterations = spec.get('n_iterations', 300)
+    measured = profile_cost_weights()
+    pending, costs = [], []
+    for config in expand_grid(spec):
+        n_tasks = len(build_tasks(nH_list,d_list,n_iterations=n_iterations,batched=config.batched))
+        if configuration_done(config, n_tasks, n_iterations):
+            continue
+        # Adaptive runs have no fixed number of tasks
+        adaptive = config.target_median is not None or config.target_peak is not None
+        remaining = 1.0 if adaptive else 1.0 - min(len(stored_tasks(config)), n_tasks) / n_tasks
+        pending.append(table_name(config))
+        costs.append(estimate_cost(config, remaining * len(nH_list) * len(d_list) * n_iterations, measured, spec.get('cost_weights')))
+    return {'shards': [[pending[i] for i in shard] for shard in partition(costs, n_shards)], 'costs': dict(zip(pending, costs)),
+            'measured': [list(key) + [value] for key, value in measured.items()]}
+
+
+def run_sweep(spec,shard_index=0,n_shards=1,dry_run=False,plan=None):
+    '''
+    Runs this shard's configurations of a grid specification back to back on one warm worker pool. Configurations
+    that already have results are left out before the pending ones are partitioned by their remaining estimated
+    cost (the realizations not in their result stores, see estimate_cost); interrupted ones are resumed from their
+    result stores.
+
+    Arguments:
+    spec: grid specification (see expand_grid); "nH", "d" and "n_iterations" set the grid of every configuration
+          (default: the grid of observational_effects.py), n_iterations being the most realizations per cell of
+          adaptive runs
+    shard_index, n_shards: which part of the partition (see partition) this process runs
+    dry_run: only print the configurations of this shard
+    plan: file of the partition shared by the shards of one submission (see load_plan)
+
+    Output:
+    dictionary {table name: (timed out tasks, errored tasks)} of the configurations that were run
+    '''
+    nH_list = spec.get('nH', [0.1,0.5,5,10])
+    d_list = spec.get('d', [1,2,3,4,5,6,8,12,18,26])
+    n_iterations = spec.get('n_iterations', 300)
+
+    configs = expand_grid(spec)
+    names = [table_name(config) for config in configs]
+    plan = load_plan(plan, lambda: plan_sweep(spec, n_shards), write=not dry_run)
+    if len(plan['shards']) != n_shards:
+        raise ValueError('The plan has %d shards, not %d' % (len(plan['shards']), n_shards))
+    mine = set(plan['shards'][shard_index])
+    todo = [config for config, name in zip(configs, names) if name in mine]
+    total = sum(plan['costs'].values())
+    # Without profiles of earlier runs or "cost_weights" the costs are numbers of realizations
+    unit = 'worker seconds' if plan['measured'] or spec.get('cost_weights') else 'realizations'
+    print(f"Shard {shard_index + 1}/{n_shards}: {len(todo)} of {len(plan['costs'])} pending configurations (estimated {sum(plan['costs'][name] for name in mine):.0f} of {total:.0f} {unit}), {len(configs) - len(plan['costs'])} of {len(configs)} already done")
+
+    if dry_run:
+        for config in todo:
+            print("  " + table_name(config))
+        return {}
+    if not todo:
+        return {}
+
+    if todo[0].backend == 'xspec':
+        setup_xspec()
+
+    tmp_dir_name = tempfile.mkdtemp(prefix="tmp_", dir="/dev/shm")
+    cache_dir = correction_npy_cache()
+    outcomes = {}
+    scheduler = make_scheduler(run_sweep_task,task_timeout=todo[0].task_timeout,initializer=init_sweep_worker,
+                               initargs=(cache_dir, todo, tmp_dir_name),max_retries=todo[0].max_retries,
+                               cell_key=lambda task: tuple(task[1:3]),start_method=todo[0].start_method,
+                               preload=preload_modules(todo[0].backend))
+    try:
+        with scheduler:
+            for index, config in enumerate(todo):
+                start_time = time.perf_counter()
+                print(f"[{index + 1}/{len(todo)}] {table_name(config)}")
+                outcomes[table_name(config)] = run_configuration(config,nH_list,d_list,n_iterations=n_iterations,scheduler=scheduler,task_prefix=(index,))
+                print(f"Configuration took {time.perf_counter() - start_time:.1f} seconds")
+    finally:
+        subprocess.Popen('rm -rf ' + tmp_dir_name, shell=True).wait()
+    return outcomes
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Runs a grid of observational_effects.py configurations, split across SLURM array tasks or nodes, on one warm worker pool per process')
+    parser.add_argument('spec', type=str, help='JSON grid specification (see expand_grid)')
+    parser.add_argument('--shard-index', type=int, default=None, help='shard run by this process (default: from SLURM_ARRAY_TASK_ID or SLURM_NODEID)')
+    parser.add_argument('--n-shards', type=int, default=None, help='number of shards (default: SLURM_ARRAY_TASK_COUNT or SLURM_NNODES)')
+    parser.add_argument('--dry-run', action='store_true', help='only list the configurations of this shard')
+    parser.add_argument('--plan', type=str, default=None, help='partition file shared by the shards (default: spec.json.plan_<job id>.json in a SLURM job, none otherwise)')
+    args = parser.parse_args()
+
+    with open(args.spec) as fh:
+        spec = json.load(fh)
+    shard_index, n_shards = shard_from_environment()
+    shard_index = args.shard_index if args.shard_index is not None else shard_index
+    n_shards = args.n_shards if args.n_shards is not None else n_shards
+    if not 0 <= shard_index < n_shards:
+        parser.error('--shard-index must be between 0 and --n-shards - 1')
+
+    start_time = time.perf_counter()
+    plan = args.plan if args.plan is not None else plan_from_environment(args.spec)
+    outcomes = run_sweep(spec,shard_index=shard_index,n_shards=n_shards,dry_run=args.dry_run,plan=plan)
+    print(f"The sweep took {time.perf_counter() - start_time} seconds to complete.")
+    for name, (timeouts, errors) in outcomes.items():
+        if timeouts or errors:
+            print(f"{name}: {len(timeouts)} timed out, {len(errors)} errored")
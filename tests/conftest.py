@@ -0,0 +1,13 @@
+import os
+import sys
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+
+@pytest.fixture
+def repo_dir(monkeypatch):
+    # The simulation classes open sim_files/... relative to the working directory
+    monkeypatch.chdir(REPO)
+    return REPO
@@ -0,0 +1,40 @@
+'''
+Writes the unit-norm powerlaw and ezdiskbb energy fluxes that XSPEC's AllModels.calcFlux gives in every band of
+flux_norm.INSTRUMENT_BANDS, for the GAMMAS and TEMPS of tests/test_flux_norm.py, to tests/fixtures/calcflux.npz.
+Needs PyXspec; run from the repository directory.
+'''
+import os
+import sys
+import itertools
+import numpy as np
+
+TESTS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [TESTS, os.path.dirname(TESTS)]
+from test_flux_norm import FIXTURE, GAMMAS, TEMPS
+from flux_norm import INSTRUMENT_BANDS
+
+# Model energies of the calcFlux runs: fine enough that the binning does not limit the reference
+ENERGIES = '0.05 50 10000 log'
+
+
+def calcflux(model, pars, band):
+    from xspec import AllModels, Model
+    m = Model(model, setPars=pars)
+    AllModels.calcFlux('%g %g' % band)
+    flux = m.flux[0]
+    AllModels.clear()
+    return flux
+
+
+if __name__ == "__main__":
+    from xspec import AllModels, Xset
+    Xset.chatter = 0
+    AllModels.setEnergies(ENERGIES)
+    rows = []
+    for band, gamma, temp in itertools.product(sorted(INSTRUMENT_BANDS.values()), GAMMAS, TEMPS):
+        rows.append((band, gamma, temp, calcflux('po', {1: gamma, 2: 1.0}, band), calcflux('ezdiskbb', {1: temp, 2: 1.0}, band)))
+    AllModels.setEnergies('reset')
+    band, gamma, temp, powerlaw, ezdiskbb = (np.array(column) for column in zip(*rows))
+    np.savez(FIXTURE, band=band, gamma=gamma, temp=temp, powerlaw=powerlaw, ezdiskbb=ezdiskbb)
+    for row in rows:
+        print(*row)
@@ -0,0 +1,34 @@
+'''
+Writes the GROUPING and QUALITY columns that ftgrouppha gives the sim_files/ spectra (grouptype snmin, groupscale 3,
+as used by the simulations) to tests/fixtures/ftgrouppha/<spectrum>.npz, for tests/test_grouping.py. Needs heasoftpy
+and a HEASoft installation; run from the repository directory.
+'''
+import os
+import sys
+import tempfile
+import numpy as np
+
+TESTS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [TESTS, os.path.dirname(TESTS)]
+from test_grouping import SPECTRA, GROUPTYPE, GROUPSCALE, FIXTURE_DIR
+
+
+def ftgrouppha_columns(infile, backfile, tmp_dir):
+    import heasoftpy as hsp
+    from astropy.io import fits
+    outfile = os.path.join(tmp_dir, 'reference.pha')
+    with hsp.utils.local_pfiles_context():
+        hsp.ftgrouppha(infile=infile, backfile=backfile, outfile=outfile, grouptype=GROUPTYPE, groupscale=str(GROUPSCALE), clobber='yes')
+    with fits.open(outfile) as hdul:
+        data = hdul['SPECTRUM'].data
+        quality = np.asarray(data['QUALITY'], dtype=int) if 'QUALITY' in data.columns.names else np.zeros(len(data), dtype=int)
+        return np.asarray(data['GROUPING'], dtype=int), quality
+
+
+if __name__ == "__main__":
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, (infile, backfile) in SPECTRA.items():
+            grouping, quality = ftgrouppha_columns(infile, backfile, tmp_dir)
+            np.savez(os.path.join(FIXTURE_DIR, name + '.npz'), grouping=grouping, quality=quality)
+            print(name, np.count_nonzero(grouping == 1), 'groups')
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+from bias_emulator import bias_emulator, LOG_VARIABLES
+from interpolation import axis_weights
+from benchmarks import emulator_queries
+
+
+def dense_prediction(emulator,queries,n):
+    # sum(G * fit) and sqrt(sum(G^2 * se^2)) of every table with the dense weights G
+    mean, var = np.zeros(n), np.zeros(n)
+    for table in emulator.tables:
+        parts = []
+        for axis, name in zip(table.axes, table.variables):
+            if name in queries:
+                parts.append(axis_weights(axis, queries[name], log=name in LOG_VARIABLES)[0])
+            else:
+                parts.append(np.tile(emulator.proportions[name], (n, 1)))
+        G = emulator._table_weights(table, *parts)[0]
+        mean += np.einsum('nij,ij->n', G, table.fit)
+        var += np.einsum('nij,ij->n', G ** 2, table.se ** 2)
+    return mean, np.sqrt(var)
+
+
+@pytest.mark.parametrize('instrument', ['maxi', 'xrt'])
+@pytest.mark.parametrize('names', [None, ('nH', 'g'), ('g', 'T', 'a'), ('e',)])
+def test_matches_dense_weights(instrument,names,repo_dir):
+    emulator = bias_emulator('effects_data_%s' % instrument)
+    queries = emulator_queries(emulator, 2000)
+    if names is not None:
+        queries = {name: queries[name] for name in names}
+    prediction = emulator.predict(**queries)
+    mean, se = dense_prediction(emulator, queries, 2000)
+    assert np.allclose(prediction['log_frac_uncert'], mean, rtol=0, atol=1e-12)
+    assert np.allclose(prediction['se'], se, rtol=0, atol=1e-12)
+
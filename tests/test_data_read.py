@@ -0,0 +1,86 @@
+import json
+import os
+import shutil
+import pytest
+import data_read
+from data_read import products_catalog, CATALOG_FILE
+
+DATES = ['60100', '60110', '60120', '60125']
+
+
+def make_tree(root):
+    # One source with a MAXI soft state and transition folder and a saved model
+    os.makedirs(os.path.join(root, 'source', 'products_60100_to_60110'))
+    os.makedirs(os.path.join(root, 'source', 'products_60120_to_60125'))
+    open(os.path.join(root, 'source', 'model_fake_PLonlyFlux.xcm'), 'w').close()
+
+
+@pytest.fixture
+def lookups(tmp_path,monkeypatch):
+    # Lookups of a fresh process in the source directory, without $PRODUCTS_CATALOG
+    make_tree(str(tmp_path))
+    monkeypatch.delenv('PRODUCTS_CATALOG', raising=False)
+    monkeypatch.chdir(str(tmp_path / 'source'))
+    monkeypatch.setattr(data_read, '_catalogs', {})
+    return tmp_path
+
+
+def test_reopened_catalog_is_not_saved_again(tmp_path):
+    make_tree(str(tmp_path))
+    path = str(tmp_path / CATALOG_FILE)
+    catalog = products_catalog(str(tmp_path), path)
+    assert catalog.find('maxi', DATES, str(tmp_path / 'source')) == \
+        (str(tmp_path / 'source' / 'products_60100_to_60110'), str(tmp_path / 'source' / 'products_60120_to_60125'))
+    os.utime(path, ns=(0, 0))
+    # The save of the first catalog changed the mtime of the root: it is listed again, and nothing is saved
+    assert products_catalog(str(tmp_path), path).products == catalog.products
+    assert os.stat(path).st_mtime_ns == 0
+    assert sorted(os.listdir(str(tmp_path))) == [CATALOG_FILE, 'source']
+
+
+def test_interrupted_save_keeps_the_previous_catalog(tmp_path,monkeypatch):
+    make_tree(str(tmp_path))
+    path = str(tmp_path / CATALOG_FILE)
+    catalog = products_catalog(str(tmp_path), path)
+    with open(path) as fh:
+        before = fh.read()
+
+    def killed(data,fh):
+        fh.write('{"version": ')
+        raise KeyboardInterrupt
+    monkeypatch.setattr(json, 'dump', killed)
+    os.makedirs(str(tmp_path / 'source' / 'products_60200_to_60210'))
+    with pytest.raises(KeyboardInterrupt):
+        catalog.refresh()
+    monkeypatch.undo()
+    with open(path) as fh:
+        assert fh.read() == before
+    assert products_catalog(str(tmp_path), path).date_ranges(str(tmp_path / 'source'))[-1] == ('60200', '60210', 'products_60200_to_60210')
+
+
+def test_lookups_without_a_catalog_file_only_list_the_working_directory(lookups):
+    os.makedirs(str(lookups / 'source' / 'sub' / 'deeper'))
+    assert data_read.findProductsFolders('maxi', DATES) == ('products_60100_to_60110', 'products_60120_to_60125')
+    assert list(data_read.getCatalog('.').dirs) == ['.']
+    assert sorted(os.listdir(str(lookups / 'source'))) == ['model_fake_PLonlyFlux.xcm', 'products_60100_to_60110', 'products_60120_to_60125', 'sub']
+    assert data_read.findSavedModel() == 'model_fake_PLonlyFlux.xcm'
+
+
+def test_catalog_path_from_the_environment(lookups,monkeypatch):
+    monkeypatch.setenv('PRODUCTS_CATALOG', str(lookups / 'catalog.json'))
+    assert data_read.findProductsFolders('maxi', DATES[:2]) == ('products_60100_to_60110', None)
+    assert os.path.isfile(str(lookups / 'catalog.json'))
+    assert not os.path.exists(str(lookups / 'source' / CATALOG_FILE))
+
+
+@pytest.mark.parametrize('persistent', [False, True])
+def test_removed_folders_are_not_returned(lookups,monkeypatch,persistent):
+    if persistent:
+        monkeypatch.setenv('PRODUCTS_CATALOG', str(lookups / 'catalog.json'))
+    assert data_read.findProductsFolders('maxi', DATES[:2]) == ('products_60100_to_60110', None)
+    # A removal the mtime of the directory does not show (e.g. on a file system with coarse timestamps)
+    mtime = os.stat('.').st_mtime_ns
+    shutil.rmtree('products_60100_to_60110')
+    os.utime('.', ns=(mtime, mtime))
+    with pytest.raises(IndexError):
+        data_read.findProductsFolders('maxi', DATES[:2])
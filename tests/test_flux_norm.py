@@ -0,0 +1,60 @@
+import os
+import numpy as np
+import pytest
+import numpy_simulations as ns
+from flux_norm import INSTRUMENT_BANDS, powerlaw_flux, ezdiskbb_flux, component_fluxes, powerlaw_norms
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'calcflux.npz')
+
+# Unit-norm powerlaw and ezdiskbb fluxes of XSPEC's AllModels.calcFlux in every band of INSTRUMENT_BANDS, written
+# to FIXTURE by fixtures/make_calcflux_fixtures.py
+GAMMAS = (1.5, 2.0, 2.5)
+TEMPS = (0.5, 1.0, 2.0)
+
+# Relative tolerance against calcFlux: the powerlaw flux is analytic on both sides, the disc flux also depends on
+# XSPEC's own ezdiskbb integration
+CALCFLUX_TOLERANCE = {'powerlaw': 1e-3, 'ezdiskbb': 5e-3}
+
+# Relative tolerance of the Simpson disc flux against adaptive quadrature of the same spectrum
+QUADRATURE_TOLERANCE = 2e-4
+
+
+def disc_flux_quadrature(temp, e_low, e_high):
+    # Energy flux of a unit-norm ezdiskbb from nested adaptive quadrature over energy and radius, to infinite radius,
+    # instead of the radial table and band grid of flux_norm
+    integrate = pytest.importorskip('scipy.integrate')
+    t_star = temp / ns.EZDISKBB_TMAX_RATIO
+
+    def photon_density(e):
+        with np.errstate(over='ignore'):
+            radial = integrate.quad(lambda x: x / np.expm1(e / (t_star * x**-0.75 * (1 - x**-0.5)**0.25)), 1, np.inf, epsabs=0, epsrel=1e-10, limit=200)[0]
+        return ns.EZDISKBB_CONST * e**2 * radial
+    return integrate.quad(lambda e: e * photon_density(e), e_low, e_high, epsabs=0, epsrel=1e-9, limit=200)[0] * ns.KEV_TO_ERG
+
+
+@pytest.mark.parametrize('band', sorted(INSTRUMENT_BANDS.values()))
+def test_powerlaw_flux_is_the_band_integral(band):
+    integrate = pytest.importorskip('scipy.integrate')
+    for gamma in GAMMAS:
+        expected = integrate.quad(lambda e: e**(1 - gamma), *band, epsabs=0, epsrel=1e-12)[0] * ns.KEV_TO_ERG
+        assert powerlaw_flux(gamma, *band) == pytest.approx(expected, rel=1e-10)
+
+
+@pytest.mark.parametrize('band', sorted(INSTRUMENT_BANDS.values()))
+def test_ezdiskbb_flux_matches_quadrature(band):
+    for temp in TEMPS:
+        assert ezdiskbb_flux(temp, *band) == pytest.approx(disc_flux_quadrature(temp, *band), rel=QUADRATURE_TOLERANCE)
+
+
+def test_matches_calcflux():
+    if not os.path.isfile(FIXTURE):
+        pytest.skip('no calcFlux reference: the flux normalization is unverified against XSPEC until '
+                    'tests/fixtures/make_calcflux_fixtures.py is run on a host with PyXspec and its output committed')
+    reference = np.load(FIXTURE)
+    for (e_low, e_high), gamma, temp, pl_flux, disk_flux in zip(reference['band'], reference['gamma'], reference['temp'], reference['powerlaw'], reference['ezdiskbb']):
+        fluxes = component_fluxes(float(gamma), float(temp), float(e_low), float(e_high))
+        assert fluxes[0] == pytest.approx(pl_flux, rel=CALCFLUX_TOLERANCE['powerlaw'])
+        assert fluxes[1] == pytest.approx(disk_flux, rel=CALCFLUX_TOLERANCE['ezdiskbb'])
+        # The norm that gives equal fluxes in the band
+        tolerance = CALCFLUX_TOLERANCE['powerlaw'] + CALCFLUX_TOLERANCE['ezdiskbb']
+        assert powerlaw_norms(gamma, temp, 1.0, 1.0, band=(e_low, e_high)) == pytest.approx(disk_flux / pl_flux, rel=tolerance)
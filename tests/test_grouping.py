@@ -0,0 +1,98 @@
+import os
+import numpy as np
+import pytest
+import grouping
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'ftgrouppha')
+
+# sim_files/ spectra (source, background) with ftgrouppha reference columns, written by
+# fixtures/make_ftgrouppha_fixtures.py with the grouping of the simulations
+SPECTRA = {
+    'maxi_gx339-4_g_low': ('sim_files/gx339-4_g_low_src.pi', 'sim_files/gx339-4_g_low_bgd.pi'),
+    'xrt_00010627114': ('sim_files/00010627114src_wt.pha', 'sim_files/00010627114bgd_wt.pha'),
+}
+GROUPTYPE = 'snmin'
+GROUPSCALE = 3.0
+
+
+def reference_group_counts(src, bkg, grouptype, groupscale, bkg_ratio=1.0, quality=None):
+    # Channel by channel transcription of the ftgrouppha rules for one spectrum
+    n_chan = len(src)
+    grouping = np.ones(n_chan, dtype=int)
+    quality = np.zeros(n_chan, dtype=int) if quality is None else np.array(quality, dtype=int)
+    group = []
+    s = b = 0.0
+
+    def close(complete):
+        if not complete and grouptype != 'constant':
+            quality[group] = 2
+
+    for i in range(n_chan):
+        if quality[i] != 0:
+            if group:
+                close(False)
+            group = []
+            continue
+        if group:
+            grouping[i] = -1
+        else:
+            s = b = 0.0
+        group.append(i)
+        s += src[i]
+        b += bkg[i]
+        if grouptype == 'constant':
+            met = len(group) >= groupscale
+        elif grouptype == 'min':
+            met = s >= groupscale
+        elif grouptype == 'bmin':
+            met = b >= groupscale
+        else:
+            noise = np.sqrt(s + bkg_ratio**2 * b)
+            met = noise > 0 and (s - bkg_ratio*b) / noise >= groupscale
+        if met:
+            group = []
+    if group:
+        close(False)
+    return grouping, quality
+
+
+@pytest.mark.parametrize('grouptype', grouping.GROUP_TYPES)
+def test_matches_reference_rules(grouptype):
+    rng = np.random.default_rng(3)
+    for _ in range(50):
+        n, n_chan = rng.integers(1, 4), rng.integers(1, 300)
+        src = rng.poisson(rng.uniform(0, 20), size=(n, n_chan)).astype(float)
+        bkg = rng.poisson(rng.uniform(0, 3), size=(n, n_chan)).astype(float)
+        quality = np.where(rng.random(n_chan) < rng.choice([0, 0.05, 0.3]), 5, 0)
+        groupscale = float(rng.choice([1, 2, 3, 10]))
+        got_grouping, got_quality = grouping.group_counts(src, bkg, grouptype, groupscale, bkg_ratio=0.7, quality=quality, window=int(rng.choice([1, 8, 64])))
+        for row in range(n):
+            expected_grouping, expected_quality = reference_group_counts(src[row], bkg[row], grouptype, groupscale, 0.7, quality)
+            assert np.array_equal(got_grouping[row], expected_grouping)
+            assert np.array_equal(got_quality[row], expected_quality)
+
+
+def test_edge_cases():
+    # The last group never reaches S/N 3 and is flagged bad; a bad channel ends the group before it; channels
+    # without counts (zero noise) never close a group
+    src = np.array([9.0, 0, 0, 1, 0, 9, 9, 0, 1])
+    bkg = np.zeros(9)
+    quality = np.array([0, 0, 0, 0, 1, 0, 0, 0, 0])
+    got_grouping, got_quality = grouping.group_snmin(src, bkg, 1.0, quality=quality)
+    assert got_grouping.tolist() == [1, 1, -1, -1, 1, 1, 1, 1, -1]
+    assert got_quality.tolist() == [0, 2, 2, 2, 1, 0, 0, 2, 2]
+
+
+@pytest.mark.parametrize('name', sorted(SPECTRA))
+def test_identical_to_ftgrouppha(name, repo_dir):
+    fixture = os.path.join(FIXTURE_DIR, name + '.npz')
+    if not os.path.isfile(fixture):
+        pytest.skip('no ftgrouppha reference for %s: agreement with ftgrouppha is unverified until '
+                    'tests/fixtures/make_ftgrouppha_fixtures.py is run on a HEASoft host and its output committed' % name)
+    infile, backfile = SPECTRA[name]
+    source, background = grouping.read_pha(infile), grouping.read_pha(backfile)
+    got_grouping, got_quality = grouping.group_counts(source['counts'], background['counts'], GROUPTYPE, GROUPSCALE,
+                                                      bkg_ratio=grouping.background_ratio(source, background), quality=source['quality'])
+    expected = np.load(fixture)
+    assert np.array_equal(got_grouping, expected['grouping'])
+    assert np.array_equal(got_quality, expected['quality'])
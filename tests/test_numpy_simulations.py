@@ -0,0 +1,121 @@
+import os
+import numpy as np
+import pytest
+import numpy_simulations as ns
+
+# Fractional tolerance of the numpy backend against XSPEC fits of the same model (median of compare_with_xspec)
+XSPEC_TOLERANCE = {'gamma': 0.01, 'temp': 0.01, 'disk_norm': 0.03, 'total_flux': 0.01}
+
+# Absolute tolerance of the tbabs transmission against XSPEC's, on narrow bins from 0.3 to 30 keV at nH = 1 and 10e22
+TBABS_TOLERANCE = 1e-3
+
+# Parameters folded in the tests: (nH, gamma, pl_norm, T_max, disk_norm)
+TRUE_VALUES = np.array([5.0, 2.0, 0.3, 1.0, 400.0])
+FIT_PARAMS = {1: '5.0,0', 2: '2.3,,1.7,1.7,3.0,3.0', 4: ',,0.1,0.1'}
+
+
+def synthetic_response(n_energies=600, n_channels=300, e_low=0.5, e_high=30.0):
+    # Gaussian redistribution (5% resolution) with a log-normal effective area, in the CSR form of read_response
+    edges = np.geomspace(e_low, e_high, n_energies + 1)
+    channels = np.linspace(e_low, e_high, n_channels + 1)
+    centre, channel_centre = (edges[:-1] + edges[1:]) / 2, (channels[:-1] + channels[1:]) / 2
+    area = 50 * np.exp(-np.log(centre / 5)**2 / 2)
+    dense = np.exp(-0.5 * ((channel_centre - centre[:, None]) / (0.05 * centre[:, None] + 0.05))**2)
+    dense *= area[:, None] / dense.sum(axis=1, keepdims=True)
+    dense[dense < 1e-6 * dense.max(axis=1, keepdims=True)] = 0
+    rows, columns = np.nonzero(dense)
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=n_energies))))
+    response = {'energ_lo': edges[:-1], 'energ_hi': edges[1:], 'e_min': channels[:-1], 'e_max': channels[1:],
+                'matrix': ns.response_matrix(dense[rows, columns], columns, indptr, n_channels)}
+    response['components'] = ns.model_components(response)
+    return response
+
+
+def fit_folded(response, counts, exposure):
+    # Every channel is its own group
+    n = len(counts)
+    group_id = np.tile(np.arange(counts.shape[1]), (n, 1))
+    return ns.fit_spectra(response['components'], group_id, counts / exposure, counts / exposure**2, ns.parse_xspec_params(FIT_PARAMS))
+
+
+def test_wabs_cross_section_units():
+    # Morrison & McCammon (1983): 2.42e-22 cm^2 per H atom at 1 keV; the function is in units of 1e22 cm^2
+    assert ns.wabs_cross_section(1.0) == pytest.approx(2.422, rel=1e-3)
+    assert np.all(np.diff(ns.wabs_cross_section(np.geomspace(1.0, 1.8, 20))) < 0)
+
+
+def test_tbabs_table():
+    # Wilms et al. (2000) abundances have fewer metals per H atom than Morrison & McCammon (1983): about 30% less
+    # absorption above the O K edge on average (the edges of the two tables differ slightly), with the O and Fe K
+    # edges at 0.54 and 7.1 keV
+    energies = np.geomspace(0.6, 10, 200)
+    ratio = ns.tbabs_cross_section(energies) / ns.wabs_cross_section(energies)
+    assert np.mean(ratio) == pytest.approx(0.7, abs=0.05)
+    assert np.all((ratio > 0.5) & (ratio < 0.85))
+    for edge in (0.538, 7.11):
+        assert ns.tbabs_cross_section(edge * 1.01) / ns.tbabs_cross_section(edge * 0.99) > 1.1
+    # Continuous where the power laws take over from the table
+    log_e, log_sigma, _, _ = ns.read_tbabs_table()
+    for end in (log_e[0], log_e[-1]):
+        below, above = ns.tbabs_cross_section(np.exp(end + np.array([-1e-4, 1e-4])))
+        assert above == pytest.approx(below, rel=1e-3)
+    assert np.all(np.diff(ns.tbabs_cross_section(np.geomspace(20, 100, 20))) < 0)
+
+
+def test_numpy_backend_models():
+    assert ns.numpy_simulation(ns.MODEL, 'maxi', {}, {}).absorption == 'tbabs'
+    assert ns.numpy_simulation("wabs*(powerlaw + ezdiskbb)", 'xrt', {}, {}).absorption == 'wabs'
+    with pytest.raises(ValueError):
+        ns.numpy_simulation("phabs*(po+ezdiskbb)", 'maxi', {}, {})
+
+
+def test_tbabs_matches_xspec():
+    xspec = pytest.importorskip('xspec')
+    xspec.Xset.abund = ns.TBABS_ABUND
+    xspec.Xset.xsect = ns.TBABS_XSECT
+    edges = np.geomspace(0.3, 30, 2001)
+    xspec.AllModels.setEnergies('0.3 30 2000 log')
+    try:
+        for nH in (1.0, 10.0):
+            model = xspec.Model('tbabs*po', setPars={1: nH, 2: 0.0, 3: 1.0})
+            transmission = np.array(model.values(0)) / np.diff(edges)
+            assert np.max(np.abs(ns.tbabs(edges[:-1], edges[1:], nH) - transmission)) < TBABS_TOLERANCE
+    finally:
+        xspec.AllModels.clear()
+        xspec.AllModels.setEnergies('reset')
+
+
+def test_fit_recovers_folded_parameters():
+    response = synthetic_response()
+    exposure = 1e4
+    counts = response['components'].folded(TRUE_VALUES) * exposure
+    fit = fit_folded(response, counts, exposure)
+    assert fit['values'][0] == pytest.approx(TRUE_VALUES, rel=1e-3)
+    assert fit['statistic'][0] == pytest.approx(0, abs=1e-3)
+
+
+def test_fit_is_unbiased_on_poisson_spectra():
+    # Ungrouped channels with enough counts that the chi-square (data variance) bias is negligible
+    response = synthetic_response()
+    exposure = 1e5
+    rng = np.random.default_rng(1)
+    counts = rng.poisson(response['components'].folded(TRUE_VALUES) * exposure, size=(100, 300)).astype(float)
+    fit = fit_folded(response, counts, exposure)
+    ok = np.isfinite(fit['statistic'])
+    assert np.count_nonzero(ok) > 95
+    median = np.median(fit['values'][ok], axis=0)
+    assert median[1] == pytest.approx(TRUE_VALUES[1], rel=0.01)
+    assert median[3] == pytest.approx(TRUE_VALUES[3], rel=0.01)
+    assert median[4] == pytest.approx(TRUE_VALUES[4], rel=0.05)
+
+
+@pytest.mark.parametrize('model', [ns.MODEL, "wabs*(po+ezdiskbb)"])
+def test_matches_xspec(repo_dir,model):
+    pytest.importorskip('xspec')
+    sim = ns.numpy_simulation(model, 'maxi', {}, {})
+    if not all(os.path.isfile(name) for name in (sim.sourceFilename, sim.backgroundFilename, sim.responseFilename)):
+        pytest.skip('MAXI response and spectra are not in sim_files/')
+    nH, gamma, pl_norm, temp, disk_norm = TRUE_VALUES
+    difference = ns.compare_with_xspec('maxi', {'nH': nH, 'gamma': gamma, 'pl_norm': pl_norm, 'temp': temp, 'disk_norm': disk_norm}, n_runs=50, model=model)
+    for name, tolerance in XSPEC_TOLERANCE.items():
+        assert abs(difference[name]) < tolerance, name
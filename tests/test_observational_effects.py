@@ -0,0 +1,35 @@
+import tempfile
+import pytest
+import benchmarks
+import observational_effects as oe
+from fake_backend import fake_simulation
+from scheduler import task_scheduler
+
+
+def task(arguments):
+    return oe.run_simulation(arguments)
+
+
+def test_completed_realization_has_a_distance():
+    result = oe.run_simulation((0.1, 5.0, benchmarks.config(), 0, tempfile.gettempdir(), benchmarks.synthetic_correction_table()))
+    assert result['d_fit'] > 0
+    assert result['error_d_low'] < result['d_fit'] < result['error_d_up']
+
+
+def test_failed_fit_raises(monkeypatch):
+    failed = {'gamma': None, 'power_norm': None, 'temp': None, 'disk_norm': None, 'disk_norm_error': (None, None),
+              'disk_norm_sigma_log': None, 'statistic': None, 'dof': None}
+    monkeypatch.setattr(fake_simulation, 'run', lambda self, **kwargs: (failed, None))
+    with pytest.raises(RuntimeError):
+        oe.run_simulation((0.1, 5.0, benchmarks.config(), 0, tempfile.gettempdir(), benchmarks.synthetic_correction_table()))
+
+
+def test_failing_tasks_are_retried_and_listed_as_errored():
+    # Every fit fails (fake error rate 1): each task is tried 1 + max_retries times and then reported as errored
+    f = benchmarks.synthetic_correction_table()
+    args = benchmarks.config(fake_settings={'error_rate': 1.0})
+    tasks = [(0.1, d, args, k, tempfile.gettempdir(), f) for k, d in enumerate((2.0, 5.0))]
+    results, timed_out, errored, report = task_scheduler(task, 1, max_retries=2).run(tasks)
+    assert results == [] and timed_out == []
+    assert len(errored) == 2
+    assert report['retries'] == 4
@@ -0,0 +1,18 @@
+import numpy as np
+import pytest
+from population_synthesis import synthesize, DISTANCE_GRID
+
+
+@pytest.mark.parametrize('instrument,selection', [('all', {}), ('maxi', {'flux_limit': 3e-10, 'nH_efold': 10.0})])
+def test_density_has_unit_integral_over_the_grid(instrument,selection):
+    result = synthesize(20000, instrument, n_realizations=2, chunk_size=5000, processes=1, **selection)
+    step = np.gradient(DISTANCE_GRID)
+    assert np.sum(result['density'] * step) == pytest.approx(1.0, rel=1e-12)
+    assert np.sum(result['realizations'] * step, axis=1) == pytest.approx([1.0, 1.0], rel=1e-12)
+    assert np.trapezoid(result['density'], DISTANCE_GRID) == pytest.approx(1.0, rel=1e-3)
+
+
+def test_runs_are_reproducible_for_any_number_of_processes():
+    first = synthesize(20000, 'all', chunk_size=5000, processes=1, seed=3)
+    second = synthesize(20000, 'all', chunk_size=5000, processes=2, seed=3)
+    assert np.array_equal(first['counts'], second['counts'])
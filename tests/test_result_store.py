@@ -0,0 +1,82 @@
+import multiprocessing
+import os
+import shutil
+import signal
+import time
+import numpy as np
+import pytest
+from result_store import result_store, RESULT_COLUMNS
+
+RUN_PARAMS = {'gamma': 2.0, 'temp': 1.0, 'instrument': 'maxi', 'backend': 'fake'}
+
+
+def result(task_id):
+    return {column: float(task_id) for column in RESULT_COLUMNS}
+
+
+def write_forever(path):
+    # Flushes a batch file after every task until it is killed
+    store = result_store(path, RUN_PARAMS, flush_every=1)
+    task_id = 0
+    while True:
+        store.append(task_id, 0.1, 1.0, result(task_id))
+        task_id += 1
+
+
+def check_store(path):
+    # Every task in the store has its row exactly once, and they are the first tasks of the writer (it runs them in
+    # order)
+    store = result_store(path, RUN_PARAMS)
+    done = store.done_tasks()
+    df = store.to_dataframe()
+    assert done == set(range(len(done)))
+    assert df['nH'].tolist() == sorted(done)
+    return store, len(done)
+
+
+@pytest.mark.parametrize('delay', [0.2, 0.5, 1.0])
+def test_killed_writer_resumes(tmp_path,delay):
+    path = str(tmp_path / 'store.h5')
+    writer = multiprocessing.get_context('fork').Process(target=write_forever, args=(path,))
+    writer.start()
+    deadline = time.monotonic() + 30
+    while not os.path.isdir(path + '.batches') or len(os.listdir(path + '.batches')) < 3:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    time.sleep(delay * np.random.default_rng().uniform())
+    os.kill(writer.pid, signal.SIGKILL)
+    writer.join()
+
+    store, n_done = check_store(path)
+    assert n_done >= 3
+    with store:
+        for task_id in range(n_done, n_done + 10):
+            store.append(task_id, 0.1, 1.0, result(task_id))
+    store, n_resumed = check_store(path)
+    assert n_resumed == n_done + 10
+    assert os.listdir(path + '.batches') == []
+
+
+def test_batches_left_by_an_interrupted_merge_are_not_counted_twice(tmp_path):
+    path = str(tmp_path / 'store.h5')
+    store = result_store(path, RUN_PARAMS, flush_every=2)
+    for task_id in range(4):
+        store.append(task_id, 0.1, 1.0, result(task_id))
+    batches = sorted(os.listdir(path + '.batches'))
+    shutil.copytree(path + '.batches', str(tmp_path / 'kept'))
+    store.merge()
+    # A kill after the main file was replaced and before the merged batches were deleted
+    for name in batches:
+        shutil.copy(str(tmp_path / 'kept' / name), path + '.batches')
+    with open(os.path.join(path + '.batches', '%08d.h5.tmp' % (len(batches) + 1)), 'wb') as fh:
+        fh.write(b'torn write')
+    store, n_done = check_store(path)
+    assert n_done == 4
+    assert os.listdir(path + '.batches') == []
+
+
+def test_other_run_parameters_are_refused(tmp_path):
+    path = str(tmp_path / 'store.h5')
+    result_store(path, RUN_PARAMS)
+    with pytest.raises(ValueError):
+        result_store(path, dict(RUN_PARAMS, gamma=2.5))
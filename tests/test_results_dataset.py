@@ -0,0 +1,84 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from results_dataset import results_dataset, parse_table_name
+
+CONFIGURATIONS = [(2.0, 1.0), (2.0, 0.5), (1.7, 1.0)]
+
+
+def write_tables(root,seed=0,scale=1.0):
+    # Reduced tables of a few (g, T) configurations on an nH x d grid, rows shuffled
+    rng = np.random.default_rng(seed)
+    folder = os.path.join(root, 'maxi_results')
+    os.makedirs(folder, exist_ok=True)
+    frames = {}
+    for g, T in CONFIGURATIONS:
+        nH, d = np.meshgrid([0.1, 0.5, 1.0, 5.0], [2.0, 3.5, 5.0, 8.0, 12.0], indexing='ij')
+        df = pd.DataFrame({'nH': nH.ravel(), 'd': d.ravel(), 'd_fit_peak': scale * rng.uniform(1, 15, nH.size)})
+        df = df.sample(frac=1, random_state=seed).reset_index(drop=True)
+        name = os.path.join(folder, 'table_g%s_T%s_a0.5_m8.0_i60.0_r0.8_e1000.0.csv' % (g, T))
+        df.to_csv(name, index=False)
+        frames[(g, T)] = pd.read_csv(name)
+    return frames
+
+
+def in_range(values,condition):
+    low, high = condition if isinstance(condition, tuple) else (condition, condition)
+    return (values >= (-np.inf if low is None else low)) & (values <= (np.inf if high is None else high))
+
+
+@pytest.mark.parametrize('nH,d', [((0.1, 1.0), (3.0, 8.0)), ((0.5, 0.5), 5.0), ((None, None), (None, 4.0)), ((2.0, 3.0), (2.0, 12.0))])
+def test_query_matches_the_tables(tmp_path,nH,d):
+    frames = write_tables(str(tmp_path / 'results'))
+    dataset = results_dataset(str(tmp_path / 'dataset'))
+    dataset.ingest(str(tmp_path / 'results' / '*_results' / 'table_*.csv'), verbose=False)
+    df = dataset.query('reduced', ['d_fit_peak'], instrument='maxi', g=2.0, T=1.0, nH=nH, d=d)
+    table = frames[(2.0, 1.0)]
+    assert sorted(df['d_fit_peak']) == sorted(table['d_fit_peak'][in_range(table['nH'], nH) & in_range(table['d'], d)])
+
+
+def test_interrupted_compact_leaves_the_dataset_as_it_was(tmp_path,monkeypatch):
+    pattern = str(tmp_path / 'results' / '*_results' / 'table_*.csv')
+    write_tables(str(tmp_path / 'results'))
+    dataset = results_dataset(str(tmp_path / 'dataset'))
+    dataset.ingest(pattern, verbose=False)
+    # Changed tables are ingested again and their old rows become inactive
+    for name in os.listdir(str(tmp_path / 'results' / 'maxi_results')):
+        os.utime(str(tmp_path / 'results' / 'maxi_results' / name), ns=(0, 0))
+    frames = write_tables(str(tmp_path / 'results'), seed=1, scale=2.0)
+    dataset.ingest(pattern, verbose=False)
+    before = dataset.query('reduced', ['d_fit_peak'], g=2.0, T=1.0, nH=(0.1, 1.0))
+
+    def killed(manifest):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(dataset, '_write_manifest', killed)
+    with pytest.raises(KeyboardInterrupt):
+        dataset.compact()
+    monkeypatch.undo()
+    pd.testing.assert_frame_equal(dataset.query('reduced', ['d_fit_peak'], g=2.0, T=1.0, nH=(0.1, 1.0)), before)
+
+    dataset = results_dataset(str(tmp_path / 'dataset'))
+    pd.testing.assert_frame_equal(dataset.query('reduced', ['d_fit_peak'], g=2.0, T=1.0, nH=(0.1, 1.0)), before)
+    assert sorted(os.listdir(str(tmp_path / 'dataset'))) == ['manifest.json', 'reduced']
+
+    dataset.compact()
+    assert dataset.manifest['tables']['reduced']['n_rows'] == sum(len(df) for df in frames.values())
+    pd.testing.assert_frame_equal(dataset.query('reduced', ['d_fit_peak'], g=2.0, T=1.0, nH=(0.1, 1.0)), before)
+    assert sorted(os.listdir(str(tmp_path / 'dataset'))) == ['manifest.json', 'reduced.1']
+
+
+def test_backends_are_told_apart(tmp_path):
+    write_tables(str(tmp_path / 'results'))
+    # A numpy run of the same configuration as one of the XSPEC tables
+    folder = tmp_path / 'results' / 'maxi_results'
+    numpy_table = pd.DataFrame({'nH': [0.1, 0.1], 'd': [2.0, 3.5], 'd_fit_peak': [-1.0, -2.0]})
+    numpy_table.to_csv(str(folder / 'table_g2.0_T1.0_a0.5_m8.0_i60.0_r0.8_e1000.0_numpy.csv'), index=False)
+    assert parse_table_name('table_g2.0_T1.0_a0.5_m8.0_i60.0_r0.8_e1000.0_numpy_full.csv') == \
+        ('full', {'g': 2.0, 'T': 1.0, 'a': 0.5, 'm': 8.0, 'i': 60.0, 'r': 0.8, 'e': 1000.0}, '', 'numpy')
+    dataset = results_dataset(str(tmp_path / 'dataset'))
+    dataset.ingest(str(tmp_path / 'results' / '*_results' / 'table_*.csv'), verbose=False)
+    df = dataset.query('reduced', ['d_fit_peak'], g=2.0, T=1.0, nH=0.1, d=(2.0, 3.5))
+    assert sorted(df['backend']) == ['numpy', 'numpy', 'xspec', 'xspec']
+    assert sorted(dataset.query('reduced', ['d_fit_peak'], backend='numpy', g=2.0, T=1.0)['d_fit_peak']) == [-2.0, -1.0]
+    assert (dataset.query('reduced', ['d_fit_peak'], backend='xspec')['d_fit_peak'] > 0).all()
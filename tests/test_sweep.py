@@ -0,0 +1,75 @@
+import json
+import os
+import pytest
+import benchmarks
+import sweep
+from observational_effects import open_store, table_name
+
+SPEC = {'parameters': {'gamma': [1.7, 2.0, 2.3], 'temp': 1.0, 'a': 0.5, 'mass': 8.0, 'inc': 60.0, 'ratio_disk_to_tot': 0.8,
+                       'exposure': 1000.0},
+        'instrument': ['maxi', 'xrt'], 'backend': 'fake', 'nH': [0.1], 'd': [2.0, 5.0], 'n_iterations': 2}
+
+
+def write_profile(instrument,seconds,realizations,run=True):
+    os.makedirs('results/%s_results' % instrument, exist_ok=True)
+    summary = {'tasks': realizations, 'task': {'count': realizations, 'total': seconds}, 'realizations': realizations}
+    if run:
+        summary['run'] = {'instrument': instrument, 'backend': 'fake', 'batched': False}
+    with open('results/%s_results/table_g%s_profile.json' % (instrument, seconds), 'w') as fh:
+        json.dump(summary, fh)
+
+
+@pytest.fixture
+def sweep_dir(tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_profile('maxi', 2.0, 200)
+    write_profile('xrt', 10.0, 200)
+    # Profiles written before they recorded their run are not used
+    write_profile('xrt', 1000.0, 10, run=False)
+    return tmp_path
+
+
+def test_cost_weights_are_measured_from_the_profiles(sweep_dir):
+    assert sweep.profile_cost_weights() == {('maxi', 'fake', False): pytest.approx(0.01), ('xrt', 'fake', False): pytest.approx(0.05)}
+    config = benchmarks.config(instrument='xrt')
+    assert sweep.estimate_cost(config, 100, sweep.profile_cost_weights()) == pytest.approx(5.0)
+    assert sweep.estimate_cost(config, 100, sweep.profile_cost_weights(), {'xrt': 1.0}) == pytest.approx(100.0)
+    assert sweep.estimate_cost(benchmarks.config(backend='numpy'), 100, {}) == 100
+
+
+def test_completed_configurations_are_left_out_before_partitioning(sweep_dir):
+    configs = sweep.expand_grid(SPEC)
+    done, half_done = configs[0], configs[1]
+    os.makedirs(os.path.dirname(table_name(done)), exist_ok=True)
+    open(table_name(done) + '.csv', 'w').close()
+    with open_store(half_done, n_iterations=2) as store:
+        for task_id in range(2):
+            store.append(task_id, 0.1, 2.0, {'nH': 0.1, 'd': 2.0})
+
+    plan = sweep.plan_sweep(SPEC, 2)
+    names = [table_name(config) for config in configs]
+    assert sorted(name for shard in plan['shards'] for name in shard) == sorted(names[1:])
+    # 4 realizations per configuration, at 0.01 s for MAXI and 0.05 s for XRT; half of one configuration is done
+    expected = {name: (0.04 if config.instrument == 'maxi' else 0.2) for name, config in zip(names, configs)}
+    expected[names[1]] /= 2
+    assert plan['costs'] == pytest.approx({name: expected[name] for name in names[1:]})
+    loads = sorted(sum(plan['costs'][name] for name in shard) for shard in plan['shards'])
+    assert loads == pytest.approx([0.26, 0.4])
+
+
+def test_shards_share_the_plan_of_the_first_one(sweep_dir):
+    path = str(sweep_dir / 'spec.json.plan_1.json')
+    first = sweep.load_plan(path, lambda: sweep.plan_sweep(SPEC, 3))
+    # A configuration finished by the first shard before the second one starts does not change the partition
+    done = sweep.expand_grid(SPEC)[3]
+    os.makedirs(os.path.dirname(table_name(done)), exist_ok=True)
+    open(table_name(done) + '.csv', 'w').close()
+    assert sweep.plan_sweep(SPEC, 3) != first
+    assert sweep.load_plan(path, lambda: sweep.plan_sweep(SPEC, 3)) == first
+    assert sorted(os.listdir(str(sweep_dir))) == ['results', 'spec.json.plan_1.json']
+
+
+def test_backends_have_their_own_tables():
+    xspec, numpy = benchmarks.config(backend='xspec'), benchmarks.config(backend='numpy')
+    assert table_name(numpy) == table_name(xspec) + '_numpy'
+    assert os.path.basename(table_name(xspec)) == 'table_g2.0_T1.0_a0.5_m8.0_i60.0_r0.8_e1000.0'
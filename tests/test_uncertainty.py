@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+import numpy_simulations as ns
+from benchmarks import synthetic_correction_table
+from uncertainty import z_score, log_sigma, covariance_interval, monte_carlo_distance
+
+# 5% and 95% quantiles of the standard normal, and the delta chi^2 of XSPEC's default 90% Fit.error
+Z_90 = 1.6448536269514722
+DELTA_CHI2_90 = 2.706
+
+
+def test_interval_of_a_known_gaussian():
+    assert z_score() == pytest.approx(Z_90, rel=1e-12)
+    assert z_score() ** 2 == pytest.approx(DELTA_CHI2_90, rel=1e-3)
+    low, up = covariance_interval(np.array([1.0, 250.0]), np.array([0.1, 0.02]))
+    assert low == pytest.approx([np.exp(-0.1 * Z_90), 250.0 * np.exp(-0.02 * Z_90)], rel=1e-12)
+    assert up == pytest.approx([np.exp(0.1 * Z_90), 250.0 * np.exp(0.02 * Z_90)], rel=1e-12)
+
+
+def test_interval_covers_the_true_norm_of_a_linear_fit():
+    # Least squares norm of a template with Gaussian noise: its sigma is 1 / sqrt(sum(t^2 / s^2)), and the
+    # interval should contain the true norm in 90% of the realizations
+    rng = np.random.default_rng(0)
+    template, noise, true_norm, n = np.linspace(1, 2, 50), 0.5, 40.0, 20000
+    data = true_norm * template + noise * rng.standard_normal((n, len(template)))
+    norm = data @ template / (template @ template)
+    sigma = np.full(n, noise / np.sqrt(template @ template))
+    low, up = covariance_interval(norm, log_sigma(norm, sigma))
+    coverage = np.mean((low <= true_norm) & (true_norm <= up))
+    assert coverage == pytest.approx(0.9, abs=0.01)
+
+
+def test_monte_carlo_quantiles_converge_to_the_covariance_interval():
+    # With fixed mass, spin and inclination d is proportional to norm^-1/2, so the distance quantiles are the
+    # distances of the norm interval bounds (swapped)
+    f = synthetic_correction_table()
+    norm, sigma_log = np.array([300.0, 1000.0, 3000.0]), np.array([0.01, 0.05, 0.2])
+    low, up = covariance_interval(norm, sigma_log)
+    d_low, d_up = f.to_d(up, 8.0, 0.5, 60.0), f.to_d(low, 8.0, 0.5, 60.0)
+    errors = []
+    for n_samples in (1000, 100000):
+        median, mc_low, mc_up = monte_carlo_distance(f, norm, sigma_log, 8.0, 0.5, 60.0, n_samples=n_samples, rng=np.random.default_rng(1))
+        errors.append(np.max(np.abs(np.concatenate([mc_low / d_low, mc_up / d_up]) - 1)))
+    assert median == pytest.approx(f.to_d(norm, 8.0, 0.5, 60.0), rel=1e-3)
+    assert errors[1] < 2e-3
+    assert errors[1] < errors[0]
+
+
+def test_missing_or_non_positive_uncertainties_give_no_interval():
+    # XSPEC reports sigma -1 without a covariance and 0 for a pegged parameter
+    sigma_log = log_sigma([100.0, 100.0, 100.0, 0.0, -5.0, 100.0], [-1.0, 0.0, np.nan, 2.0, 2.0, 2.0])
+    assert np.all(np.isnan(sigma_log[:5]))
+    assert sigma_log[5] == pytest.approx(0.02)
+    low, up = covariance_interval([100.0, 100.0], sigma_log[[0, 5]])
+    assert np.isnan(low[0]) and np.isnan(up[0])
+    assert np.isfinite(low[1]) and np.isfinite(up[1])
+    f = synthetic_correction_table()
+    median, mc_low, mc_up = monte_carlo_distance(f, [100.0, 0.0, 100.0], [np.nan, 0.02, 0.02], 8.0, 0.5, 60.0, n_samples=100, rng=np.random.default_rng(0))
+    assert np.all(np.isnan([median[:2], mc_low[:2], mc_up[:2]]))
+    assert np.all(np.isfinite([median[2], mc_low[2], mc_up[2]]))
+
+
+def test_singular_fit_covariance_gives_no_interval():
+    # A disc far below the band of the response leaves its norm unconstrained: the covariance is singular and the
+    # numpy backend has no sigma for the norm
+    edges = np.geomspace(0.5, 30, 201)
+    response = {'energ_lo': edges[:-1], 'energ_hi': edges[1:], 'e_min': edges[:-1], 'e_max': edges[1:],
+                'matrix': ns.response_matrix(np.full(200, 50.0), np.arange(200, dtype=np.int32), np.arange(201), 200)}
+    components = ns.model_components(response)
+    rate = components.folded(np.array([1.0, 2.0, 0.3, 0.01, 400.0]))
+    fit = ns.fit_spectra(components, np.arange(200)[None, :], rate, rate / 1e4, ns.parse_xspec_params({1: '1.0,0', 2: '2.0,0', 4: '0.01,0'}))
+    sigma_log = np.sqrt(fit['covariance'][:, -1, -1])
+    assert np.all(np.isnan(sigma_log))
+    assert np.all(np.isnan(covariance_interval(fit['values'][:, 4], sigma_log)))
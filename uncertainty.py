@@ -0,0 +1,94 @@
+'''
+Distance uncertainties from the fitted ezdiskbb norm without XSPEC's Fit.error. The 1-sigma uncertainty of the log
+norm comes from the fit covariance (the diagonal element of the norm, available right after the fit), and is either
+turned into a confidence interval on the norm that goes through to_d ('covariance'), or propagated to the distance
+by drawing norms, and optionally spins, inclinations and masses, for all realizations at once ('montecarlo').
+'''
+from statistics import NormalDist
+import numpy as np
+
+ERROR_METHODS = ('covariance', 'montecarlo', 'profile')
+
+# Confidence level of the intervals: 90%, the delta chi^2 = 2.706 of Fit.error
+LEVEL = 0.9
+
+# Inclinations (degrees) are kept in the range of the GR correction grid
+INC_RANGE = (0.0, 90.0)
+
+
+def z_score(level=LEVEL):
+    return NormalDist().inv_cdf(0.5 + level / 2)
+
+
+def log_sigma(norm,sigma):
+    '''
+    1-sigma uncertainty of ln(norm) from the 1-sigma uncertainty of the norm (e.g. the sigma of an XSPEC parameter,
+    which is -1 when the fit has no covariance); NaN where it is not available.
+    '''
+    norm, sigma = np.asarray(norm, dtype=float), np.asarray(sigma, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where((sigma > 0) & (norm > 0), sigma / norm, np.nan)
+
+
+def covariance_interval(norm,sigma_log,level=LEVEL):
+    '''
+    Confidence interval on the norm, symmetric in ln(norm), from the covariance uncertainty of ln(norm).
+
+    Returns:
+        tuple: lower and upper norms, NaN where sigma_log is not finite
+    '''
+    norm = np.asarray(norm, dtype=float)
+    width = z_score(level) * np.asarray(sigma_log, dtype=float)
+    return norm * np.exp(-width), norm * np.exp(width)
+
+
+def monte_carlo_distance(f,norm,sigma_log,mass,a,inc,n_samples=1000,level=LEVEL,rng=None,mass_sigma=0.0,a_sigma=0.0,inc_sigma=0.0,limb_dark=True):
+    '''
+    Distance interval of every realization from n_samples draws of its norm (log-normal with sigma_log) and of
+    the mass, spin and inclination (normal with mass_sigma, a_sigma and inc_sigma around mass, a and inc), all put
+    through one call of the vectorized correction_table.to_d. Spins are kept in the range of the correction grid,
+    inclinations in INC_RANGE and masses positive.
+
+    With fixed mass, spin and inclination the distance is a monotonic function of the norm, so the quantiles are
+    those of the 'covariance' interval up to sampling noise; the draws matter when those have uncertainties.
+
+    Arguments:
+    f: correction_table
+    norm, sigma_log: fitted norms and covariance uncertainties of ln(norm), one per realization
+    mass, a, inc: values around which the draws are centred (scalars, or one per realization)
+    n_samples: draws per realization
+    level: confidence level of the interval
+    rng: numpy Generator (default: a new unseeded one)
+
+    Returns:
+        tuple: median, lower and upper quantiles of the distance, one per realization (NaN where sigma_log is not
+        finite)
+    '''
+    rng = np.random.default_rng() if rng is None else rng
+    norm = np.atleast_1d(np.asarray(norm, dtype=float))
+    sigma_log = np.broadcast_to(np.asarray(sigma_log, dtype=float), norm.shape)
+    valid = np.isfinite(norm) & (norm > 0) & np.isfinite(sigma_log)
+    median, low, up = (np.full(norm.shape, np.nan) for _ in range(3))
+    if not valid.any():
+        return median, low, up
+
+    shape = (np.count_nonzero(valid), n_samples)
+    samples = norm[valid, None] * np.exp(sigma_log[valid, None] * rng.standard_normal(shape))
+    mass, a, inc = (np.broadcast_to(np.asarray(x, dtype=float), norm.shape)[valid, None] for x in (mass, a, inc))
+    if mass_sigma:
+        mass = np.clip(mass + mass_sigma * rng.standard_normal(shape), 1e-3, None)
+    if a_sigma:
+        a = np.clip(a + a_sigma * rng.standard_normal(shape), np.min(f['a_grid']), np.max(f['a_grid']))
+    if inc_sigma:
+        inc = np.clip(inc + inc_sigma * rng.standard_normal(shape), *INC_RANGE)
+    # Drawn spins and inclinations are often tied between grid points in 'nearest' mode; the warning of the
+    # table would be printed for every task
+    verbose, f.verbose = f.verbose, False
+    try:
+        d = f.to_d(samples, mass, a, inc, limb_dark=limb_dark)
+    finally:
+        f.verbose = verbose
+
+    tail = (1 - level) / 2
+    median[valid], low[valid], up[valid] = np.quantile(d, [0.5, tail, 1 - tail], axis=1)
+    return median, low, up
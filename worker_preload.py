@@ -0,0 +1,35 @@
+'''
+Imported once by the fork server of task_scheduler (see observational_effects.PRELOAD_MODULES), before it forks
+any worker: builds the per-process tables that do not depend on the run, so that every worker, including one that
+replaces a timed out worker, is forked with them instead of building them in init_worker or its first task.
+Only meant to be imported by the fork server.
+'''
+import os
+import flux_norm
+import numpy_simulations
+
+# Instruments whose spectra and response are read into the server (when their files are in the working directory)
+INSTRUMENTS = ('maxi', 'xrt')
+
+
+def preload_tables():
+    # ezdiskbb radial integral and band grids of flux_norm (used by scale_powerlaw_norm in every task), and the
+    # tbabs cross-sections of the numpy backend
+    numpy_simulations.ezdiskbb_radial_table()
+    numpy_simulations.read_tbabs_table()
+    for band in flux_norm.INSTRUMENT_BANDS.values():
+        flux_norm.band_grid(*band)
+
+
+def preload_instruments(instruments=INSTRUMENTS):
+    for instrument in instruments:
+        sim = numpy_simulations.numpy_simulation(numpy_simulations.MODEL,instrument,{},{})
+        if all(os.path.isfile(name) for name in (sim.sourceFilename, sim.backgroundFilename, sim.responseFilename)):
+            try:
+                sim.preload()
+            except Exception:  # a broken file is reported by the tasks
+                pass
+
+
+preload_tables()
+preload_instruments()
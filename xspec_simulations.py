@@ -1,7 +1,6 @@
 
-from xspec import *
-import subprocess
-import heasoftpy as hsp
+from grouping import group_file
+from profiling import stage_timer
 
 class simulation:
     
@@ -15,10 +14,12 @@ class simulation:
         simulation_params_dic: the dictionary (in PyXspec notation) that specifics the parameters of the faked spectrum (example: {1:'0.5,0',5:',,0.1,0.1'})
         fit_params_dic : similar to simulation_params_dic but for the model to be fitted
 
+        PyXspec is only imported when the object is first run (or preloaded).
         '''
         self.model =  model_def
         self.sim_params_dic = simulation_params_dic 
         self.fit_params_dic = fit_params_dic
+        self._template = None
         if instrument == 'maxi': # Will need to change this part according to your need
             self.energyRange_low = '2.0'
             self.energyRange_high= '20.0'
@@ -34,53 +35,96 @@ class simulation:
         else:
             raise ValueError('Only maxi or xrt allowed.')
 
-    def run(self,id='',spec_dir='',**kwargs):
+    def reset(self,simulation_params_dic,fit_params_dic):
+        '''
+        Sets the parameters of the next run, keeping the instrument settings and the model template, so that a
+        worker can reuse one simulation object for all its tasks (see observational_effects.get_simulation).
+        '''
+        self.sim_params_dic = simulation_params_dic
+        self.fit_params_dic = fit_params_dic
+        return self
+
+    def preload(self):
+        '''
+        Imports PyXspec and builds the model template ahead of the first run.
+        '''
+        self._set_model({})
+
+    def _set_model(self,params_dic):
+        '''
+        Resets the model template to the defaults XSPEC gave it (values, limits and frozen flags) and applies
+        params_dic. The template is built once and kept while loading and clearing spectra, which is cheaper than
+        building a new model twice per run. It is built again if the models were cleared elsewhere.
+        '''
+        from xspec import AllModels, Model
+        if self._template is not None:
+            try:
+                current = AllModels(1).expression == self._template[0].expression
+            except Exception:
+                current = False
+            if not current:
+                self._template = None
+        if self._template is None:
+            AllModels.clear()
+            model = Model(self.model)
+            self._template = (model, [(list(model(i).values), model(i).frozen) for i in range(1, model.nParameters + 1)])
+        model, defaults = self._template
+        for i, (values, frozen) in enumerate(defaults, start=1):
+            model(i).values = values
+            model(i).frozen = frozen
+        if params_dic:
+            model.setPars(params_dic)
+        return model
+
+    def run(self,id='',spec_dir='',profile_errors=False,**kwargs):
 
         '''
         Perform a simulation run (fake a spectrum and then fit it)
 
         Arguments:
         id: needed for the temp fake it file (especially when running multiprocessing simulation)
+        profile_errors: run Fit.error on every free parameter after the fit (slow). Otherwise only the covariance
+                        sigmas of the fit are available (see uncertainty.py).
         **kwargs: This is passed to the FakeitSettings object from PyXspec. Needed to change exposure of the faked spectrum for example
 
         Output:
-        A fitted model object. If fitting fails it will return the unfitted model object 
+        The fitted model object and the total flux. An exception of Fit.perform (a failed fit) is raised, so the
+        task that ran it fails and is retried by the scheduler.
  
         '''
-        
-        AllModels.clear()
+        from xspec import AllModels, AllData, Spectrum, FakeitSettings, Fit
+        timer = stage_timer()
         AllData.clear()
 
-        Model(self.model,setPars=self.sim_params_dic)
+        self._set_model(self.sim_params_dic)
 
         s1 = Spectrum(self.sourceFilename)
+        timer.lap('model_setup')
 
         fake_settings = FakeitSettings(response=self.responseFilename,background=self.backgroundFilename,fileName=spec_dir+"/fakeit_tmp_"+str(id)+".pha",**kwargs)
         AllData.fakeit(1, fake_settings, applyStats=True)
+        timer.lap('fakeit')
 
-        with hsp.utils.local_pfiles_context():
-            hsp.ftgrouppha(infile=spec_dir+'/fakeit_tmp_'+str(id)+'.pha',backfile=spec_dir+'/fakeit_tmp_'+str(id)+'_bkg.pha',outfile=spec_dir+'/fakeit_tmp_'+str(id)+'_binned.pha',grouptype='snmin',groupscale='3')
+        # Same grouping as ftgrouppha grouptype='snmin' groupscale=3, written into the faked spectrum in-process
+        group_file(spec_dir+'/fakeit_tmp_'+str(id)+'.pha',backfile=spec_dir+'/fakeit_tmp_'+str(id)+'_bkg.pha',grouptype='snmin',groupscale=3)
+        timer.lap('grouping')
 
-        # command = f'ftgrouppha fakeit_tmp_'+str(id)+'.pha backfile=fakeit_tmp_'+str(id)+'_bkg.pha fakeit_tmp_'+str(id)+'_binned.pha snmin 3'
-        # process = subprocess.Popen(command, shell=True)
-        # process.wait()
-        
         AllData.clear()
-        s1 = Spectrum(spec_dir+"/fakeit_tmp_"+str(id)+"_binned.pha")
+        s1 = Spectrum(spec_dir+"/fakeit_tmp_"+str(id)+".pha")
         AllData.ignore("bad")
         s1.ignore("**-"+self.energyRange_low+","+self.energyRange_high+"-**")
-        AllModels.clear()
-        fitModel = Model(self.model,setPars=self.fit_params_dic)
+        fitModel = self._set_model(self.fit_params_dic)
         Fit.query = "yes"
+        timer.lap('load')
 
-        try:
-            Fit.perform()
+        Fit.perform()
+        timer.lap('fit')
+        if profile_errors:
             try:
                 Fit.error("1-"+str(fitModel.nParameters))
             except:
                 pass
-        except:
-            pass
+            timer.lap('error')
 
         tot_flux = None
 
@@ -89,12 +133,12 @@ class simulation:
             tot_flux = s1.flux[0]
         except:
             pass
+        timer.lap('flux')
         
         # command = [
         #     'rm', '-rf',
         #     f"{spec_dir}/fakeit_tmp_{id}.pha",
-        #     f"{spec_dir}/fakeit_tmp_{id}_bkg.pha",
-        #     f"{spec_dir}/fakeit_tmp_{id}_binned.pha"
+        #     f"{spec_dir}/fakeit_tmp_{id}_bkg.pha"
         # ]
         # process = subprocess.Popen(command)
         # process.wait(timeout=30)